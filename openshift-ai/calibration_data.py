@@ -0,0 +1,205 @@
+"""Calibration sets shared by the compression steps.
+
+SparseGPT, the CPU quantization and GPTQ all calibrate on a few hundred
+samples of a dataset, and every one of them used to load, format and
+tokenize it again on each run, sometimes the whole dataset to keep 512
+samples. calibration_set streams the dataset once, reservoir sampling it with
+a fixed seed, so neither the disk nor the memory hold more than the sample,
+tokenizes the sample in batches and keeps it in the model cache on the
+shared volume, keyed by tokenizer, dataset, seed, sample count and
+max_seq_len:
+
+    calibration = calibration_set(model_path, "open_platypus", 512, 384,
+                                  cache_dir="/mnt/models/cache",
+                                  path=compress_model_path + "-calibration")
+    oneshot(model=model, dataset=calibration.dataset(), ...)  # SparseML
+    model.quantize(calibration.examples())                    # AutoGPTQ
+
+The tokens are stored as numpy arrays, memory mapped when loaded, next to
+the formatted texts SparseML tokenizes itself. This module is baked into the
+sparseml and storage images, see their Dockerfiles.
+"""
+import hashlib
+import json
+import os
+import random
+
+import numpy as np
+
+# Files the tokenizer is loaded from, the ones that change its output
+TOKENIZER_PATTERNS = ('tokenizer', 'special_tokens_map', 'added_tokens',
+                      'vocab', 'merges', 'spiece')
+
+# Alpaca templates SparseML formats open_platypus with, the one without
+# input for the samples whose input is empty, most of Open-Platypus
+ALPACA_PROMPT = (
+    "Below is an instruction that describes a task, paired with an input "
+    "that provides further context. Write a response that appropriately "
+    "completes the request.\n\n### Instruction:\n{instruction}\n\n"
+    "### Input:\n{input}\n\n### Response:\n")
+ALPACA_PROMPT_NO_INPUT = (
+    "Below is an instruction that describes a task. Write a response that "
+    "appropriately completes the request.\n\n### Instruction:\n"
+    "{instruction}\n\n### Response:\n")
+
+
+def _platypus_text(tokenizer, sample):
+    if sample.get("input"):
+        prompt = ALPACA_PROMPT.format(instruction=sample["instruction"],
+                                      input=sample["input"])
+    else:
+        prompt = ALPACA_PROMPT_NO_INPUT.format(
+            instruction=sample["instruction"])
+    return prompt + sample["output"]
+
+
+def _instruction_text(tokenizer, sample):
+    return sample["instruction"] + sample["output"]
+
+
+def _chat_text(tokenizer, sample):
+    return tokenizer.apply_chat_template(sample["messages"], tokenize=False)
+
+
+# How the samples are drawn, part of the cache key
+SAMPLING = 'reservoir'
+
+# Version of the sample formatting, part of the cache key, bumped when the
+# formatted texts change
+FORMATTING = 2
+
+# HF dataset, split and sample formatting of every calibration dataset
+DATASETS = {
+    'open_platypus': ('garage-bAInd/Open-Platypus', 'train', _platypus_text),
+    'garage-bAInd/Open-Platypus': ('garage-bAInd/Open-Platypus', 'train',
+                                   _instruction_text),
+    'HuggingFaceH4/ultrachat_200k': ('HuggingFaceH4/ultrachat_200k',
+                                     'train_sft', _chat_text),
+}
+
+
+class CalibrationSet:
+    """A calibration set built by calibration_set, loaded from path."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'info.json')) as f:
+            self.info = json.load(f)
+        self.input_ids = np.load(os.path.join(path, 'input_ids.npy'),
+                                 mmap_mode='r')
+        self.lengths = np.load(os.path.join(path, 'lengths.npy'),
+                               mmap_mode='r')
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def texts(self):
+        with open(os.path.join(self.path, 'texts.json')) as f:
+            return json.load(f)
+
+    def dataset(self):
+        """The formatted samples, as the dataset SparseML oneshot takes."""
+        from datasets import Dataset
+
+        return Dataset.from_dict({'text': self.texts()})
+
+    def examples(self):
+        """The tokenized samples, as the examples AutoGPTQ quantizes with."""
+        return [{'input_ids': self.input_ids[i, :length].tolist(),
+                 'attention_mask': [1] * int(length)}
+                for i, length in enumerate(self.lengths)]
+
+
+def tokenizer_hash(model_path):
+    """Hash of the tokenizer files of a model folder."""
+    sha256 = hashlib.sha256()
+    for file in sorted(os.listdir(model_path)):
+        if file.startswith(TOKENIZER_PATTERNS):
+            sha256.update(file.encode())
+            with open(os.path.join(model_path, file), 'rb') as f:
+                sha256.update(f.read())
+    return sha256.hexdigest()
+
+
+def reservoir_sample(samples, num_samples, seed=42):
+    """num_samples drawn uniformly from the samples iterable, in one pass.
+
+    Only the sample is held in memory, however long the iterable is.
+    """
+    rng = random.Random(seed)
+    reservoir = []
+    for index, sample in enumerate(samples):
+        if index < num_samples:
+            reservoir.append(sample)
+        else:
+            slot = rng.randint(0, index)
+            if slot < num_samples:
+                reservoir[slot] = sample
+    return reservoir
+
+
+def build_calibration_set(path, model_path, ds, num_samples, max_seq_len,
+                          seed=42, batch_size=64):
+    """Sample, format and tokenize num_samples of ds into path."""
+    from datasets import load_dataset
+    from transformers import AutoTokenizer
+
+    if ds not in DATASETS:
+        raise ValueError(f'No calibration format for {ds}, one of '
+                         f'{", ".join(DATASETS)} is needed')
+    dataset_name, split, format_text = DATASETS[ds]
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    # Streamed, so the split is never written to disk nor loaded whole, and
+    # only the sample is formatted
+    dataset = load_dataset(dataset_name, split=split, streaming=True)
+    samples = reservoir_sample(dataset, num_samples, seed)
+    texts = [format_text(tokenizer, sample) for sample in samples]
+
+    input_ids = np.zeros((len(texts), max_seq_len), dtype=np.int32)
+    lengths = np.zeros(len(texts), dtype=np.int32)
+    for start in range(0, len(texts), batch_size):
+        batch = tokenizer(texts[start:start + batch_size], padding=False,
+                          max_length=max_seq_len, truncation=True)
+        for offset, ids in enumerate(batch['input_ids']):
+            input_ids[start + offset, :len(ids)] = ids
+            lengths[start + offset] = len(ids)
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'input_ids.npy'), input_ids)
+    np.save(os.path.join(path, 'lengths.npy'), lengths)
+    with open(os.path.join(path, 'texts.json'), 'w') as f:
+        json.dump(texts, f)
+    with open(os.path.join(path, 'info.json'), 'w') as f:
+        json.dump({'dataset': ds, 'sampling': SAMPLING, 'seed': seed,
+                   'num_samples': len(texts),
+                   'max_seq_len': max_seq_len,
+                   'tokens': int(lengths.sum())}, f, indent=2)
+    print(f'Built a calibration set of {len(texts)} samples of {ds}, '
+          f'{int(lengths.sum())} tokens')
+
+
+def calibration_set(model_path, ds, num_samples, max_seq_len, path,
+                    seed=42, cache_dir=""):
+    """The calibration set of ds for the tokenizer of model_path, at path.
+
+    With a cache_dir, it is only built the first time, and exposed at path
+    from the model cache afterwards.
+    """
+    if not cache_dir:
+        build_calibration_set(path, model_path, ds, num_samples, max_seq_len,
+                              seed)
+        return CalibrationSet(path)
+
+    from model_storage import library_versions, memoize_step
+
+    memoize_step('calibration_set', path,
+                 lambda entry_path: build_calibration_set(
+                     entry_path, model_path, ds, num_samples, max_seq_len,
+                     seed),
+                 cache_dir, tokenizer=tokenizer_hash(model_path), dataset=ds,
+                 sampling=SAMPLING, formatting=FORMATTING, seed=seed,
+                 num_samples=num_samples, max_seq_len=max_seq_len,
+                 versions=library_versions('transformers', 'tokenizers',
+                                           'datasets'))
+    return CalibrationSet(path)
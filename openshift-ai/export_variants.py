@@ -0,0 +1,234 @@
+"""Sequence length and batch size variants of an exported LLM.
+
+The export step used to compile the model for a single shape, 1024 tokens
+and one sequence per batch, so short prompts paid for the whole 1024 token
+KV cache. The exported ONNX graph does not fix its shape though: DeepSparse
+sets the sequence length and batch size of the graph when it compiles its
+engines. A variant is one of those shapes, and one export serves them all,
+without copying the weights. The export step lists them in a manifest next
+to the model, deployment/variants.json:
+
+    {"task": "text_generation",
+     "variants": [{"name": "seq256-bs1", "sequence_length": 256,
+                   "batch_size": 1}, ...]}
+
+The serving runtime starts the server through the serve command, which
+writes a DeepSparse server config with an endpoint per variant and starts
+the command after --:
+
+    python /export_variants.py serve /mnt/models-aux /tmp/server-config.yaml \\
+        -- deepsparse.server --integration openai \\
+        --config-file /tmp/server-config.yaml
+
+The OpenAI server of DeepSparse keys its models by their path, so with more
+than one variant each gets a folder of its own, variants/<name> in the model
+folder, linking the weights, and the model id clients ask for is that path.
+The server does not pick the variant itself: clients send every request to
+the smallest model it fits in, with select_model and the model ids of
+/v1/models (see request.py), or the select command. Every variant is an
+engine of its own, compiled on start and kept in memory, so list the shapes
+the traffic needs, not every possible one.
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+
+MANIFEST = 'variants.json'
+TASK = 'text_generation'
+# Folder of the model folder with a folder per variant
+VARIANTS_DIR = 'variants'
+# Copied to the variant folders, which DeepSparse may rewrite, the rest linked
+COPY_MAX_MB = 64
+
+
+def parse_sizes(value, name='sizes'):
+    """The sorted, unique positive ints of a JSON list (or single int)."""
+    sizes = json.loads(value) if isinstance(value, str) else value
+    if isinstance(sizes, int):
+        sizes = [sizes]
+    if (not isinstance(sizes, list) or not sizes
+            or not all(isinstance(size, int) and size > 0 for size in sizes)):
+        raise ValueError(f'{name} must be a JSON list of positive ints, '
+                         f'got {value!r}')
+    return sorted(set(sizes))
+
+
+def variant_name(sequence_length, batch_size):
+    return f'seq{sequence_length}-bs{batch_size}'
+
+
+def parse_variant_name(name):
+    """The (sequence_length, batch_size) of a variant name or model id."""
+    match = re.search(r'seq(\d+)-bs(\d+)/?$', name)
+    if not match:
+        raise ValueError(f'{name} is not a variant name')
+    return int(match.group(1)), int(match.group(2))
+
+
+def write_manifest(deployment_dir, sequence_lengths, batch_sizes, task=TASK):
+    """Write the manifest of the variants of the model in deployment_dir.
+
+    A variant for every sequence length and batch size, smallest first.
+    Returns the manifest.
+    """
+    manifest = {'task': task, 'variants': [
+        {'name': variant_name(sequence_length, batch_size),
+         'sequence_length': sequence_length, 'batch_size': batch_size}
+        for sequence_length in parse_sizes(sequence_lengths,
+                                           'sequence_lengths')
+        for batch_size in parse_sizes(batch_sizes, 'batch_sizes')]}
+    path = os.path.join(deployment_dir, MANIFEST)
+    # Replaced rather than rewritten, the deployment files may be links to
+    # the model cache
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+    return manifest
+
+
+def load_manifest(deployment_dir):
+    with open(os.path.join(deployment_dir, MANIFEST)) as f:
+        return json.load(f)
+
+
+def select_variant(manifest, tokens, batch_size=1):
+    """The smallest variant for batch_size requests of up to tokens tokens.
+
+    tokens is the prompt plus the completion. The shortest sequence length
+    they fit in, with the smallest batch size of at least batch_size, the
+    largest variant when none is big enough.
+    """
+    variants = manifest['variants']
+    fitting = [variant for variant in variants
+               if variant['sequence_length'] >= tokens
+               and variant['batch_size'] >= batch_size]
+    if not fitting:
+        return max(variants, key=lambda variant: (variant['sequence_length'],
+                                                  variant['batch_size']))
+    return min(fitting, key=lambda variant: (variant['sequence_length'],
+                                             variant['batch_size']))
+
+
+def select_model(model_ids, tokens, batch_size=1):
+    """The model id of the server to send the request to, see select_variant.
+
+    model_ids are the ids of /v1/models; the first one when the server does
+    not serve variants.
+    """
+    variants = []
+    for model_id in model_ids:
+        try:
+            sequence_length, size = parse_variant_name(model_id)
+        except ValueError:
+            continue
+        variants.append({'name': model_id, 'sequence_length': sequence_length,
+                         'batch_size': size})
+    if not variants:
+        return model_ids[0]
+    return select_variant({'variants': variants}, tokens, batch_size)['name']
+
+
+def variant_dir(model_dir, variant):
+    return os.path.join(model_dir, VARIANTS_DIR, variant['name'])
+
+
+def link_variants(model_dir, manifest, copy_max_mb=COPY_MAX_MB):
+    """Give every variant a folder of its own viewing the model of model_dir.
+
+    The small files, which DeepSparse may rewrite, are copied, the others
+    hard linked (symlinked across filesystems), and the folders symlinked.
+    """
+    files = [file for file in os.listdir(model_dir) if file != VARIANTS_DIR]
+    for variant in manifest['variants']:
+        target = variant_dir(model_dir, variant)
+        # From scratch, a restarted container keeps the folder
+        shutil.rmtree(target, ignore_errors=True)
+        os.makedirs(target)
+        for file in files:
+            src = os.path.join(model_dir, file)
+            dst = os.path.join(target, file)
+            if os.path.isdir(src):
+                os.symlink(os.path.realpath(src), dst)
+                continue
+            if os.path.getsize(src) <= copy_max_mb * 2**20:
+                shutil.copy2(src, dst)
+                continue
+            try:
+                os.link(src, dst)
+            except OSError:
+                os.symlink(os.path.realpath(src), dst)
+
+
+def server_config(manifest, model_dir):
+    """DeepSparse server config serving every variant of the model.
+
+    A single variant is served from model_dir itself, the others from the
+    folders of link_variants.
+    """
+    variants = manifest['variants']
+    return {'endpoints': [
+        {'name': variant['name'], 'task': manifest['task'],
+         'model': (variant_dir(model_dir, variant) if len(variants) > 1
+                   else model_dir),
+         'batch_size': variant['batch_size'],
+         'kwargs': {'sequence_length': variant['sequence_length']}}
+        for variant in variants]}
+
+
+def serve(model_dir, config_path):
+    """Write the server config of the model of model_dir to config_path.
+
+    Models exported without a manifest get the single endpoint of the
+    image config, with the shapes DeepSparse defaults to.
+    """
+    if os.path.exists(os.path.join(model_dir, MANIFEST)):
+        manifest = load_manifest(model_dir)
+        if len(manifest['variants']) > 1:
+            link_variants(model_dir, manifest)
+        config = server_config(manifest, model_dir)
+    else:
+        config = {'endpoints': [{'task': TASK, 'model': model_dir}]}
+    # JSON is valid YAML, the server reads either
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent=2)
+    for endpoint in config['endpoints']:
+        print(f"Serving {endpoint['model']}", flush=True)
+
+
+def main():
+    # Everything after -- is the command to start once the config is written
+    argv = sys.argv[1:]
+    command = []
+    if '--' in argv:
+        command = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    config = commands.add_parser(
+        'serve', help='write the DeepSparse server config, then start the '
+                      'command after --')
+    config.add_argument('model_dir', help='deployment folder served')
+    config.add_argument('config', help='server config file to write')
+    select = commands.add_parser(
+        'select', help='print the name of the variant for a request')
+    select.add_argument('model_dir', help='deployment folder served')
+    select.add_argument('tokens', type=int,
+                        help='prompt plus completion tokens')
+    select.add_argument('--batch-size', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        serve(args.model_dir, args.config)
+        if command:
+            os.execvp(command[0], command)
+    else:
+        manifest = load_manifest(args.model_dir)
+        print(select_variant(manifest, args.tokens, args.batch_size)['name'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""Repack GPTQ quantized layers into the Marlin layout in memory.
+
+AutoGPTQ only converts a GPTQ checkpoint to Marlin while loading it, so the
+GPU quantization step used to save the GPTQ model, load it back with
+use_marlin=True and save it again. convert_to_marlin swaps the layers of
+the freshly quantized model instead, repacking their int4 weights with the
+same layout the autogptq_marlin_cuda.gptq_repack kernel produces:
+
+    model.quantize(examples)
+    save_marlin(model, quantize_config, output_dir)
+
+The repacking is plain torch, so it runs on any device, CPU included, and
+saves bit for bit the model of the two steps conversion, see
+tests/test_gptq_marlin.py. It relies on private helpers of auto-gptq 0.7.1,
+the version the GPU quantization step installs; save_marlin falls back to
+the two steps with an auto-gptq that lacks them. This module is baked into
+the storage image, see storage_Dockerfile.
+"""
+import shutil
+
+import torch
+
+try:
+    from auto_gptq.nn_modules.qlinear.qlinear_marlin import _get_perms
+except ImportError:
+    _get_perms = None
+
+# Marlin stores the weights in 16x16 tiles, shuffled for its kernel
+TILE = 16
+REPACK_AVAILABLE = _get_perms is not None
+if REPACK_AVAILABLE:
+    _PERM, _SCALE_PERM, _SCALE_PERM_SINGLE = _get_perms()
+
+
+def unpack_gptq_weight(qweight):
+    """The (infeatures, outfeatures) int4 values of a GPTQ packed qweight.
+
+    GPTQ packs 8 consecutive input rows in every int32, the first one in the
+    lowest bits.
+    """
+    shifts = torch.arange(0, 32, 4, dtype=torch.int32, device=qweight.device)
+    weight = (qweight.unsqueeze(1) >> shifts.view(1, -1, 1)) & 0xF
+    return weight.reshape(-1, qweight.shape[1])
+
+
+def repack_weight(qweight):
+    """The Marlin B tensor of a GPTQ packed qweight, as gptq_repack has it."""
+    weight = unpack_gptq_weight(qweight).to(torch.int64)
+    infeatures, outfeatures = weight.shape
+    weight = weight.reshape(infeatures // TILE, TILE, outfeatures // TILE, TILE)
+    weight = weight.permute(0, 2, 1, 3).reshape(infeatures // TILE,
+                                                outfeatures * TILE)
+    weight = weight.reshape(-1, _PERM.numel())[:, _PERM.to(weight.device)]
+    weight = weight.reshape(infeatures // TILE, outfeatures * TILE)
+    packed = torch.zeros((weight.shape[0], weight.shape[1] // 8),
+                         dtype=torch.int64, device=weight.device)
+    for i in range(8):
+        packed |= weight[:, i::8] << 4 * i
+    # Back to the int32 the kernel takes, wrapping the top bit
+    return torch.where(packed >= 2 ** 31, packed - 2 ** 32,
+                       packed).to(torch.int32)
+
+
+def repack_scales(scales, group_size, infeatures):
+    """The Marlin s tensor of the (groups, outfeatures) GPTQ scales."""
+    outfeatures = scales.shape[1]
+    scales = scales.clone()
+    if group_size != infeatures:
+        scales = scales.reshape(-1, len(_SCALE_PERM))[:, _SCALE_PERM]
+    else:
+        scales = scales.reshape(-1, len(_SCALE_PERM_SINGLE))[
+            :, _SCALE_PERM_SINGLE]
+    return scales.reshape(-1, outfeatures).contiguous()
+
+
+def marlin_incompatibility(quantize_config):
+    """Why the Marlin kernels can not run a GPTQ config, None if they can."""
+    if quantize_config.bits != 4:
+        return f'{quantize_config.bits} bits weights, not 4'
+    if quantize_config.group_size not in (128, -1):
+        return f'group size {quantize_config.group_size}, not 128 or -1'
+    if not quantize_config.sym:
+        return 'asymmetric quantization'
+    if quantize_config.desc_act:
+        return 'act-order (desc_act)'
+    return None
+
+
+@torch.no_grad()
+def convert_to_marlin(model, quantize_config):
+    """Replace the GPTQ layers of a quantized model with Marlin ones.
+
+    Mirrors auto_gptq.utils.marlin_utils.convert_to_marlin, minus the CUDA
+    repacking, and flags the config as Marlin serialized so the saved model
+    loads straight into the Marlin kernels.
+    """
+    from auto_gptq.nn_modules.qlinear.qlinear_marlin import (
+        QuantLinear as MarlinQuantLinear
+    )
+
+    reason = marlin_incompatibility(quantize_config)
+    if reason is not None:
+        raise ValueError(f'The model can not be converted to Marlin: {reason}')
+
+    layers = [(name, module) for name, module in model.named_modules()
+              if hasattr(module, 'qweight') and hasattr(module, 'qzeros')]
+    for name, module in layers:
+        parent_name, _, layer_name = name.rpartition('.')
+        device = module.qweight.device
+        with torch.device('meta'):
+            marlin = MarlinQuantLinear(bits=4, group_size=module.group_size,
+                                       infeatures=module.infeatures,
+                                       outfeatures=module.outfeatures,
+                                       bias=module.bias is not None,
+                                       trainable=False)
+        marlin.workspace = torch.zeros(module.outfeatures // 128 * 16,
+                                       dtype=torch.int, device=device)
+        marlin.B = repack_weight(module.qweight)
+        marlin.s = repack_scales(module.scales.data, module.group_size,
+                                 module.infeatures)
+        marlin.bias = module.bias
+        setattr(model.get_submodule(parent_name), layer_name,
+                marlin.to(device))
+        del module
+
+    quantize_config.is_marlin_format = True
+    print(f'Repacked {len(layers)} layers to the Marlin format')
+    return model
+
+
+def save_marlin(model, quantize_config, output_dir):
+    """Save an AutoGPTQ quantized model to output_dir in the Marlin format.
+
+    Repacked in memory when REPACK_AVAILABLE, otherwise the GPTQ model is
+    saved next to output_dir and loaded back with use_marlin, which needs
+    the Marlin CUDA kernels.
+    """
+    if REPACK_AVAILABLE:
+        convert_to_marlin(model.model, quantize_config)
+        model.save_pretrained(output_dir)
+        return
+
+    from auto_gptq import AutoGPTQForCausalLM
+
+    gptq_dir = output_dir.rstrip('/') + '-gptq'
+    print(f'Saving the GPTQ model to {gptq_dir} and reloading it as Marlin')
+    model.save_pretrained(gptq_dir)
+    marlin_model = AutoGPTQForCausalLM.from_quantized(
+        gptq_dir, use_marlin=True, device_map='auto')
+    marlin_model.save_pretrained(output_dir)
+    shutil.rmtree(gptq_dir)
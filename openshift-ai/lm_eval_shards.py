@@ -0,0 +1,259 @@
+"""Run an lm-evaluation-harness command over a shard of the documents.
+
+The eval steps can fan out over several workers, each evaluating every
+num_shards-th document of every task, and a merge step combines the
+per-shard scores weighted by the number of documents each shard evaluated.
+This module is baked into the eval images (see the *eval_Dockerfile files)
+and wraps the very same command the steps run unsharded:
+
+    python -m lm_eval_shards --shard 0 --num-shards 4 \\
+        --results /mnt/models/eval/llm/shard-0.json -- \\
+        lm_eval --model hf --model_args pretrained=/mnt/models/llm ...
+
+It works with both harness generations the images carry, as both build the
+tasks with lm_eval.tasks.get_task_dict and run them with
+lm_eval.evaluator.simple_evaluate.
+
+Metrics averaged over the documents, as accuracies are, merge exactly, and
+so do their stderr and the groups, rebuilt from their merged subtasks; the
+corpus level ones (perplexity, BLEU, F1, ...) are merged as the document
+weighted average of the shard scores, and flagged as approximate.
+"""
+import argparse
+import json
+import math
+import os
+import re
+import runpy
+import sys
+
+
+def _shard_docs(docs, shard, num_shards, limit=0):
+    # The harness --limit, a count or a fraction of the docs, applies to the
+    # whole task, so it is taken before sharding
+    size = len(docs)
+    if limit:
+        size = min(size, int(math.ceil(size * limit) if limit < 1.0
+                             else limit))
+    if hasattr(docs, 'select'):
+        # HF datasets keep their type, tasks may rely on it
+        return docs.select(range(shard, size, num_shards))
+    return list(docs)[shard:size:num_shards]
+
+
+def _shard_tasks(task_dict, shard, num_shards, counts, aggregations,
+                 limit=0):
+    """Restrict every task to its shard of the docs, counting them per task."""
+    total = 0
+    for name, task in task_dict.items():
+        if isinstance(task, tuple):
+            # (group name, task) in the 0.4.1 harness
+            task = task[-1]
+        if isinstance(task, dict):
+            count = _shard_tasks(task, shard, num_shards, counts,
+                                 aggregations, limit)
+        elif task is None:
+            continue
+        else:
+            for split in ('test_docs', 'validation_docs'):
+                if getattr(task, 'has_' + split)():
+                    docs = _shard_docs(getattr(task, split)(), shard,
+                                       num_shards, limit)
+                    setattr(task, split, lambda docs=docs: docs)
+                    count = len(docs)
+                    break
+            else:
+                continue
+            aggregations[getattr(name, 'group_name', name)] = {
+                metric: getattr(function, '__name__', str(function))
+                for metric, function in task.aggregation().items()}
+        counts[getattr(name, 'group_name', name)] = count
+        total += count
+    return total
+
+
+def run_shard(command, shard, num_shards, results_path, limit=0):
+    """Run the lm_eval command in process, over a shard of every task.
+
+    limit replaces the --limit of the command, see _shard_docs.
+    """
+    import lm_eval.evaluator
+    import lm_eval.tasks
+
+    # Never leave the results of an earlier run behind for the merge step
+    if os.path.exists(results_path):
+        os.remove(results_path)
+
+    counts = {}
+    aggregations = {}
+    outputs = {}
+    get_task_dict = lm_eval.tasks.get_task_dict
+    simple_evaluate = lm_eval.evaluator.simple_evaluate
+
+    def sharded_get_task_dict(*args, **kwargs):
+        task_dict = get_task_dict(*args, **kwargs)
+        _shard_tasks(task_dict, shard, num_shards, counts, aggregations,
+                     limit)
+        return task_dict
+
+    def recording_simple_evaluate(*args, **kwargs):
+        outputs['results'] = simple_evaluate(*args, **kwargs)
+        return outputs['results']
+
+    lm_eval.tasks.get_task_dict = sharded_get_task_dict
+    if hasattr(lm_eval.evaluator, 'get_task_dict'):
+        lm_eval.evaluator.get_task_dict = sharded_get_task_dict
+    lm_eval.evaluator.simple_evaluate = recording_simple_evaluate
+
+    if command[0] == 'lm_eval':
+        sys.argv = command
+        runpy.run_module('lm_eval', run_name='__main__', alter_sys=True)
+    elif command[0].startswith('python'):
+        sys.argv = command[1:]
+        runpy.run_path(command[1], run_name='__main__')
+    else:
+        raise ValueError(f'Unsupported eval command {command[0]}')
+
+    results = outputs.get('results')
+    if results is None:
+        raise RuntimeError('The eval command did not produce any results')
+    os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    with open(results_path + '.tmp', 'w') as f:
+        json.dump({'shard': shard, 'num_shards': num_shards,
+                   'counts': counts, 'aggregations': aggregations,
+                   'results': results['results'],
+                   'group_subtasks': results.get('group_subtasks', {})},
+                  f, indent=2, default=str)
+    os.replace(results_path + '.tmp', results_path)
+
+
+def _pooled_stderr(weights, means, stderrs):
+    """Stderr of the mean over the union of the shards, as the harness has it.
+
+    The harness reports the sample stdev over sqrt(n), so each shard gives
+    back its sum of squares, and the spread between the shard means is added.
+    """
+    total = sum(weights)
+    mean = sum(w * m for w, m in zip(weights, means)) / total
+    squares = sum(se ** 2 * w * (w - 1) + w * (m - mean) ** 2
+                  for w, m, se in zip(weights, means, stderrs))
+    return math.sqrt(squares / max(total - 1, 1) / total)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def merge_shards(shard_results):
+    """Combine the per-shard results into the scores of the whole tasks."""
+    merged = {'num_shards': len(shard_results), 'results': {},
+              'counts': {}, 'approximate': []}
+    group_subtasks = {}
+    for shard in shard_results:
+        for group, subtasks in shard.get('group_subtasks', {}).items():
+            if subtasks:
+                group_subtasks[group] = subtasks
+    tasks = sorted({task for shard in shard_results
+                    for task in shard['results']} - set(group_subtasks))
+
+    for task in tasks:
+        shards = [shard for shard in shard_results if task in shard['results']]
+        # Shards are interleaved, so they hold about the same number of docs
+        # when a result has no count
+        weights = [shard['counts'].get(task, 1) for shard in shards]
+        merged['counts'][task] = sum(weights)
+        aggregations = shards[0].get('aggregations', {}).get(task, {})
+        results = [shard['results'][task] for shard in shards]
+        values = {}
+        for key in results[0]:
+            metric, _, filter_name = key.partition(',')
+            samples = [result.get(key) for result in results]
+            if not all(_is_number(sample) for sample in samples):
+                values[key] = samples[0]
+                continue
+            exact = aggregations.get(metric.rsplit('_stderr', 1)[0],
+                                     'mean') == 'mean'
+            # name,filter in the 0.4 harness, name alone in the legacy one
+            mean_key = metric[:-len('_stderr')] + (',' + filter_name
+                                                   if filter_name else '')
+            if metric.endswith('_stderr') and exact and all(
+                    _is_number(result.get(mean_key)) for result in results):
+                values[key] = _pooled_stderr(
+                    weights, [result[mean_key] for result in results], samples)
+            elif metric.endswith('_stderr'):
+                values[key] = math.sqrt(sum(
+                    (weight / sum(weights)) ** 2 * sample ** 2
+                    for weight, sample in zip(weights, samples)))
+            else:
+                values[key] = sum(weight * sample for weight, sample
+                                  in zip(weights, samples)) / sum(weights)
+            if not exact:
+                merged['approximate'].append(f'{task}/{key}')
+        merged['results'][task] = values
+
+    # Groups average their subtasks by size, so they are rebuilt from the
+    # merged subtasks, the inner groups first
+    pending = dict(group_subtasks)
+    while pending:
+        ready = [group for group, subtasks in pending.items()
+                 if all(subtask in merged['counts'] for subtask in subtasks)]
+        if not ready:
+            raise ValueError(f'Could not resolve the groups {sorted(pending)}')
+        for group in ready:
+            subtasks = pending.pop(group)
+            weights = [merged['counts'][subtask] for subtask in subtasks]
+            results = [merged['results'][subtask] for subtask in subtasks]
+            merged['counts'][group] = sum(weights)
+            values = {}
+            for key in set.intersection(*(set(result) for result in results)):
+                samples = [result[key] for result in results]
+                if not all(_is_number(sample) for sample in samples):
+                    continue
+                if key.split(',')[0].endswith('_stderr'):
+                    # Pooled variance of the subtasks, as the harness does
+                    values[key] = math.sqrt(sum(
+                        (weight - 1) * sample ** 2 * weight
+                        for weight, sample in zip(weights, samples))
+                        / max(sum(weights) - len(weights), 1) / sum(weights))
+                else:
+                    values[key] = sum(weight * sample for weight, sample
+                                      in zip(weights, samples)) / sum(weights)
+                if any(f'{subtask}/{key}' in merged['approximate']
+                       for subtask in subtasks):
+                    merged['approximate'].append(f'{group}/{key}')
+            merged['results'][group] = dict(sorted(values.items()))
+    return merged
+
+
+def kfp_metrics(merged):
+    """The merged scores, without their stderr, as KFP run metrics."""
+    metrics = []
+    for task, values in merged['results'].items():
+        for key, value in values.items():
+            if isinstance(value, float) and '_stderr' not in key:
+                name = re.sub(r'[^a-z0-9]+', '-',
+                              f"{task}-{key.replace(',none', '')}".lower())
+                metrics.append({'name': name.strip('-')[:63],
+                                'numberValue': value, 'format': 'RAW'})
+    return {'metrics': metrics}
+
+
+def main():
+    argv = sys.argv[1:]
+    if '--' not in argv:
+        sys.exit('usage: python -m lm_eval_shards [options] -- command ...')
+    command = argv[argv.index('--') + 1:]
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shard', type=int, required=True)
+    parser.add_argument('--num-shards', type=int, required=True)
+    parser.add_argument('--results', required=True,
+                        help='JSON file to write the shard results to')
+    parser.add_argument('--limit', type=float, default=0,
+                        help='docs of every task to evaluate over all the '
+                             'shards, or their fraction if below 1')
+    args = parser.parse_args(argv[:argv.index('--')])
+    run_shard(command, args.shard, args.num_shards, args.results, args.limit)
+
+
+if __name__ == '__main__':
+    main()
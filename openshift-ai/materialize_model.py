@@ -0,0 +1,82 @@
+"""Build a writable view of a read only model folder and start a command.
+
+DeepSparse writes next to the model it serves, but KServe mounts the model
+read only, so the serving runtime used to copy the whole model into an
+emptyDir on every pod start. This links every file into the writable folder
+instead, and only copies the small ones DeepSparse may rewrite (the ONNX
+graph, configs and tokenizer files), leaving the weights where they are:
+
+    python /materialize_model.py /mnt/models/deployment /mnt/models-aux -- \\
+        deepsparse.server --integration openai --config-file /server-config.yaml
+
+Files are hard linked when both folders share a filesystem and symlinked
+otherwise. The command replaces this process, so it gets the pod signals.
+"""
+import argparse
+import fnmatch
+import os
+import shutil
+import sys
+import time
+
+
+def materialize(source, target, copy_patterns, copy_max_mb):
+    """Mirror source into target, returning (linked, copied) byte counts."""
+    linked = copied = 0
+    for root, dirs, files in os.walk(source):
+        target_root = os.path.join(target, os.path.relpath(root, source))
+        os.makedirs(target_root, exist_ok=True)
+        for file in files:
+            src = os.path.join(root, file)
+            dst = os.path.join(target_root, file)
+            size = os.path.getsize(src)
+            if os.path.lexists(dst):
+                os.remove(dst)
+            if (size <= copy_max_mb * 2**20
+                    or any(fnmatch.fnmatch(file, pattern)
+                           for pattern in copy_patterns)):
+                shutil.copy2(src, dst)
+                copied += size
+                continue
+            try:
+                os.link(src, dst)
+            except OSError:
+                os.symlink(os.path.realpath(src), dst)
+            linked += size
+    return linked, copied
+
+
+def main():
+    # Everything after -- is the command to start once the folder is ready
+    argv = sys.argv[1:]
+    command = []
+    if '--' in argv:
+        command = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        usage='%(prog)s [options] source target [-- command ...]')
+    parser.add_argument('source', help='read only model folder')
+    parser.add_argument('target', help='writable folder the server loads')
+    parser.add_argument('--copy', action='append', default=[],
+                        metavar='PATTERN',
+                        help='also copy the files matching this glob, '
+                             'whatever their size (repeatable)')
+    parser.add_argument('--copy-max-mb', type=float, default=64,
+                        help='copy the files up to this size, link the rest')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    linked, copied = materialize(args.source, args.target, args.copy,
+                                 args.copy_max_mb)
+    print(f'Materialized {args.source} into {args.target} in '
+          f'{time.perf_counter() - start:.1f}s: {linked / 2**20:.1f} MiB '
+          f'linked, {copied / 2**20:.1f} MiB copied', flush=True)
+
+    if command:
+        os.execvp(command[0], command)
+
+
+if __name__ == '__main__':
+    main()
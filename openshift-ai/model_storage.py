@@ -0,0 +1,1249 @@
+"""Model storage layer shared by the pipeline components.
+
+The components run as lightweight KFP components, which only carry the
+source of their own function, so this module is baked into the storage
+image (see storage_Dockerfile) and imported from inside the components.
+
+It provides a pooled S3 client configured from the data connection env vars,
+resumable and checksummed transfers of whole model folders, the model cache
+on the shared volume, which also memoizes the outputs of the compression
+steps, and the I/O counters emitted as pipeline metrics.
+
+Model folders are stored either as plain files, the layout the serving
+runtimes read, or packed: every file concatenated and cut in zstd compressed
+chunks, stored as a single <name>/model.pack object next to an index that
+gives the offset of every chunk and file, so many small files cost a single
+request and chunks are fetched and decompressed in parallel.
+
+Uploads overwrite the objects of a model folder in place, so a
+<name>.uploading object flags the folder from the first write until the new
+manifest or index is committed, and downloads refuse the folder meanwhile.
+The serving runtimes read the folder without looking at it, so only roll
+them out once the upload step is done.
+"""
+import os
+import json
+import time
+import base64
+import fcntl
+import fnmatch
+import shutil
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+PACK_NAME = 'model.pack'
+# Object next to a model folder while it is being uploaded
+UPLOADING_SUFFIX = '.uploading'
+
+# Weight formats of a HF model repo, in the order transformers prefers them
+HF_WEIGHT_PATTERNS = (('*.safetensors', '*.safetensors.index.json'),
+                      ('*.bin', '*.bin.index.json'))
+# The single file and the shard index transformers loads of each format
+HF_WEIGHT_NAMES = (('model.safetensors', 'model.safetensors.index.json'),
+                   ('pytorch_model.bin', 'pytorch_model.bin.index.json'))
+# Files needed next to the weights to load the model and its tokenizer
+HF_SUPPORT_PATTERNS = ('*.json', '*.txt', '*.model', '*.tiktoken', '*.py')
+# Download metadata huggingface_hub keeps in the local_dir it downloads into
+HF_METADATA_DIR = '.cache'
+
+
+def file_part_hashes(path, part_size):
+    hashes = []
+    with open(path, 'rb') as f:
+        for part in iter(lambda: f.read(part_size), b''):
+            hashes.append(hashlib.sha256(part).hexdigest())
+    return hashes
+
+
+def save_json(path, data):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+
+class StorageMetrics:
+    """Per-operation latency and byte counters, safe to update from threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self.calls = {}
+        self.bytes = {'downloaded': 0, 'uploaded': 0, 'skipped': 0}
+
+    def record_call(self, operation, seconds):
+        with self._lock:
+            count, total = self.calls.get(operation, (0, 0.0))
+            self.calls[operation] = (count + 1, total + seconds)
+
+    def add_bytes(self, kind, size):
+        with self._lock:
+            self.bytes[kind] += size
+
+    def to_kfp_metrics(self):
+        elapsed = time.perf_counter() - self._start
+        metrics = [{'name': 'elapsed-seconds', 'numberValue': elapsed}]
+        for kind, size in self.bytes.items():
+            metrics.append({'name': f'mib-{kind}', 'numberValue': size / 2**20})
+        moved = self.bytes['downloaded'] + self.bytes['uploaded']
+        metrics.append({'name': 'mib-per-second',
+                        'numberValue': moved / 2**20 / max(elapsed, 1e-6)})
+        for operation, (count, total) in sorted(self.calls.items()):
+            name = ''.join('-' + c.lower() if c.isupper() else c
+                           for c in operation).lstrip('-')
+            metrics.append({'name': f's3-{name}-calls', 'numberValue': count})
+            metrics.append({'name': f's3-{name}-avg-ms',
+                            'numberValue': total / count * 1000})
+        return {'metrics': [dict(metric, format='RAW') for metric in metrics]}
+
+    def write(self, path):
+        """Write the counters as the KFP mlpipeline-metrics artifact."""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.to_kfp_metrics(), f)
+
+
+class ModelStorage:
+    """S3 access for whole model folders.
+
+    The connection pool is sized so that every file worker can run all of
+    its part transfers at once, connections are kept alive between requests
+    and throttled or failed requests are retried with adaptive backoff.
+    """
+
+    def __init__(self, max_concurrency=10, file_concurrency=4,
+                 multipart_chunksize_mb=64, metrics=None):
+        from boto3 import client
+        from botocore.config import Config
+
+        self.endpoint_url = os.environ["s3_host"]
+        self.bucket_name = os.environ["s3_bucket"]
+        self.max_concurrency = max_concurrency
+        self.file_concurrency = file_concurrency
+        # Files bigger than one part are split and their parts sent in parallel
+        self.part_size = multipart_chunksize_mb * 1024 * 1024
+        self.metrics = metrics or StorageMetrics()
+
+        self.client = client(
+            's3', endpoint_url=self.endpoint_url,
+            aws_access_key_id=os.environ["s3_access_key"],
+            aws_secret_access_key=os.environ["s3_secret_access_key"],
+            verify=False,
+            config=Config(
+                max_pool_connections=file_concurrency * max_concurrency,
+                tcp_keepalive=True,
+                retries={'max_attempts': 10, 'mode': 'adaptive'})
+        )
+
+        # Time every API call, retries included
+        local = threading.local()
+
+        def before_call(**kwargs):
+            local.start = time.perf_counter()
+
+        def after_call(model, **kwargs):
+            self.metrics.record_call(model.name,
+                                     time.perf_counter() - local.start)
+
+        self.client.meta.events.register('before-call.s3', before_call)
+        self.client.meta.events.register('after-call.s3', after_call)
+
+    def get_manifest(self, name):
+        # The manifest lists size and part hashes of every file of a model
+        # folder, to verify the downloads and skip unchanged files
+        try:
+            return json.loads(self.client.get_object(
+                Bucket=self.bucket_name,
+                Key=name.rstrip('/') + '.manifest.json')['Body'].read())
+        except self.client.exceptions.NoSuchKey:
+            return None
+
+    def is_uploading(self, name):
+        """Whether an upload of the model folder `name` is in progress."""
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.head_object(Bucket=self.bucket_name,
+                                    Key=name.rstrip('/') + UPLOADING_SUFFIX)
+            return True
+        except ClientError as error:
+            # Only a missing flag means no upload, denied or throttled
+            # requests say nothing about it
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey',
+                                                   'NotFound'):
+                return False
+            raise
+
+    def _begin(self, name):
+        # Objects are overwritten in place, so until the new manifest is
+        # committed the folder mixes files of both models: flag it for the
+        # readers before the first write, a failed upload leaves it flagged
+        self.client.put_object(Bucket=self.bucket_name,
+                               Key=name.rstrip('/') + UPLOADING_SUFFIX,
+                               Body=b'')
+
+    def list_objects(self, prefix):
+        # list all objects in the folder, page by page, as a single
+        # list_objects call stops at 1000 keys
+        objects = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for object in page.get('Contents', []):
+                # Skip the "folder" placeholder objects
+                if not object['Key'].endswith('/'):
+                    objects.append(object)
+        return objects
+
+    def revision(self, name):
+        """Return an identifier that changes whenever the model folder does."""
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client.head_object(
+                Bucket=self.bucket_name,
+                Key=name.rstrip('/') + '.manifest.json')['ETag'].strip('"')
+        except ClientError:
+            return hashlib.sha256(json.dumps(sorted(
+                (object['Key'], object['ETag'])
+                for object in self.list_objects(name.rstrip('/') + '/')
+            )).encode()).hexdigest()
+
+    def download(self, name, local_path, sync=True):
+        """Download the model folder `name` of the bucket into local_path."""
+        print(f'Starting downloading {name} from bucket {self.bucket_name}')
+        prefix = name.rstrip('/') + '/'
+        if self.is_uploading(name):
+            raise RuntimeError(f'{name} is being uploaded, or its last upload '
+                               f'failed, in bucket {self.bucket_name}')
+
+        manifest = self.get_manifest(name)
+        if manifest is None:
+            try:
+                index = json.loads(self.client.get_object(
+                    Bucket=self.bucket_name,
+                    Key=prefix + PACK_NAME + '.json')['Body'].read())
+            except self.client.exceptions.NoSuchKey:
+                index = None
+            if index is not None:
+                return self._download_packed(name, local_path, index, sync)
+            print(f'No manifest found for {name}, downloading every file and '
+                  'checking it against its ETag')
+
+        downloads = []
+        etags = {}
+        if manifest is not None:
+            for path, entry in manifest['files'].items():
+                downloads.append((prefix + path,
+                                  os.path.join(local_path, path),
+                                  entry['size']))
+        else:
+            for object in self.list_objects(prefix):
+                file_name = object['Key']
+                local_file_name = os.path.join(local_path,
+                                               file_name[len(prefix):])
+                downloads.append((file_name, local_file_name, object['Size']))
+                etags[file_name] = object['ETag'].strip('"')
+
+        if not downloads:
+            raise RuntimeError(f'No objects found under {prefix} in bucket '
+                               f'{self.bucket_name}')
+
+        bytes_skipped = 0
+        if sync and manifest is not None:
+            # Drop the files left behind by a previous model, and keep only
+            # the ones whose size and hashes differ from the manifest
+            for root, dirs, files in os.walk(local_path):
+                for file in files:
+                    local_file_name = os.path.join(root, file)
+                    path = os.path.relpath(local_file_name, local_path)
+                    if path not in manifest['files']:
+                        os.remove(local_file_name)
+
+            def is_up_to_date(download):
+                file_name, local_file_name, size = download
+                entry = manifest['files'][file_name[len(prefix):]]
+                return (os.path.isfile(local_file_name)
+                        and os.path.getsize(local_file_name) == size
+                        and file_part_hashes(local_file_name, entry['part_size'])
+                        == entry['parts'])
+
+            with ThreadPoolExecutor(max_workers=self.file_concurrency) as executor:
+                up_to_date = list(executor.map(is_up_to_date, downloads))
+            bytes_skipped = sum(download[2] for download, skip
+                                in zip(downloads, up_to_date) if skip)
+            downloads = [download for download, skip
+                         in zip(downloads, up_to_date) if not skip]
+        self.metrics.add_bytes('skipped', bytes_skipped)
+
+        # Create the whole local tree up front instead of on the fly
+        for local_dir in {os.path.dirname(d[1]) for d in downloads}:
+            os.makedirs(local_dir, exist_ok=True)
+
+        # Start with the biggest shards so they do not end up as the tail
+        downloads.sort(key=lambda download: download[2], reverse=True)
+
+        # Parts are written into <file>.part files under a state folder next
+        # to local_path, on the same volume, together with the list of parts
+        # already completed, so a preempted download resumes where it stopped
+        state_dir = local_path.rstrip('/') + '.download-state'
+
+        def download(file_name, local_file_name, size):
+            path = file_name[len(prefix):]
+            if manifest is not None:
+                entry = manifest['files'][path]
+                part_size, expected, etag = (entry['part_size'],
+                                             entry['parts'], None)
+            else:
+                part_size, etag = self._etag_layout(file_name,
+                                                    etags[file_name], size)
+                expected = None
+            self._download_file(file_name, local_file_name, size, part_size,
+                                expected, os.path.join(state_dir,
+                                                       path + '.part'),
+                                etag)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.file_concurrency) as executor:
+            futures = [executor.submit(download, *download_args)
+                       for download_args in downloads]
+            # Re-raise the first failed download, if any
+            for future in futures:
+                future.result()
+        elapsed = time.perf_counter() - start
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+        total_size = sum(size for _, _, size in downloads)
+        print(f'Downloaded {len(downloads)} files, '
+              f'{total_size / 2**20:.1f} MiB in {elapsed:.1f}s '
+              f'({total_size / 2**20 / max(elapsed, 1e-6):.1f} MiB/s).')
+        print(f'Bytes moved: {total_size}, bytes skipped: {bytes_skipped}')
+
+    def _etag_layout(self, file_name, etag, size):
+        """The part size to download file_name with, and its ETag to verify.
+
+        The ETag of an object uploaded in one request is the MD5 of its
+        content, and the one of a multipart upload the MD5 of the MD5s of its
+        parts, followed by -<parts>. Downloading it with the parts of the
+        upload, the first one giving their size, lets every part hash while
+        it streams. Objects uploaded in one request are streamed as a single
+        part, for a single MD5. The ETag is None when it is no MD5, as for
+        objects encrypted with KMS or customer keys.
+        """
+        head = self.client.head_object(Bucket=self.bucket_name, Key=file_name,
+                                       PartNumber=1)
+        if (head.get('ServerSideEncryption') == 'aws:kms'
+                or head.get('SSECustomerAlgorithm')):
+            print(f'{file_name} is encrypted with KMS or a customer key, its '
+                  f'ETag is no MD5, checking only its size')
+            return self.part_size, None
+        if '-' not in etag:
+            return max(size, 1), etag
+        part_size = head['ContentLength']
+        if -(-size // part_size) != int(etag.split('-')[1]):
+            print(f'{file_name} was uploaded with parts of different sizes, '
+                  f'checking only its size')
+            return self.part_size, None
+        return part_size, etag
+
+    def _download_file(self, file_name, local_file_name, size, part_size,
+                       expected, part_path, etag=None):
+        start = time.perf_counter()
+        state_path = part_path + '.json'
+        os.makedirs(os.path.dirname(part_path), exist_ok=True)
+
+        state = None
+        if os.path.exists(state_path) and os.path.exists(part_path):
+            with open(state_path) as f:
+                state = json.load(f)
+            # Only resume a download of the very same object
+            if (state['size'], state['part_size'], state['expected'],
+                    state.get('etag')) != (size, part_size, expected, etag):
+                state = None
+        if state is None:
+            state = {'size': size, 'part_size': part_size,
+                     'expected': expected, 'etag': etag, 'parts': {},
+                     'md5s': {}}
+            with open(part_path, 'wb') as f:
+                f.truncate(size)
+            save_json(state_path, state)
+        resumed = len(state['parts'])
+        state_lock = threading.Lock()
+
+        def download_part(index):
+            first = index * part_size
+            last = min(size, first + part_size) - 1
+            body = self.client.get_object(Bucket=self.bucket_name, Key=file_name,
+                                          Range=f'bytes={first}-{last}')['Body']
+            # Hash the part while it streams to disk, instead of reading the
+            # file back once it is complete
+            sha256 = hashlib.sha256()
+            md5 = hashlib.md5()
+            with open(part_path, 'r+b') as f:
+                f.seek(first)
+                for chunk in body.iter_chunks(1024 * 1024):
+                    sha256.update(chunk)
+                    if etag is not None:
+                        md5.update(chunk)
+                    f.write(chunk)
+                if f.tell() != last + 1:
+                    raise RuntimeError(f'Short read for part {index} of '
+                                       f'{file_name}')
+            if expected is not None and sha256.hexdigest() != expected[index]:
+                raise RuntimeError(f'Checksum mismatch for part {index} of '
+                                   f'{file_name}')
+            self.metrics.add_bytes('downloaded', last + 1 - first)
+            with state_lock:
+                state['parts'][str(index)] = sha256.hexdigest()
+                state.setdefault('md5s', {})[str(index)] = md5.hexdigest()
+                save_json(state_path, state)
+
+        num_parts = -(-size // part_size)
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            list(executor.map(download_part,
+                              [index for index in range(num_parts)
+                               if str(index) not in state['parts']]))
+
+        if etag is not None:
+            md5s = [state['md5s'][str(index)] for index in range(num_parts)]
+            if '-' in etag:
+                digest = hashlib.md5(b''.join(
+                    bytes.fromhex(md5) for md5 in md5s)).hexdigest()
+                digest += f'-{num_parts}'
+            else:
+                digest = md5s[0] if md5s else hashlib.md5().hexdigest()
+            if digest != etag:
+                # Start over on the next attempt
+                os.remove(state_path)
+                raise RuntimeError(f'Checksum mismatch for {file_name}: '
+                                   f'ETag {etag}, downloaded {digest}')
+
+        os.replace(part_path, local_file_name)
+        os.remove(state_path)
+        elapsed = time.perf_counter() - start
+        print(f'Downloaded {file_name} ({size / 2**20:.1f} MiB in '
+              f'{elapsed:.1f}s, {size / 2**20 / max(elapsed, 1e-6):.1f} MiB/s'
+              f'{f", resumed after {resumed} parts" if resumed else ""})')
+
+    def upload(self, local_path, name, sync=True, layout='plain',
+               pack_chunk_mb=16):
+        """Upload the model folder local_path as `name` in the bucket.
+
+        layout is either 'plain' or 'packed', see the module docstring.
+        """
+        print(f'Uploading {local_path} to bucket {self.bucket_name} '
+              f'to S3 storage at {self.endpoint_url}')
+        if layout == 'packed':
+            return self._upload_packed(local_path, name,
+                                       pack_chunk_mb * 1024 * 1024)
+
+        # Walk through the local folder and collect the files to upload
+        uploads = []
+        for root, dirs, files in os.walk(local_path):
+            for file in files:
+                local_file_path = os.path.join(root, file)
+                s3_file_path = os.path.join(
+                    name, os.path.relpath(local_file_path, local_path))
+                uploads.append((local_file_path, s3_file_path,
+                                os.path.getsize(local_file_path)))
+
+        remote_manifest = self.get_manifest(name) or {'files': {}}
+        manifest = {'version': 2, 'files': {}}
+        bytes_skipped = 0
+        if sync:
+            # Compare against the manifest of the previous upload, so only
+            # the files whose size or hashes changed go over the wire again
+            paths = [os.path.relpath(upload[0], local_path) for upload in uploads]
+            with ThreadPoolExecutor(max_workers=self.file_concurrency) as executor:
+                hashes = list(executor.map(
+                    lambda upload: file_part_hashes(upload[0], self.part_size),
+                    uploads))
+            remaining = []
+            for path, upload, parts in zip(paths, uploads, hashes):
+                entry = {'size': upload[2], 'part_size': self.part_size,
+                         'parts': parts}
+                if remote_manifest['files'].get(path) == entry:
+                    manifest['files'][path] = entry
+                    bytes_skipped += upload[2]
+                else:
+                    remaining.append(upload)
+            uploads = remaining
+        self.metrics.add_bytes('skipped', bytes_skipped)
+
+        # Start with the biggest shards so they do not end up as the tail
+        uploads.sort(key=lambda upload: upload[2], reverse=True)
+
+        # The multipart upload id and the parts already sent are tracked in a
+        # state folder next to local_path, on the same volume, so a preempted
+        # upload resumes where it stopped
+        state_dir = local_path.rstrip('/') + '.upload-state'
+
+        def upload(local_file_path, s3_file_path, size):
+            path = os.path.relpath(local_file_path, local_path)
+            parts = self._upload_file(local_file_path, s3_file_path, size,
+                                      os.path.join(state_dir, path + '.json'))
+            return path, {'size': size, 'part_size': self.part_size,
+                          'parts': parts}
+
+        self._begin(name)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.file_concurrency) as executor:
+            futures = [executor.submit(upload, *upload_args)
+                       for upload_args in uploads]
+            # Re-raise the first failed upload, if any
+            for future in futures:
+                path, entry = future.result()
+                manifest['files'][path] = entry
+        elapsed = time.perf_counter() - start
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+        stale_paths = set()
+        if sync:
+            stale_paths = set(remote_manifest['files']) - set(manifest['files'])
+        self._commit(name, manifest, stale_paths)
+
+        total_size = sum(size for _, _, size in uploads)
+        print(f'Finished uploading results: {len(uploads)} files, '
+              f'{total_size / 2**20:.1f} MiB in {elapsed:.1f}s '
+              f'({total_size / 2**20 / max(elapsed, 1e-6):.1f} MiB/s).')
+        print(f'Bytes moved: {total_size}, bytes skipped: {bytes_skipped}')
+
+    def upload_while(self, local_path, name, produce, sync=True,
+                     poll_seconds=10):
+        """Run produce() and upload the files it writes into local_path.
+
+        Every file is sent as soon as it stops changing for poll_seconds,
+        while produce() keeps writing the rest. Once it returns, the files
+        that changed after being sent go again and the manifest is committed,
+        as in upload(). Nothing is committed if produce() raises.
+        """
+        print(f'Uploading {local_path} to bucket {self.bucket_name} '
+              f'to S3 storage at {self.endpoint_url} while it is written')
+        remote_manifest = self.get_manifest(name) or {'files': {}}
+        state_dir = local_path.rstrip('/') + '.upload-state'
+
+        def scan():
+            stats = {}
+            for root, dirs, files in os.walk(local_path):
+                for file in files:
+                    local_file_path = os.path.join(root, file)
+                    try:
+                        stat = os.stat(local_file_path)
+                    except FileNotFoundError:
+                        # Temporary file removed while walking the folder
+                        continue
+                    path = os.path.relpath(local_file_path, local_path)
+                    stats[path] = (stat.st_size, stat.st_mtime)
+            return stats
+
+        def upload(path, stat):
+            local_file_path = os.path.join(local_path, path)
+            size = stat[0]
+            if sync:
+                entry = {'size': size, 'part_size': self.part_size,
+                         'parts': file_part_hashes(local_file_path,
+                                                   self.part_size)}
+                if remote_manifest['files'].get(path) == entry:
+                    self.metrics.add_bytes('skipped', size)
+                    return stat, entry
+            parts = self._upload_file(local_file_path,
+                                      os.path.join(name, path), size,
+                                      os.path.join(state_dir, path + '.json'))
+            return stat, {'size': size, 'part_size': self.part_size,
+                          'parts': parts}
+
+        # path -> future of its upload, submitted once per path while
+        # produce() runs, so no two uploads of the same object overlap
+        futures = {}
+        done = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=self.file_concurrency)
+
+        def watch():
+            previous = {}
+            while not done.wait(poll_seconds):
+                current = scan()
+                for path, stat in current.items():
+                    if path not in futures and previous.get(path) == stat:
+                        futures[path] = executor.submit(upload, path, stat)
+                previous = current
+
+        self._begin(name)
+        start = time.perf_counter()
+        watcher = threading.Thread(target=watch, daemon=True)
+        watcher.start()
+        try:
+            produce()
+        except BaseException:
+            done.set()
+            watcher.join()
+            executor.shutdown(cancel_futures=True)
+            raise
+        done.set()
+        watcher.join()
+
+        manifest = {'version': 2, 'files': {}}
+        sent = {path: future.result() for path, future in futures.items()}
+        final = scan()
+        with executor:
+            # The files written after the last poll, or rewritten after being
+            # sent, are uploaded now that produce() is done with them
+            late = {path: executor.submit(upload, path, stat)
+                    for path, stat in final.items()
+                    if path not in sent or sent[path][0] != stat}
+            for path, stat in final.items():
+                if path in late:
+                    manifest['files'][path] = late[path].result()[1]
+                else:
+                    manifest['files'][path] = sent[path][1]
+        elapsed = time.perf_counter() - start
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+        # Drop the files sent and then removed by produce(), and with sync
+        # those of the previous upload too
+        stale_paths = set(sent) - set(final)
+        if sync:
+            stale_paths |= set(remote_manifest['files']) - set(final)
+        self._commit(name, manifest, stale_paths)
+
+        print(f'Finished uploading results: {len(final)} files in '
+              f'{elapsed:.1f}s, {len(final) - len(late)} of them sent while '
+              f'being produced and {len(late)} afterwards.')
+
+    def _commit(self, name, manifest, stale_paths):
+        for path in stale_paths:
+            self.client.delete_object(Bucket=self.bucket_name,
+                                      Key=os.path.join(name, path))
+        # Any packed copy of the model would now be stale as well
+        for key in (PACK_NAME + '.json', PACK_NAME):
+            self.client.delete_object(Bucket=self.bucket_name,
+                                      Key=os.path.join(name, key))
+
+        # Commit the new manifest only once every file is in place
+        self.client.put_object(Bucket=self.bucket_name,
+                               Key=name.rstrip('/') + '.manifest.json',
+                               Body=json.dumps(manifest, indent=2).encode())
+        self.client.delete_object(Bucket=self.bucket_name,
+                                  Key=name.rstrip('/') + UPLOADING_SUFFIX)
+
+    def _upload_packed(self, local_path, name, chunk_size, level=3):
+        import zstandard
+
+        start = time.perf_counter()
+        index = {'version': 1, 'codec': 'zstd', 'chunk_size': chunk_size,
+                 'files': [], 'chunks': []}
+        offset = 0
+        for root, dirs, files in os.walk(local_path):
+            for file in sorted(files):
+                local_file_path = os.path.join(root, file)
+                size = os.path.getsize(local_file_path)
+                index['files'].append({
+                    'path': os.path.relpath(local_file_path, local_path),
+                    'offset': offset, 'size': size})
+                offset += size
+
+        def raw_chunks():
+            buffer = bytearray()
+            for entry in index['files']:
+                with open(os.path.join(local_path, entry['path']), 'rb') as f:
+                    for block in iter(lambda: f.read(chunk_size), b''):
+                        buffer += block
+                        while len(buffer) >= chunk_size:
+                            yield bytes(buffer[:chunk_size])
+                            del buffer[:chunk_size]
+            if buffer:
+                yield bytes(buffer)
+
+        def compress(raw):
+            # zstandard releases the GIL, so the chunks compress in parallel
+            return (zstandard.ZstdCompressor(level=level).compress(raw),
+                    len(raw), hashlib.sha256(raw).hexdigest())
+
+        # The pack is built next to local_path, on the same volume, and then
+        # sent as a regular resumable multipart upload
+        pack_path = local_path.rstrip('/') + '.pack'
+        pack_size = 0
+        with open(pack_path, 'wb') as pack, \
+                ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            # Bound the chunks in flight, so memory use does not depend on
+            # the model size
+            pending = deque()
+
+            def write_chunk(future):
+                nonlocal pack_size
+                data, raw_size, sha256 = future.result()
+                pack.write(data)
+                index['chunks'].append({'offset': pack_size, 'size': len(data),
+                                        'raw_size': raw_size, 'sha256': sha256})
+                pack_size += len(data)
+
+            for raw in raw_chunks():
+                pending.append(executor.submit(compress, raw))
+                if len(pending) >= 2 * self.max_concurrency:
+                    write_chunk(pending.popleft())
+            while pending:
+                write_chunk(pending.popleft())
+
+        prefix = name.rstrip('/') + '/'
+        self._begin(name)
+        self._upload_file(pack_path, prefix + PACK_NAME, pack_size,
+                          pack_path + '.upload-state.json')
+        os.remove(pack_path)
+
+        # Drop the plain layout of a previous upload, then commit the index
+        remote_manifest = self.get_manifest(name) or {'files': {}}
+        for path in remote_manifest['files']:
+            if path not in (PACK_NAME, PACK_NAME + '.json'):
+                self.client.delete_object(Bucket=self.bucket_name,
+                                          Key=prefix + path)
+        self.client.delete_object(Bucket=self.bucket_name,
+                                  Key=name.rstrip('/') + '.manifest.json')
+        self.client.put_object(Bucket=self.bucket_name,
+                               Key=prefix + PACK_NAME + '.json',
+                               Body=json.dumps(index).encode())
+        self.client.delete_object(Bucket=self.bucket_name,
+                                  Key=name.rstrip('/') + UPLOADING_SUFFIX)
+
+        elapsed = time.perf_counter() - start
+        print(f'Finished uploading results: {len(index["files"])} files '
+              f'packed in {len(index["chunks"])} chunks, '
+              f'{offset / 2**20:.1f} MiB compressed to {pack_size / 2**20:.1f} '
+              f'MiB in {elapsed:.1f}s '
+              f'({offset / 2**20 / max(elapsed, 1e-6):.1f} MiB/s).')
+
+    def _download_packed(self, name, local_path, index, sync=True):
+        import bisect
+        import zstandard
+
+        start = time.perf_counter()
+        key = name.rstrip('/') + '/' + PACK_NAME
+        files = index['files']
+        file_offsets = [entry['offset'] for entry in files]
+        raw_offsets = []
+        raw_offset = 0
+        for chunk in index['chunks']:
+            raw_offsets.append(raw_offset)
+            raw_offset += chunk['raw_size']
+
+        if sync:
+            # Drop the files left behind by a previous model
+            paths = {entry['path'] for entry in files}
+            for root, dirs, local_files in os.walk(local_path):
+                for file in local_files:
+                    local_file_name = os.path.join(root, file)
+                    if os.path.relpath(local_file_name, local_path) not in paths:
+                        os.remove(local_file_name)
+
+        # Chunks already written are tracked in a state file next to
+        # local_path, so a preempted download resumes where it stopped
+        state_path = local_path.rstrip('/') + '.download-state.json'
+        state = None
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+            if state['chunks'] != [chunk['sha256'] for chunk in index['chunks']]:
+                state = None
+        if state is None:
+            state = {'chunks': [chunk['sha256'] for chunk in index['chunks']],
+                     'done': []}
+            for entry in files:
+                local_file_name = os.path.join(local_path, entry['path'])
+                os.makedirs(os.path.dirname(local_file_name), exist_ok=True)
+                with open(local_file_name, 'wb') as f:
+                    f.truncate(entry['size'])
+            save_json(state_path, state)
+        done = set(state['done'])
+        state_lock = threading.Lock()
+
+        def download_chunk(number):
+            chunk = index['chunks'][number]
+            data = self.client.get_object(
+                Bucket=self.bucket_name, Key=key,
+                Range=f'bytes={chunk["offset"]}-'
+                      f'{chunk["offset"] + chunk["size"] - 1}')['Body'].read()
+            raw = zstandard.ZstdDecompressor().decompress(data)
+            if hashlib.sha256(raw).hexdigest() != chunk['sha256']:
+                raise RuntimeError(f'Checksum mismatch for chunk {number} of '
+                                   f'{key}')
+            self.metrics.add_bytes('downloaded', len(data))
+
+            # Scatter the chunk into the files it overlaps
+            first = raw_offsets[number]
+            last = first + len(raw)
+            position = max(bisect.bisect_right(file_offsets, first) - 1, 0)
+            while position < len(files) and files[position]['offset'] < last:
+                entry = files[position]
+                begin = max(first, entry['offset'])
+                end = min(last, entry['offset'] + entry['size'])
+                if begin < end:
+                    fd = os.open(os.path.join(local_path, entry['path']),
+                                 os.O_WRONLY)
+                    try:
+                        os.pwrite(fd, raw[begin - first:end - first],
+                                  begin - entry['offset'])
+                    finally:
+                        os.close(fd)
+                position += 1
+
+            with state_lock:
+                state['done'].append(number)
+                save_json(state_path, state)
+
+        with ThreadPoolExecutor(
+                max_workers=self.max_concurrency * self.file_concurrency) as executor:
+            list(executor.map(download_chunk,
+                              [number for number in range(len(index['chunks']))
+                               if number not in done]))
+        os.remove(state_path)
+
+        elapsed = time.perf_counter() - start
+        print(f'Downloaded {len(files)} files from {len(index["chunks"])} '
+              f'packed chunks, {raw_offset / 2**20:.1f} MiB in {elapsed:.1f}s '
+              f'({raw_offset / 2**20 / max(elapsed, 1e-6):.1f} MiB/s).')
+
+    def _send(self, data, **kwargs):
+        # S3 checks the MD5 of the body, and the SHA-256 recorded in the
+        # manifest is computed from the very same bytes while they are sent
+        md5 = base64.b64encode(hashlib.md5(data).digest()).decode()
+        if 'UploadId' in kwargs:
+            etag = self.client.upload_part(Body=data, ContentMD5=md5,
+                                           **kwargs)['ETag']
+        else:
+            etag = self.client.put_object(Body=data, ContentMD5=md5,
+                                          **kwargs)['ETag']
+        self.metrics.add_bytes('uploaded', len(data))
+        return etag, hashlib.sha256(data).hexdigest()
+
+    def _upload_file(self, local_file_path, s3_file_path, size, state_path):
+        from botocore.exceptions import ClientError
+
+        start = time.perf_counter()
+        resumed = 0
+        if size <= self.part_size:
+            with open(local_file_path, 'rb') as f:
+                data = f.read()
+            etag, sha256 = self._send(data, Bucket=self.bucket_name,
+                                      Key=s3_file_path)
+            parts = [sha256] if data else []
+        else:
+            os.makedirs(os.path.dirname(state_path), exist_ok=True)
+            mtime = os.path.getmtime(local_file_path)
+
+            state = None
+            if os.path.exists(state_path):
+                with open(state_path) as f:
+                    state = json.load(f)
+                # Only resume an upload of the very same file, and only the
+                # parts S3 still has for it
+                if (state['key'], state['size'], state['mtime'],
+                        state['part_size']) == (s3_file_path, size, mtime,
+                                                self.part_size):
+                    try:
+                        listed = {}
+                        paginator = self.client.get_paginator('list_parts')
+                        for page in paginator.paginate(
+                                Bucket=self.bucket_name, Key=s3_file_path,
+                                UploadId=state['upload_id']):
+                            for part in page.get('Parts', []):
+                                listed[str(part['PartNumber'])] = part['ETag']
+                        state['parts'] = {
+                            number: part for number, part
+                            in state['parts'].items()
+                            if listed.get(number) == part['etag']}
+                    except ClientError:
+                        state = None
+                else:
+                    try:
+                        self.client.abort_multipart_upload(
+                            Bucket=self.bucket_name, Key=state['key'],
+                            UploadId=state['upload_id'])
+                    except ClientError:
+                        pass
+                    state = None
+            if state is None:
+                upload_id = self.client.create_multipart_upload(
+                    Bucket=self.bucket_name, Key=s3_file_path)['UploadId']
+                state = {'key': s3_file_path, 'size': size, 'mtime': mtime,
+                         'part_size': self.part_size, 'upload_id': upload_id,
+                         'parts': {}}
+                save_json(state_path, state)
+            resumed = len(state['parts'])
+            state_lock = threading.Lock()
+
+            def upload_part(number):
+                with open(local_file_path, 'rb') as f:
+                    f.seek((number - 1) * self.part_size)
+                    data = f.read(self.part_size)
+                etag, sha256 = self._send(data, Bucket=self.bucket_name,
+                                          Key=s3_file_path,
+                                          UploadId=state['upload_id'],
+                                          PartNumber=number)
+                with state_lock:
+                    state['parts'][str(number)] = {'etag': etag,
+                                                   'sha256': sha256}
+                    save_json(state_path, state)
+
+            num_parts = -(-size // self.part_size)
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                list(executor.map(upload_part,
+                                  [number for number in range(1, num_parts + 1)
+                                   if str(number) not in state['parts']]))
+
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket_name, Key=s3_file_path,
+                UploadId=state['upload_id'],
+                MultipartUpload={'Parts': [
+                    {'ETag': state['parts'][str(number)]['etag'],
+                     'PartNumber': number}
+                    for number in range(1, num_parts + 1)]})
+            os.remove(state_path)
+            parts = [state['parts'][str(number)]['sha256']
+                     for number in range(1, num_parts + 1)]
+
+        elapsed = time.perf_counter() - start
+        print(f'Uploaded {local_file_path} ({size / 2**20:.1f} MiB in '
+              f'{elapsed:.1f}s, {size / 2**20 / max(elapsed, 1e-6):.1f} MiB/s'
+              f'{f", resumed after {resumed} parts" if resumed else ""})')
+        return parts
+
+
+def hf_revision(model_name):
+    from huggingface_hub import HfApi
+
+    return HfApi().model_info(model_name).sha
+
+
+def select_hf_files(filenames, allow_patterns=None, read_index=None):
+    """Pick the files of a HF model repo the pipeline steps load.
+
+    That is the top level configs, tokenizer and remote code files, and the
+    weights in a single format, safetensors if the repo has them, leaving
+    out the duplicated .bin weights, the ONNX, GGUF and other variants, and
+    the docs and images. allow_patterns, a list of globs, overrides it.
+
+    Of the weights, those transformers loads: model.safetensors, or the
+    shards model.safetensors.index.json maps the weights to, relative to
+    it and so possibly in subfolders, leaving out a consolidated copy of
+    them. read_index returns the parsed JSON of an index file of the repo;
+    without it, every weight file of the format is picked.
+    """
+    if allow_patterns:
+        return [filename for filename in filenames
+                if any(fnmatch.fnmatch(filename, pattern)
+                       for pattern in allow_patterns)]
+
+    def matches(filename, patterns):
+        return any(fnmatch.fnmatch(filename, pattern) for pattern in patterns)
+
+    top_level = [filename for filename in filenames if '/' not in filename]
+    weight_patterns = [pattern for patterns in HF_WEIGHT_PATTERNS
+                       for pattern in patterns]
+    selected = [filename for filename in top_level
+                if matches(filename, HF_SUPPORT_PATTERNS)
+                and not matches(filename, weight_patterns)]
+    for patterns, (single, index) in zip(HF_WEIGHT_PATTERNS,
+                                         HF_WEIGHT_NAMES):
+        if single in top_level:
+            return selected + [single]
+        if index in top_level and read_index:
+            shards = sorted({os.path.normpath(file) for file
+                             in read_index(index)['weight_map'].values()})
+            missing = [shard for shard in shards if shard not in filenames]
+            if missing:
+                raise RuntimeError(f'{index} maps weights to '
+                                   f'{", ".join(missing)}, not in the repo')
+            return selected + [index] + shards
+        weights = [filename for filename in top_level
+                   if matches(filename, patterns)]
+        if weights:
+            return selected + weights
+    return selected
+
+
+def download_from_hf(model_name, local_path, revision="main",
+                     allow_patterns=None, max_workers=8, metrics=None):
+    """Download the files select_hf_files picks from a HF model repo.
+
+    The files are fetched in parallel, biggest first, all from the commit
+    revision points to. The hub is taken from the HF_ENDPOINT env var, so a
+    mirror or a local stand-in server can be used instead.
+    """
+    from huggingface_hub import HfApi, hf_hub_download
+    from huggingface_hub.utils import disable_progress_bars
+
+    # One progress bar per parallel download garbles the step logs, the
+    # progress is printed per file instead
+    disable_progress_bars()
+    metrics = metrics or StorageMetrics()
+
+    print(f'Starting downloading {model_name}@{revision} from HF')
+    info = HfApi().model_info(model_name, revision=revision,
+                              files_metadata=True)
+    sizes = {sibling.rfilename: sibling.size or 0
+             for sibling in info.siblings}
+
+    def read_index(file):
+        # Downloaded ahead of the weights, to pick the shards it lists
+        with open(hf_hub_download(model_name, file, revision=info.sha,
+                                  local_dir=local_path)) as f:
+            return json.load(f)
+
+    files = select_hf_files(sizes, allow_patterns, read_index)
+    if not files:
+        raise RuntimeError(f'No files to download from {model_name}')
+    total_size = sum(sizes[file] for file in files)
+    skipped = sum(sizes.values()) - total_size
+    metrics.add_bytes('skipped', skipped)
+    print(f'Downloading {len(files)} of {len(sizes)} files, '
+          f'{total_size / 2**20:.1f} MiB, leaving out '
+          f'{skipped / 2**20:.1f} MiB the pipeline does not use')
+
+    # Start with the biggest shards so they do not end up as the tail
+    files.sort(key=sizes.get, reverse=True)
+    progress = {'files': 0, 'bytes': 0}
+    progress_lock = threading.Lock()
+    start = time.perf_counter()
+
+    def download(file):
+        file_start = time.perf_counter()
+        hf_hub_download(model_name, file, revision=info.sha,
+                        local_dir=local_path)
+        elapsed = time.perf_counter() - file_start
+        metrics.add_bytes('downloaded', sizes[file])
+        with progress_lock:
+            progress['files'] += 1
+            progress['bytes'] += sizes[file]
+            print(f'Downloaded {file} ({sizes[file] / 2**20:.1f} MiB in '
+                  f'{elapsed:.1f}s, {sizes[file] / 2**20 / max(elapsed, 1e-6):.1f}'
+                  f' MiB/s), {progress["files"]}/{len(files)} files, '
+                  f'{progress["bytes"] / max(total_size, 1):.0%} of the bytes')
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(download, file) for file in files]
+        # Re-raise the first failed download, if any
+        for future in futures:
+            future.result()
+    # Not part of the model, keep it out of the cache and the uploads
+    shutil.rmtree(os.path.join(local_path, HF_METADATA_DIR), ignore_errors=True)
+    elapsed = time.perf_counter() - start
+    print(f'Model downloaded successfully from HF: {len(files)} files, '
+          f'{total_size / 2**20:.1f} MiB in {elapsed:.1f}s '
+          f'({total_size / 2**20 / max(elapsed, 1e-6):.1f} MiB/s).')
+
+
+def _lock(path, blocking=True):
+    # flock based, so locks are released if the pod dies while holding them
+    lock_file = open(path, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if blocking
+                    else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+# ioctl cloning a whole file, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+def _clone_or_copy(src, dst):
+    # A copy on write clone, which shares the blocks until either file is
+    # written, where the volume supports it (XFS, btrfs), a copy otherwise
+    with open(src, 'rb') as source, open(dst, 'wb') as destination:
+        try:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+        except OSError:
+            shutil.copyfileobj(source, destination, 16 * 1024 * 1024)
+    shutil.copystat(src, dst)
+
+
+def _copy_tree(source, destination):
+    # Copies, not links: the steps write into the folders they are given,
+    # which must never change the files of the cache entry
+    if os.path.exists(destination):
+        shutil.rmtree(destination)
+    shutil.copytree(source, destination, copy_function=_clone_or_copy)
+
+
+class ModelCache:
+    """Models fetched before, kept on the shared volume.
+
+    There is one entry per source, model name and revision, exposed to the
+    pipeline as a copy, cloned where the volume supports it. index.json keeps hit/miss counters, entry
+    sizes and last use, and the least recently used entries are evicted once
+    the cache grows over max_gb.
+    """
+
+    def __init__(self, cache_dir, max_gb=200):
+        self.cache_dir = cache_dir
+        self.max_gb = max_gb
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _read_index(self):
+        if not os.path.exists(self.index_path):
+            return {'hits': 0, 'misses': 0, 'entries': {}}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def _write_index(self, index):
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def fetch(self, source, model_name, revision, destination_path,
+              download=None):
+        """Expose the model at destination_path, calling download(path) on a miss.
+
+        Without download, a miss leaves destination_path alone, for callers
+        that produce the entry elsewhere and store() it afterwards. Returns
+        True on a hit.
+        """
+        key, entry_path = self._entry(source, model_name, revision)
+
+        # Hold the entry lock while filling and linking the entry, so
+        # concurrent runs wait for a single download and eviction skips
+        # entries in use
+        entry_lock = _lock(entry_path + '.lock')
+        try:
+            index_lock = _lock(self.index_path + '.lock')
+            index = self._read_index()
+            hit = key in index['entries'] and os.path.isdir(entry_path)
+            index['hits' if hit else 'misses'] += 1
+            self._write_index(index)
+            index_lock.close()
+
+            if not hit and download is None:
+                print(f'Cache miss for {model_name}@{revision}')
+                return False
+            if not hit:
+                download(entry_path)
+
+            _copy_tree(entry_path, destination_path)
+            index, used = self._touch(key, source, model_name, revision)
+        finally:
+            entry_lock.close()
+
+        print(f"Cache {'hit' if hit else 'miss'} for {model_name}@{revision} "
+              f"({index['hits']} hits, {index['misses']} misses, "
+              f"{used / 2**30:.1f} of {self.max_gb} GiB used)")
+        return hit
+
+    def store(self, source, model_name, revision, path):
+        """Add the folder at path as the entry a later fetch() exposes."""
+        key, entry_path = self._entry(source, model_name, revision)
+        entry_lock = _lock(entry_path + '.lock')
+        try:
+            _copy_tree(path, entry_path)
+            index, used = self._touch(key, source, model_name, revision)
+        finally:
+            entry_lock.close()
+        print(f'Stored {model_name}@{revision} in the cache '
+              f'({used / 2**30:.1f} of {self.max_gb} GiB used)')
+
+    def _entry(self, source, model_name, revision):
+        key = hashlib.sha256(
+            f'{source}:{model_name}:{revision}'.encode()).hexdigest()
+        return key, os.path.join(self.cache_dir, key)
+
+    def _touch(self, key, source, model_name, revision):
+        # Record the entry as just used, and make room for it
+        index_lock = _lock(self.index_path + '.lock')
+        try:
+            index = self._read_index()
+            entry_path = os.path.join(self.cache_dir, key)
+            index['entries'][key] = {
+                'source': source,
+                'model_name': model_name,
+                'revision': revision,
+                'size': sum(os.path.getsize(os.path.join(root, file))
+                            for root, dirs, files in os.walk(entry_path)
+                            for file in files),
+                'last_used': time.time(),
+            }
+            used = self._evict(index, key)
+            self._write_index(index)
+        finally:
+            index_lock.close()
+        return index, used
+
+    def _evict(self, index, keep_key):
+        # Evict the least recently used entries until the cache fits in its
+        # budget, skipping the ones other runs are using right now
+        budget = self.max_gb * 1024**3
+        used = sum(entry['size'] for entry in index['entries'].values())
+        for key, entry in sorted(index['entries'].items(),
+                                 key=lambda item: item[1]['last_used']):
+            if used <= budget:
+                break
+            if key == keep_key:
+                continue
+            entry_path = os.path.join(self.cache_dir, key)
+            entry_lock = _lock(entry_path + '.lock', blocking=False)
+            if entry_lock is None:
+                continue
+            shutil.rmtree(entry_path, ignore_errors=True)
+            entry_lock.close()
+            del index['entries'][key]
+            used -= entry['size']
+            print(f"Evicted {entry['model_name']}@{entry['revision']} "
+                  f"from the cache")
+        return used
+
+
+def folder_hash(path, max_workers=8):
+    """Content hash of a model folder: relative paths, sizes and contents.
+
+    The huggingface_hub download metadata is left out, it changes with the
+    library version and not with the model.
+    """
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs[:] = [name for name in dirs if name != HF_METADATA_DIR]
+        files += [os.path.relpath(os.path.join(root, name), path)
+                  for name in names]
+    files.sort()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        hashes = list(executor.map(
+            lambda file: file_part_hashes(os.path.join(path, file),
+                                          64 * 1024 * 1024), files))
+    return hashlib.sha256(json.dumps([
+        (file, os.path.getsize(os.path.join(path, file)), parts)
+        for file, parts in zip(files, hashes)]).encode()).hexdigest()
+
+
+def library_versions(*distributions):
+    from importlib.metadata import PackageNotFoundError, version
+
+    versions = {}
+    for distribution in distributions:
+        try:
+            versions[distribution] = version(distribution)
+        except PackageNotFoundError:
+            versions[distribution] = None
+    return versions
+
+
+def step_key(**inputs):
+    """Hash of the inputs of a step, the cache key of its outputs."""
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True,
+                                     default=str).encode()).hexdigest()
+
+
+def memoize_step(step, output_path, run, cache_dir, max_gb=200, **inputs):
+    """Expose the output of step at output_path, running it only if needed.
+
+    The cache key is the hash of the step inputs, so a step run before with
+    the same ones, e.g. the folder_hash of its model, its rendered recipe,
+    dataset and library_versions, reuses that output from the model cache
+    instead of calling run(path) again. Returns True on a cache hit.
+    """
+    key = step_key(**inputs)
+
+    def produce(entry_path):
+        # Start from scratch if an earlier run died half way
+        shutil.rmtree(entry_path, ignore_errors=True)
+        run(entry_path)
+
+    return ModelCache(cache_dir, max_gb).fetch(step, step, key, output_path,
+                                               produce)
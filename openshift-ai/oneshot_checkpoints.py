@@ -0,0 +1,143 @@
+"""Checkpoint SparseML oneshot after every decoder layer, and resume it.
+
+With sequential_update, the SparseGPT modifier of oneshot compresses the
+decoder layers one at a time: it runs the calibration set through the
+whole model, already compressed layers included, then prunes the layer.
+A pod that dies at layer 30 throws all of that away. Within
+resumable_oneshot, every compressed layer is saved to checkpoint_dir, and a
+rerun with the same checkpoint_key loads the saved layers at their turn
+instead of calibrating and compressing them again:
+
+    with resumable_oneshot(checkpoint_dir, step_key(**inputs)):
+        sparseml.transformers.oneshot(model=model, recipe=recipe, ...)
+
+The later layers are calibrated on the outputs of the loaded ones, as they
+were on the outputs of the compressed ones, so the result is the one of an
+uninterrupted run. Calibration activations are not checkpointed: oneshot
+runs the whole model for every layer, it does not pass them along.
+
+It works through the LayerCompressor steps of SparseML, the ones of the
+SparseGPT and Wanda modifiers. This module is baked into the sparseml image,
+see sparseml_Dockerfile.
+"""
+import contextlib
+import json
+import os
+import shutil
+
+PROGRESS_FILE = 'progress.json'
+
+
+class LayerCheckpoints:
+    """The state dicts of the layers compressed so far, in path.
+
+    progress.json is written after the file of a layer, so it always points
+    to complete ones, and a different key starts over.
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.completed = -1
+        progress = os.path.join(path, PROGRESS_FILE)
+        if os.path.exists(progress):
+            with open(progress) as f:
+                saved = json.load(f)
+            if saved['key'] == key:
+                self.completed = saved['completed']
+            else:
+                print(f'Checkpoints in {path} are for other settings, '
+                      f'starting over')
+                shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+
+    def layer_path(self, index):
+        return os.path.join(self.path, f'layer-{index:05d}.pt')
+
+    def save(self, index, layer):
+        import torch
+
+        # With torch.save, not safetensors: the state dict keeps its
+        # metadata, which the quantization observers need to load it back
+        torch.save(layer.state_dict(), self.layer_path(index) + '.tmp')
+        os.replace(self.layer_path(index) + '.tmp', self.layer_path(index))
+        with open(os.path.join(self.path, PROGRESS_FILE + '.tmp'), 'w') as f:
+            json.dump({'key': self.key, 'completed': index}, f)
+        os.replace(os.path.join(self.path, PROGRESS_FILE + '.tmp'),
+                   os.path.join(self.path, PROGRESS_FILE))
+        self.completed = index
+
+    def restore(self, index, layer):
+        import torch
+
+        layer.load_state_dict(torch.load(self.layer_path(index),
+                                         map_location='cpu'))
+
+
+@contextlib.contextmanager
+def resumable_oneshot(checkpoint_dir, checkpoint_key,
+                      replay_calibration=False):
+    """Checkpoint and resume the layer by layer compression of oneshot.
+
+    The calibration forward passes of the layers loaded from checkpoints are
+    skipped, only the samples are drawn. Recipes with modifiers that calibrate during those passes, as
+    the quantization observers of SparseGPT with quantize, need
+    replay_calibration to run them again, for the same observer ranges.
+    """
+    import operator
+
+    from sparseml.modifiers.pruning.wanda import pytorch as wanda
+    from sparseml.modifiers.utils.layer_compressor import LayerCompressor
+
+    checkpoints = LayerCheckpoints(checkpoint_dir, checkpoint_key)
+    if checkpoints.completed >= 0:
+        print(f'Resuming after layer {checkpoints.completed + 1}, '
+              f'{checkpoint_dir}')
+    originals = {name: getattr(LayerCompressor, name)
+                 for name in ('pre_compress', 'compress',
+                              'revert_layer_wrappers')}
+    run_calibration_forward = wanda.run_calibration_forward
+    skip_calibration = [False]
+
+    def restored(compressor):
+        return compressor.layer_index <= checkpoints.completed
+
+    def pre_compress(self):
+        # Called right before the calibration forward pass of the layer
+        skip_calibration[0] = restored(self) and not replay_calibration
+        if restored(self):
+            self.handles = []
+            return
+        originals['pre_compress'](self)
+
+    def calibrate(model, dataloader, *args, **kwargs):
+        if not skip_calibration[0]:
+            return run_calibration_forward(model, dataloader, *args, **kwargs)
+        # Still iterated, without the model: its sampler shuffles with the
+        # global RNG, and the next layers get the samples in the same order
+        for _ in dataloader:
+            pass
+
+    def compress(self):
+        if restored(self):
+            checkpoints.restore(self.layer_index,
+                                operator.attrgetter(self.name)(self.model))
+            return
+        originals['compress'](self)
+
+    def revert_layer_wrappers(self):
+        originals['revert_layer_wrappers'](self)
+        if not restored(self):
+            checkpoints.save(self.layer_index,
+                             operator.attrgetter(self.name)(self.model))
+
+    LayerCompressor.pre_compress = pre_compress
+    LayerCompressor.compress = compress
+    LayerCompressor.revert_layer_wrappers = revert_layer_wrappers
+    wanda.run_calibration_forward = calibrate
+    try:
+        yield checkpoints
+    finally:
+        for name, method in originals.items():
+            setattr(LayerCompressor, name, method)
+        wanda.run_calibration_forward = run_calibration_forward
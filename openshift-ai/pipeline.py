@@ -1,7 +1,10 @@
 import kfp.dsl as dsl
 import kfp.components as comp
+from kfp.components import OutputPath
 from kfp_tekton.compiler import TektonCompiler
-from kfp_tekton.k8s_client_helper import env_from_secret
+
+from pipeline_helpers import (STORAGE_IMAGE, add_data_connection,
+                              add_telemetry)
 
 from kubernetes.client import V1Volume, V1PersistentVolumeClaimVolumeSource, V1Toleration
 
@@ -23,24 +26,26 @@ def download_model(model_name: str, destination_path: str):
         print(result.stderr)
 
 
-def sparse_model(model_path:str, compress_model_path: str, ds: str, precision: str):
+def sparse_model(model_path:str, compress_model_path: str, ds: str, precision: str,
+                 cache_dir: str = ""):
     from sparseml.transformers import (
-        SparseAutoModelForCausalLM, SparseAutoTokenizer, load_dataset, oneshot
+        SparseAutoModelForCausalLM, SparseAutoTokenizer, oneshot
     )
+    from calibration_data import calibration_set
+    from stage_telemetry import mark
 
+    mark('load_model')
     model = SparseAutoModelForCausalLM.from_pretrained(model_path, device_map="auto")
 
     tokenizer = SparseAutoTokenizer.from_pretrained(model_path)
     #tokenizer = SparseAutoTokenizer.from_pretrained(model_path).to(model.device)
 
-    dataset = load_dataset(ds)
-
-    def format_data(data):
-        return {
-            "text": data["instruction"] + data["output"]
-        }
-
-    dataset = dataset.map(format_data)
+    mark('calibration')
+    # Only the calibration samples are formatted, once, and kept in the cache
+    calibration = calibration_set(model_path, ds, 512, 384,
+                                  path=f"{compress_model_path}-calibration",
+                                  cache_dir=cache_dir)
+    dataset = calibration.dataset()
 
     recipe = """
     test_stage:
@@ -92,18 +97,23 @@ def sparse_model(model_path:str, compress_model_path: str, ds: str, precision: s
           targets: ["re:model.layers.\\\d*$"]
     """
 
+    mark('oneshot')
     oneshot(
         model=model,
         tokenizer=tokenizer,
         dataset=dataset,
         recipe=recipe,
         output_dir=compress_model_path,
+        num_calibration_samples=len(calibration),
+        max_seq_length=384,
     )
 
 
 def export_model(model_path: str, exported_model_path: str):
     from sparseml import export
+    from stage_telemetry import mark
 
+    mark('export')
     export(
         model_path,
         task="text-generation",
@@ -142,52 +152,37 @@ def eval_model(model_path: str, tasks: str, batch_size: str):
         print(result.stderr)
 
 
-def upload_pruned_model(model_path: str):
+def upload_pruned_model(model_path: str,
+                        mlpipeline_metrics_path: OutputPath('Metrics'),
+                        max_concurrency: int = 10, file_concurrency: int = 4,
+                        multipart_chunksize_mb: int = 64):
     import os
-    from boto3 import client
+    from model_storage import ModelStorage
 
     print('Commencing results upload.')
-    print(os.environ)
-
-    s3_endpoint_url = os.environ["s3_host"]
-    s3_access_key = os.environ["s3_access_key"]
-    s3_secret_key = os.environ["s3_secret_access_key"]
-    s3_bucket_name = os.environ["s3_bucket"]
-
-    print(f'Uploading predictions to bucket {s3_bucket_name} '
-          f'to S3 storage at {s3_endpoint_url}')
-
-    s3_client = client(
-        's3', endpoint_url=s3_endpoint_url,
-        aws_access_key_id=s3_access_key, aws_secret_access_key=s3_secret_key, verify=False
-    )
-
-    # Walk through the local folder and upload files
-    for root, dirs, files in os.walk(model_path):
-        for file in files:
-            local_file_path = os.path.join(root, file)
-            s3_file_path = os.path.join(s3_bucket_name, local_file_path[len(model_path)+1:])
-            s3_client.upload_file(local_file_path, s3_bucket_name, s3_file_path)
-            print(f'Uploaded {local_file_path}')
-
-    print('Finished uploading results.')
+    storage = ModelStorage(max_concurrency, file_concurrency,
+                           multipart_chunksize_mb)
+    storage.upload(model_path, os.environ["s3_bucket"])
+    storage.metrics.write(mlpipeline_metrics_path)
 
 
+# The images built from the Dockerfiles of this folder carry stage_telemetry,
+# which wraps every step, and the neural-magic:sparseml one calibration_data
 download_op = comp.create_component_from_func(download_model,
                                               packages_to_install=["huggingface-hub"],
-                                              base_image='registry.access.redhat.com/ubi9/python-311')
+                                              base_image=STORAGE_IMAGE)
 sparse_op = comp.create_component_from_func(sparse_model,
                                             packages_to_install=["datasets"],
-                                            base_image='quay.io/ltomasbo/sparseml')
+                                            base_image='quay.io/ltomasbo/neural-magic:sparseml')
 export_op = comp.create_component_from_func(export_model,
                                             packages_to_install=[],
-                                            base_image='quay.io/ltomasbo/sparseml')
+                                            base_image='quay.io/ltomasbo/neural-magic:sparseml')
 eval_op = comp.create_component_from_func(eval_model,
                                           packages_to_install=["datasets"],
-                                          base_image='quay.io/ltomasbo/sparseml:eval2')
+                                          base_image='quay.io/ltomasbo/neural-magic:sparseml_eval')
 upload_op = comp.create_component_from_func(upload_pruned_model,
-                                            packages_to_install=["boto3"],
-                                            base_image='registry.access.redhat.com/ubi9/python-311')
+                                            packages_to_install=[],
+                                            base_image=STORAGE_IMAGE)
 
 # Define your pipeline function
 @dsl.pipeline(
@@ -203,6 +198,9 @@ def sparseml_pipeline(
     eval_batch_size:str="64",
 ):
     print("Params", model_name, accuracy)
+    # Time and resources of every step, see stage_telemetry.py
+    dsl.get_pipeline_conf().add_op_transformer(add_telemetry)
+
     vol = V1Volume(
         name='models-shared',
         persistent_volume_claim=V1PersistentVolumeClaimVolumeSource(
@@ -234,7 +232,8 @@ def sparseml_pipeline(
                               compress_model_path=SPARSE_MODEL_DIR,
                               #ds="open-platypus",
                               ds="garage-bAInd/Open-Platypus",
-                              precision="bfloat16")
+                              precision="bfloat16",
+                              cache_dir=BASE_DIR + "cache")
         sparse_llm.add_pvolumes({"/mnt/models": vol})
         sparse_llm.add_node_selector_constraint(label_name='nvidia.com/gpu.present', value='true')
         sparse_llm.add_toleration(gpu_toleration)
@@ -265,10 +264,7 @@ def sparseml_pipeline(
             export_llm.after(eval_llm)
 
             upload_pruned_llm = upload_op(model_path=EXPORTED_MODEL_DIR)
-            upload_pruned_llm.add_env_variable(env_from_secret('s3_access_key', 'aws-connection-models', 'AWS_ACCESS_KEY_ID'))
-            upload_pruned_llm.add_env_variable(env_from_secret('s3_secret_access_key', 'aws-connection-models', 'AWS_SECRET_ACCESS_KEY'))
-            upload_pruned_llm.add_env_variable(env_from_secret('s3_host', 'aws-connection-models', 'AWS_S3_ENDPOINT'))
-            upload_pruned_llm.add_env_variable(env_from_secret('s3_bucket', 'aws-connection-models', 'AWS_S3_BUCKET'))
+            add_data_connection(upload_pruned_llm, 'aws-connection-models')
             upload_pruned_llm.add_pvolumes({"/mnt/models": vol})
             upload_pruned_llm.after(export_llm)
 
@@ -278,10 +274,7 @@ def sparseml_pipeline(
             export_llm.after(sparse_llm)
 
             upload_pruned_llm = upload_op(model_path=EXPORTED_MODEL_DIR)
-            upload_pruned_llm.add_env_variable(env_from_secret('s3_access_key', 'aws-connection-models', 'AWS_ACCESS_KEY_ID'))
-            upload_pruned_llm.add_env_variable(env_from_secret('s3_secret_access_key', 'aws-connection-models', 'AWS_SECRET_ACCESS_KEY'))
-            upload_pruned_llm.add_env_variable(env_from_secret('s3_host', 'aws-connection-models', 'AWS_S3_ENDPOINT'))
-            upload_pruned_llm.add_env_variable(env_from_secret('s3_bucket', 'aws-connection-models', 'AWS_S3_BUCKET'))
+            add_data_connection(upload_pruned_llm, 'aws-connection-models')
             upload_pruned_llm.add_pvolumes({"/mnt/models": vol})
             upload_pruned_llm.after(export_llm)
 
@@ -300,10 +293,7 @@ def sparseml_pipeline(
         export_llm.after(download_llm)
 
         upload_pruned_llm = upload_op(model_path=EXPORTED_MODEL_DIR)
-        upload_pruned_llm.add_env_variable(env_from_secret('s3_access_key', 'aws-connection-models', 'AWS_ACCESS_KEY_ID'))
-        upload_pruned_llm.add_env_variable(env_from_secret('s3_secret_access_key', 'aws-connection-models', 'AWS_SECRET_ACCESS_KEY'))
-        upload_pruned_llm.add_env_variable(env_from_secret('s3_host', 'aws-connection-models', 'AWS_S3_ENDPOINT'))
-        upload_pruned_llm.add_env_variable(env_from_secret('s3_bucket', 'aws-connection-models', 'AWS_S3_BUCKET'))
+        add_data_connection(upload_pruned_llm, 'aws-connection-models')
         upload_pruned_llm.add_pvolumes({"/mnt/models": vol})
         upload_pruned_llm.after(export_llm)
 
@@ -0,0 +1,389 @@
+"""Pipeline components shared by pipeline_nmvllm.py and pipeline_simplified.py.
+
+The steps both pipelines run the same way, defined once with the images
+they run on. Like every lightweight component, each function only carries
+its own source, and imports the modules baked into its image.
+"""
+import kfp.components as comp
+from kfp.components import OutputPath
+from typing import NamedTuple
+
+from pipeline_helpers import STORAGE_IMAGE
+
+
+def download_model(model_name: str, destination_path: str,
+                   download_option: str,
+                   mlpipeline_metrics_path: OutputPath('Metrics'),
+                   cache_dir: str = "", cache_max_gb: float = 200,
+                   sync: bool = True, max_concurrency: int = 10,
+                   file_concurrency: int = 4, multipart_chunksize_mb: int = 64):
+    from model_storage import (ModelCache, ModelStorage, StorageMetrics,
+                               download_from_hf, hf_revision)
+
+    metrics = StorageMetrics()
+    download = None
+    if download_option == "HF":
+        revision = hf_revision(model_name) if cache_dir else "main"
+
+        def download(local_path):
+            download_from_hf(model_name, local_path, revision,
+                             max_workers=file_concurrency, metrics=metrics)
+
+    elif download_option == "S3":
+        storage = ModelStorage(max_concurrency, file_concurrency,
+                               multipart_chunksize_mb, metrics)
+        revision = storage.revision(model_name) if cache_dir else None
+
+        def download(local_path):
+            storage.download(model_name, local_path, sync)
+            print('Model downloaded successfully from S3.')
+
+    elif download_option == "PVC":
+        print('Model should be already on the volumen.')
+
+    if download is not None:
+        if cache_dir:
+            ModelCache(cache_dir, cache_max_gb).fetch(
+                download_option, model_name, revision, destination_path,
+                download)
+        else:
+            download(destination_path)
+
+    metrics.write(mlpipeline_metrics_path)
+
+
+def quantize_gpu_model(model_path:str, compress_model_path: str, ds: str,
+                       num_examples: int = 512, max_seq_len: int = 512,
+                       cache_dir: str = ""):
+    # Quantizing an LLM
+    from transformers import AutoTokenizer
+
+    from auto_gptq import AutoGPTQForCausalLM, BaseQuantizeConfig
+    from calibration_data import calibration_set
+    from gptq_marlin import save_marlin
+    from model_storage import folder_hash, library_versions, memoize_step
+    from stage_telemetry import mark
+
+    SEED = 42
+
+    # Apply GPTQ
+    quantize_config = BaseQuantizeConfig(
+        bits=4,                         # Only support 4 bit
+        group_size=128,                 # Set to g=128 or -1 (for channelwise)
+        desc_act=False,                 # Marlin does not support act_order=True
+        model_file_base_name="model",   # Name of the model.safetensors when we call save_pretrained
+    )
+
+    def compress(output_dir):
+        mark('calibration')
+        # Tokenized once and kept in the model cache, see calibration_data
+        print("Loading the dataset and tokenizers")
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        calibration = calibration_set(model_path, ds, num_examples,
+                                      max_seq_len, seed=SEED,
+                                      path=f"{compress_model_path}-calibration",
+                                      cache_dir=cache_dir)
+        examples = calibration.examples()
+
+        print("Loaded the dataset and tokenizers")
+        print("Starting the quantization")
+
+        print("Applying GPTQ for quantization")
+
+        mark('load_model')
+        model = AutoGPTQForCausalLM.from_pretrained(
+            model_path,
+            quantize_config,
+            device_map="auto")
+        mark('quantize')
+        model.quantize(examples)
+
+        mark('marlin')
+        # Convert to Marlin, repacking the quantized layers in memory instead
+        # of saving the GPTQ model and loading it back with use_marlin
+        print(f"Saving model in marlin format to {output_dir}")
+        save_marlin(model, quantize_config, output_dir)
+        tokenizer.save_pretrained(output_dir)
+
+        print("Quantization process completed")
+
+    if not cache_dir:
+        compress(compress_model_path)
+        return
+    # Reuse the output of an earlier run with the same model, GPTQ settings,
+    # dataset and libraries instead of quantizing again
+    memoize_step('quantize_gpu_model', compress_model_path, compress,
+                 cache_dir, model=folder_hash(model_path),
+                 recipe=quantize_config.to_dict(), dataset=ds,
+                 num_examples=num_examples, max_seq_len=max_seq_len, seed=SEED,
+                 versions=library_versions('auto-gptq', 'torch',
+                                           'transformers', 'datasets'))
+
+
+def export_model(model_path: str, exported_model_path: str,
+                 mlpipeline_metrics_path: OutputPath('Metrics'),
+                 upload_name: str = "", upload: bool = True,
+                 cache_dir: str = "",
+                 sequence_lengths: str = "[1024]", batch_sizes: str = "[1]",
+                 task: str = "text-generation"):
+    import os
+    from sparseml import export
+    from export_variants import parse_sizes, write_manifest
+    from model_storage import (ModelStorage, StorageMetrics, folder_hash,
+                               library_versions, memoize_step)
+    from stage_telemetry import mark
+
+    # DeepSparse compiles the graph for the shape of every variant, see
+    # export_variants.py, so it is exported once, for the longest one
+    sequence_length = parse_sizes(sequence_lengths, 'sequence_lengths')[-1]
+
+    def export_llm(target_path):
+        mark('export')
+        export(
+            model_path,
+            task=task,
+            sequence_length=sequence_length,
+            target_path=target_path
+        )
+
+    def export_or_reuse():
+        if not cache_dir:
+            export_llm(exported_model_path)
+        else:
+            # Reuse the export of an earlier run with the same model and
+            # libraries instead of exporting again
+            memoize_step('export_model', exported_model_path, export_llm,
+                         cache_dir, model=folder_hash(model_path), task=task,
+                         sequence_length=sequence_length,
+                         versions=library_versions('sparseml', 'torch',
+                                                   'onnx', 'transformers'))
+        write_manifest(os.path.join(exported_model_path, "deployment"),
+                       sequence_lengths, batch_sizes,
+                       task=task.replace("-", "_"))
+
+    # upload is save_model, so the pipeline builds a single export step
+    if upload and upload_name:
+        # Upload every exported file as soon as it is written, instead of
+        # reading the whole export back in a separate upload step
+        storage = ModelStorage()
+        storage.upload_while(exported_model_path, upload_name,
+                             export_or_reuse)
+        metrics = storage.metrics
+    else:
+        export_or_reuse()
+        metrics = StorageMetrics()
+    metrics.write(mlpipeline_metrics_path)
+
+
+def cpu_eval_model(model_path: str, tasks: str, batch_size: str,
+                   shard: int = 0, num_shards: int = 1,
+                   results_dir: str = "", num_fewshot: int = 0,
+                   limit: str = ""):
+    import subprocess
+    import os
+
+    model_args = "pretrained=" + model_path  # + ",trust_remote_code=True"
+
+    # Execute the huggingface_hub-cli command
+    env = os.environ.copy()
+    env["CUDA_VISIBLE_DEVICES"] = "0"
+    command = ["python", "./lm-evaluation-harness/main.py",
+               "--model", "sparseml",
+               "--model_args", model_args,
+               "--tasks", tasks,
+               "--batch_size", batch_size,
+               "--no_cache",
+               "--write_out",
+               "--device", "cuda:0",
+               "--num_fewshot", str(num_fewshot)]
+
+    if results_dir:
+        # Evaluate this worker's share of the docs only, the merge step
+        # weights the results of all the shards
+        command = ["python", "-m", "lm_eval_shards",
+                   "--shard", str(shard), "--num-shards", str(num_shards),
+                   "--results", f"{results_dir}/shard-{shard}.json",
+                   "--limit", limit or "0",
+                   "--"] + command
+    elif limit:
+        command += ["--limit", limit]
+    result = subprocess.run(command, capture_output=True, text=True, env=env)
+
+    # Check for errors or output
+    if result.returncode == 0:
+        print("Model evaluated successfully:")
+        print(result.stdout)
+    else:
+        print("Error evaluating the model:")
+        print(result.stderr)
+
+
+def gpu_eval_model(model_path: str, tasks: str, batch_size: str, sparse: bool=False,
+                   shard: int = 0, num_shards: int = 1,
+                   results_dir: str = "", num_fewshot: int = 0,
+                   limit: str = ""):
+    import subprocess
+    import os
+
+    if sparse:
+        model_args = "pretrained=" + model_path + ",sparsity=sparse_w16a16"  # + ",trust_remote_code=True"
+    else:
+        model_args = "pretrained=" + model_path  + ",tensor_parallel_size=1"  # + ",trust_remote_code=True"
+
+    # Execute the huggingface_hub-cli command
+    env = os.environ.copy()
+    env["CUDA_VISIBLE_DEVICES"] = "0"
+    command = ["lm_eval",
+               "--model", "vllm",
+               "--model_args", model_args,
+               "--tasks", tasks,
+               "--batch_size", batch_size,
+               "--write_out",
+               "--num_fewshot", str(num_fewshot)]
+
+    if results_dir:
+        # Evaluate this worker's share of the docs only, the merge step
+        # weights the results of all the shards
+        command = ["python", "-m", "lm_eval_shards",
+                   "--shard", str(shard), "--num-shards", str(num_shards),
+                   "--results", f"{results_dir}/shard-{shard}.json",
+                   "--limit", limit or "0",
+                   "--"] + command
+    elif limit:
+        command += ["--limit", limit]
+    result = subprocess.run(command, capture_output=True, text=True, env=env)
+
+    # Check for errors or output
+    if result.returncode == 0:
+        print("Model evaluated successfully:")
+        print(result.stdout)
+    else:
+        print("Error evaluating the model:")
+        print(result.stderr)
+
+
+def merge_eval_results(results_dir: str, num_shards: int,
+                       mlpipeline_metrics_path: OutputPath('Metrics')):
+    import json
+    import os
+    from lm_eval_shards import kfp_metrics, merge_shards
+
+    shard_results = []
+    for shard in range(num_shards):
+        shard_path = os.path.join(results_dir, f"shard-{shard}.json")
+        if not os.path.exists(shard_path):
+            raise RuntimeError(f"Eval shard {shard} produced no results, "
+                               "see its logs")
+        with open(shard_path) as f:
+            shard_results.append(json.load(f))
+
+    merged = merge_shards(shard_results)
+    # Replaced, never rewritten in place, as it may be linked to the cache
+    results_path = os.path.join(results_dir, "results.json")
+    with open(results_path + ".tmp", "w") as f:
+        json.dump(merged, f, indent=2)
+    os.replace(results_path + ".tmp", results_path)
+    print("Model evaluated successfully:")
+    print(json.dumps(merged["results"], indent=2))
+    if merged["approximate"]:
+        print("Averaged over the shards, so approximate:",
+              ", ".join(merged["approximate"]))
+
+    # Show the scores in the run metrics too
+    with open(mlpipeline_metrics_path, "w") as f:
+        json.dump(kfp_metrics(merged), f)
+
+
+def lookup_eval_results(model_path: str, tasks: str, results_dir: str,
+                        cache_dir: str,
+                        mlpipeline_metrics_path: OutputPath('Metrics'),
+                        num_fewshot: int = 0, limit: str = ""
+                        ) -> NamedTuple('Outputs', [('cache', str),
+                                                    ('key', str)]):
+    import json
+    import os
+    from collections import namedtuple
+    from lm_eval_shards import kfp_metrics
+    from model_storage import (ModelCache, folder_hash, library_versions,
+                               step_key)
+
+    # Scores only change with the model content, the eval settings and the
+    # harness (and what it runs the model with) in this eval image
+    key = step_key(model=folder_hash(model_path), tasks=tasks,
+                   num_fewshot=num_fewshot, limit=limit,
+                   versions=library_versions('lm_eval', 'transformers',
+                                             'torch', 'vllm', 'nm-vllm',
+                                             'sparseml', 'sparseml-nightly'))
+    hit = ModelCache(cache_dir).fetch('eval', 'eval', key, results_dir)
+
+    metrics = {"metrics": []}
+    if hit:
+        with open(os.path.join(results_dir, "results.json")) as f:
+            merged = json.load(f)
+        print("Reusing the scores of an earlier run:")
+        print(json.dumps(merged["results"], indent=2))
+        metrics = kfp_metrics(merged)
+    with open(mlpipeline_metrics_path, "w") as f:
+        json.dump(metrics, f)
+
+    outputs = namedtuple('Outputs', ['cache', 'key'])
+    return outputs('hit' if hit else 'miss', key)
+
+
+def store_eval_results(results_dir: str, key: str, cache_dir: str):
+    from model_storage import ModelCache
+
+    ModelCache(cache_dir).store('eval', 'eval', key, results_dir)
+
+
+def upload_model(model_path: str, name: str,
+                 mlpipeline_metrics_path: OutputPath('Metrics'),
+                 sync: bool = True, layout: str = "plain",
+                 max_concurrency: int = 10, file_concurrency: int = 4,
+                 multipart_chunksize_mb: int = 64):
+    from model_storage import ModelStorage
+
+    print('Starting results upload.')
+    storage = ModelStorage(max_concurrency, file_concurrency,
+                           multipart_chunksize_mb)
+    storage.upload(model_path, name, sync, layout)
+    storage.metrics.write(mlpipeline_metrics_path)
+
+
+download_op = comp.create_component_from_func(download_model,
+                                              packages_to_install=[],
+                                              base_image=STORAGE_IMAGE)
+# The storage image is the same python-311 one, plus model_storage for the
+# step memoization
+quant_gpu_op = comp.create_component_from_func(quantize_gpu_model,
+                                               packages_to_install=["datasets", "auto-gptq==0.7.1", "torch==2.2.1", "sentencepiece"],
+                                               base_image=STORAGE_IMAGE)
+export_op = comp.create_component_from_func(export_model,
+                                            packages_to_install=[],
+                                            base_image='quay.io/ltomasbo/neural-magic:sparseml')
+cpu_eval_op = comp.create_component_from_func(cpu_eval_model,
+                                              packages_to_install=[],
+                                              base_image='quay.io/ltomasbo/neural-magic:sparseml_eval')
+gpu_eval_op = comp.create_component_from_func(gpu_eval_model,
+                                              packages_to_install=[],
+                                              base_image='quay.io/ltomasbo/neural-magic:nm_vllm_eval')
+merge_eval_op = comp.create_component_from_func(merge_eval_results,
+                                                packages_to_install=[],
+                                                base_image='quay.io/ltomasbo/neural-magic:base_eval')
+# The eval cache key has the harness version, so the lookups run on the image
+# of the eval they cache
+lookup_cpu_eval_op = comp.create_component_from_func(lookup_eval_results,
+                                                     packages_to_install=[],
+                                                     base_image='quay.io/ltomasbo/neural-magic:sparseml_eval')
+lookup_gpu_eval_op = comp.create_component_from_func(lookup_eval_results,
+                                                     packages_to_install=[],
+                                                     base_image='quay.io/ltomasbo/neural-magic:nm_vllm_eval')
+lookup_base_eval_op = comp.create_component_from_func(lookup_eval_results,
+                                                      packages_to_install=[],
+                                                      base_image='quay.io/ltomasbo/neural-magic:base_eval')
+store_eval_op = comp.create_component_from_func(store_eval_results,
+                                                packages_to_install=[],
+                                                base_image=STORAGE_IMAGE)
+upload_op = comp.create_component_from_func(upload_model,
+                                            packages_to_install=[],
+                                            base_image=STORAGE_IMAGE)
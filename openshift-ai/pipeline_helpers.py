@@ -0,0 +1,218 @@
+"""Compile time helpers shared by the pipeline definitions."""
+import inspect
+import re
+
+import kfp.components as comp
+import kfp.dsl as dsl
+from kfp_tekton.k8s_client_helper import env_from_secret
+
+from resource_model import stage_resources
+
+# Image with model_storage.py and its dependencies, see storage_Dockerfile
+STORAGE_IMAGE = 'quay.io/ltomasbo/neural-magic:storage'
+
+# Folder of the shared volume the steps write their telemetry to
+TELEMETRY_DIR = '/mnt/models/telemetry'
+# stage_telemetry.py, in every image the steps run on, see the Dockerfiles
+TELEMETRY_SCRIPT = '/opt/nm/stage_telemetry.py'
+
+
+def add_data_connection(task, secret_name):
+    """Expose the data connection secret as the s3_* env vars of the task."""
+    for env_name, secret_key in (('s3_access_key', 'AWS_ACCESS_KEY_ID'),
+                                 ('s3_secret_access_key', 'AWS_SECRET_ACCESS_KEY'),
+                                 ('s3_host', 'AWS_S3_ENDPOINT'),
+                                 ('s3_bucket', 'AWS_S3_BUCKET')):
+        task.add_env_variable(env_from_secret(env_name, secret_name,
+                                              secret_key))
+    return task
+
+
+def branch(condition):
+    """Build the body of a dsl.Condition once, or not at all.
+
+    When the pipeline is specialized (see specialize) the condition may be
+    known at compile time: the body is then built unconditionally when it
+    holds, and left out otherwise, instead of becoming a condition task. It
+    is used as a loop, so it reads as the with block it replaces:
+
+        for _ in branch(quantize == True):
+            quant_llm = quant_cpu_op(...)
+    """
+    if isinstance(condition, bool):
+        if condition:
+            yield
+        return
+    with dsl.Condition(condition):
+        yield
+
+
+def specialize(pipeline_func, **fixed):
+    """pipeline_func with the fixed parameters set at compile time.
+
+    They are no longer pipeline parameters, and the branches of the
+    pipeline written with branch that depend on them are resolved, so the
+    compiled pipeline only has the tasks the combination runs.
+    """
+    signature = inspect.signature(pipeline_func)
+    unknown = set(fixed) - set(signature.parameters)
+    if unknown:
+        raise ValueError(f'{pipeline_func.__name__} has no parameters '
+                         f'{", ".join(sorted(unknown))}')
+    reduced = signature.replace(parameters=[
+        parameter for parameter in signature.parameters.values()
+        if parameter.name not in fixed])
+
+    def specialized(*args, **kwargs):
+        return pipeline_func(**reduced.bind(*args, **kwargs).arguments,
+                             **fixed)
+
+    specialized.__signature__ = reduced
+    specialized.__name__ = pipeline_func.__name__
+    settings = ', '.join(f'{name}={value}' for name, value in fixed.items())
+    name = getattr(pipeline_func, '_component_human_name',
+                   pipeline_func.__name__)
+    return dsl.pipeline(
+        name=f'{name} ({settings})',
+        description=getattr(pipeline_func, '_component_description', None),
+    )(specialized)
+
+
+def parse_params(pipeline_func, arguments):
+    """The name=value arguments, as values of the pipeline_func parameters."""
+    parameters = inspect.signature(pipeline_func).parameters
+    params = {}
+    for argument in arguments:
+        name, _, value = argument.partition('=')
+        if name not in parameters or not _:
+            raise ValueError(f'Expected name=value, with one of '
+                             f'{", ".join(parameters)} as name, got {argument}')
+        annotation = parameters[name].annotation
+        if annotation is bool:
+            value = value.lower() in ('true', '1', 'yes')
+        elif annotation in (int, float):
+            value = annotation(value)
+        params[name] = value
+    return params
+
+
+def add_telemetry(op):
+    """Record the resources the step uses, see stage_telemetry.py.
+
+    Meant as an op transformer of the pipeline, for all its steps:
+
+        dsl.get_pipeline_conf().add_op_transformer(add_telemetry)
+
+    The script is baked into the images, at TELEMETRY_SCRIPT, with the
+    steps importing its mark from there, so every step runs on one of the
+    images built from the Dockerfiles of this folder. The telemetry goes to
+    TELEMETRY_DIR when the step mounts the shared volume, and to the log.
+    """
+    output_dir = TELEMETRY_DIR if '/mnt/models' in op.pvolumes else ''
+    stage = re.sub(r'[^a-z0-9]+', '-', op.human_name.lower()).strip('-')
+    op.container.command = [
+        'python3', '-u', TELEMETRY_SCRIPT,
+        '--stage', stage, '--task', op.name,
+        '--run', '{{workflow.name}}', '--output-dir', output_dir,
+        '--'] + list(op.container.command)
+    return op
+
+
+def add_resources(task, stage, profile=None, gpus=0, **calibration):
+    """Request the GPUs, CPUs and memory stage needs, see resource_model.
+
+    With the profile of the model, when it is known at compile time, they
+    come from the cost model, for the calibration (samples and seq_len)
+    when it is known too. Without it, the task only gets the fixed gpus.
+    """
+    if profile is None:
+        resources = None
+    else:
+        calibration = {name: value for name, value in calibration.items()
+                       if isinstance(value, int)}
+        resources = stage_resources(profile, stage, **calibration)
+        gpus = resources.gpus
+    if gpus:
+        task.add_resource_request('nvidia.com/gpu', str(gpus))
+        task.add_resource_limit('nvidia.com/gpu', str(gpus))
+    if resources:
+        # Requests only, the cost model is an estimate, not a hard limit
+        task.add_resource_request('cpu', str(resources.cpu))
+        task.add_resource_request('memory', f'{resources.memory_gib}Gi')
+    return task
+
+
+def shard_indexes(num_shards: int) -> list:
+    return list(range(num_shards))
+
+
+shard_indexes_op = comp.create_component_from_func(shard_indexes,
+                                                   packages_to_install=[],
+                                                   base_image=STORAGE_IMAGE)
+
+
+def add_eval(eval_op, merge_op, predecessor, vol, gpu_toleration,
+             results_dir, num_shards=1, profile=None, **eval_args):
+    """Add eval_op fanned out over num_shards GPU workers.
+
+    Every worker evaluates its share of the documents of every task, and
+    merge_op weights their results into the scores of the whole tasks, see
+    lm_eval_shards.py, written to results_dir/results.json. The workers
+    are sized for the model of profile, see add_resources. num_shards is
+    either fixed at compile time or a pipeline parameter, the workers then
+    being a loop over its shard indexes. Returns the merge task, for the
+    ones that have to run after the eval.
+    """
+    def add_worker(shard):
+        eval_llm = eval_op(**eval_args, shard=shard, num_shards=num_shards,
+                           results_dir=results_dir)
+        eval_llm.add_pvolumes({"/mnt/models": vol})
+        eval_llm.add_node_selector_constraint(
+            label_name='nvidia.com/gpu.present', value='true')
+        eval_llm.add_toleration(gpu_toleration)
+        add_resources(eval_llm, 'eval', profile, gpus=1)
+        eval_llm.after(predecessor)
+        return eval_llm
+
+    if isinstance(num_shards, int):
+        evals = [add_worker(shard) for shard in range(num_shards)]
+    else:
+        shards = shard_indexes_op(num_shards)
+        shards.after(predecessor)
+        with dsl.ParallelFor(shards.output) as shard:
+            evals = [add_worker(shard)]
+
+    merge_llm = merge_op(results_dir=results_dir, num_shards=num_shards)
+    merge_llm.add_pvolumes({"/mnt/models": vol})
+    for eval_llm in evals:
+        merge_llm.after(eval_llm)
+    return merge_llm
+
+
+def add_cached_eval(lookup_op, store_op, eval_op, merge_op, predecessor, vol,
+                    gpu_toleration, results_dir, cache_dir, num_shards=1,
+                    profile=None, **eval_args):
+    """Add eval_op as add_eval does, reusing the scores of earlier runs.
+
+    lookup_op keys the results by the model content, the eval settings and
+    the harness version of its image, which must be the one of eval_op, and
+    exposes the cached ones at results_dir. The eval, and store_op caching
+    its results, only run on a miss. Returns the lookup and store tasks, the
+    scores are in results_dir after both.
+    """
+    lookup = lookup_op(model_path=eval_args['model_path'],
+                       tasks=eval_args['tasks'], results_dir=results_dir,
+                       cache_dir=cache_dir,
+                       num_fewshot=eval_args.get('num_fewshot', 0),
+                       limit=eval_args.get('limit', ""))
+    lookup.add_pvolumes({"/mnt/models": vol})
+    lookup.after(predecessor)
+
+    with dsl.Condition(lookup.outputs['cache'] == 'miss'):
+        eval_llm = add_eval(eval_op, merge_op, lookup, vol, gpu_toleration,
+                            results_dir, num_shards, profile, **eval_args)
+        store = store_op(results_dir=results_dir,
+                         key=lookup.outputs['key'], cache_dir=cache_dir)
+        store.add_pvolumes({"/mnt/models": vol})
+        store.after(eval_llm)
+    return lookup, store
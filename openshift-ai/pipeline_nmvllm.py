@@ -1,7 +1,17 @@
+import sys
+
 import kfp.dsl as dsl
 import kfp.components as comp
 from kfp_tekton.compiler import TektonCompiler
-from kfp_tekton.k8s_client_helper import env_from_secret
+
+from pipeline_components import (cpu_eval_op, download_op, export_op,
+                                 gpu_eval_op, lookup_cpu_eval_op,
+                                 lookup_gpu_eval_op, merge_eval_op,
+                                 quant_gpu_op, store_eval_op, upload_op)
+from pipeline_helpers import (add_cached_eval, add_data_connection, add_eval,
+                              add_resources, add_telemetry, branch,
+                              parse_params, specialize)
+from resource_model import model_profile
 
 from kubernetes.client import V1Volume, V1PersistentVolumeClaimVolumeSource, V1Toleration
 
@@ -10,75 +20,31 @@ MODEL_DIR = BASE_DIR + "llm"
 SPARSE_MODEL_DIR = BASE_DIR + "sparse-llm"
 QUANT_MODEL_DIR = BASE_DIR + "quant-llm"
 EXPORTED_MODEL_DIR = BASE_DIR + "exported"
+EVAL_DIR = BASE_DIR + "eval/"
+CACHE_DIR = BASE_DIR + "cache"
 
 
-def download_model(model_name: str, destination_path: str,
-                   download_option: str):
-    if download_option == "HF":
-        import subprocess
-        print('Starting downloading the model from HF')
-        # Execute the huggingface_hub-cli command
-        result = subprocess.run(["huggingface-cli", "download", model_name,
-                                 "--local-dir", destination_path,
-                                 "--local-dir-use-symlinks", "False"],
-                                capture_output=True, text=True)
-        # Check for errors or output
-        if result.returncode == 0:
-            print("Model downloaded successfully from HF.")
-        else:
-            print("Error downloading model:")
-            print(result.stderr)
-
-    elif download_option == "S3":
-        import os
-        import errno
-        from boto3 import client
-
-        print('Starting downloading the model from S3')
- 
-        s3_endpoint_url = os.environ["s3_host"]
-        s3_access_key = os.environ["s3_access_key"]
-        s3_secret_key = os.environ["s3_secret_access_key"]
-        s3_bucket_name = os.environ["s3_bucket"]
-
-        s3_client = client(
-            's3', endpoint_url=s3_endpoint_url, aws_access_key_id=s3_access_key,
-            aws_secret_access_key=s3_secret_key, verify=False
-        )
-
-        # list all objects in the folder
-        objects = s3_client.list_objects(Bucket=s3_bucket_name, Prefix=model_name)
-
-        # download each object in the folder
-        for object in objects['Contents']:
-            file_name = object['Key']
-            local_file_name = os.path.join(destination_path, file_name.replace(model_name, '')[1:])
-            if not os.path.exists(os.path.dirname(local_file_name)):
-                try:
-                    os.makedirs(os.path.dirname(local_file_name))
-                except OSError as exc: # Guard against race condition
-                    if exc.errno != errno.EEXIST:
-                        print("Error downloading model")
-                        raise
-            s3_client.download_file(s3_bucket_name, file_name, local_file_name)
-
-        print('Model downloaded successfully from S3.')
-    
-    elif download_option == "PVC":
-        print('Model should be already on the volumen.')
-
 def sparse_model(model_path:str, compress_model_path: str, ds: str,
-                 sparsity_ratio: float, sparsity_targets: str):
+                 sparsity_ratio: float, sparsity_targets: str,
+                 cache_dir: str = "", low_memory: bool = False):
+    import json
+    import os
+    import shutil
+
     import sparseml.transformers
     import torch
-
-    #set the data type of the model to bfloat16 and device_map="auto" which
-    # will place the model on all the gpus available in the system
-    model = sparseml.transformers.SparseAutoModelForCausalLM.from_pretrained(
-        model_path,
-        torch_dtype=torch.bfloat16,
-        device_map="auto"
-    )
+    from transformers import AutoTokenizer
+    from calibration_data import calibration_set
+    from model_storage import (folder_hash, library_versions, memoize_step,
+                               step_key)
+    from oneshot_checkpoints import resumable_oneshot
+    from sparsegpt import prune_model_streaming
+    from stage_telemetry import mark
+
+    # Calibration samples, as many and as long as SparseML takes by default
+    NUM_CALIBRATION_SAMPLES = 512
+    MAX_SEQ_LEN = 384
+    SEED = 42
 
     recipe = f"""
     test_stage:
@@ -89,18 +55,95 @@ def sparse_model(model_path:str, compress_model_path: str, ds: str,
           sequential_update: true
           targets: {sparsity_targets}
     """
+    # low_memory is part of the key too: the streamed run shards its output
+    # per layer and may run on another device, so neither its output nor its
+    # checkpoints are interchangeable with the in memory ones
+    inputs = dict(model=folder_hash(model_path), recipe=recipe, dataset=ds,
+                  num_samples=NUM_CALIBRATION_SAMPLES, max_seq_len=MAX_SEQ_LEN,
+                  seed=SEED, low_memory=low_memory,
+                  versions=library_versions('sparseml', 'torch',
+                                            'transformers'))
+    # On the shared volume, so a retried pod resumes from the last layer
+    checkpoint_dir = f"{compress_model_path}-checkpoints"
+
+    def compress(output_dir):
+        if low_memory:
+            mark('calibration')
+            # Tokenized once and kept in the model cache, see calibration_data
+            calibration = calibration_set(model_path, ds,
+                                          NUM_CALIBRATION_SAMPLES, MAX_SEQ_LEN,
+                                          seed=SEED,
+                                          path=f"{compress_model_path}-calibration",
+                                          cache_dir=cache_dir)
+            mark('oneshot')
+            # The layers are read from the safetensors and written to the
+            # output one at a time, the model is never loaded whole
+            prune_model_streaming(model_path, output_dir,
+                                  calibration.examples(), sparsity_ratio,
+                                  json.loads(sparsity_targets),
+                                  checkpoint_dir=checkpoint_dir,
+                                  checkpoint_key=step_key(**inputs),
+                                  dtype=torch.bfloat16)
+            mark('save')
+            AutoTokenizer.from_pretrained(model_path).save_pretrained(
+                output_dir)
+            with open(os.path.join(output_dir, "recipe.yaml"), "w") as f:
+                f.write(recipe)
+            shutil.rmtree(checkpoint_dir)
+            return
+
+        mark('load_model')
+        #set the data type of the model to bfloat16 and device_map="auto" which
+        # will place the model on all the gpus available in the system
+        model = sparseml.transformers.SparseAutoModelForCausalLM.from_pretrained(
+            model_path,
+            torch_dtype=torch.bfloat16,
+            device_map="auto"
+        )
 
-    sparseml.transformers.oneshot(
-        model=model,
-        dataset=ds,
-        recipe=recipe,
-        output_dir=compress_model_path,
-    )
-
-def quantize_cpu_model(model_path:str, compress_model_path: str, ds: str):
+        mark('calibration')
+        # Formatted once and kept in the model cache, so SparseML only
+        # tokenizes the samples instead of the whole dataset
+        calibration = calibration_set(model_path, ds,
+                                      NUM_CALIBRATION_SAMPLES, MAX_SEQ_LEN,
+                                      seed=SEED,
+                                      path=f"{compress_model_path}-calibration",
+                                      cache_dir=cache_dir)
+        mark('oneshot')
+        # Every compressed layer is checkpointed, and a retried pod resumes
+        # after the last one, see oneshot_checkpoints.py
+        with resumable_oneshot(checkpoint_dir, step_key(**inputs)):
+            sparseml.transformers.oneshot(
+                model=model,
+                dataset=calibration.dataset(),
+                recipe=recipe,
+                output_dir=output_dir,
+                num_calibration_samples=len(calibration),
+                max_seq_length=MAX_SEQ_LEN,
+            )
+        shutil.rmtree(checkpoint_dir)
+
+    if not cache_dir:
+        compress(compress_model_path)
+        return
+    # Reuse the output of an earlier run with the same model, recipe,
+    # dataset and libraries instead of compressing again
+    memoize_step('sparse_model', compress_model_path, compress, cache_dir,
+                 **inputs)
+
+def quantize_cpu_model(model_path:str, compress_model_path: str, ds: str,
+                       cache_dir: str = "", weight_strategy: str = "channel"):
     import sparseml.transformers
+    from calibration_data import calibration_set
+    from model_storage import folder_hash, library_versions, memoize_step
+    from stage_telemetry import mark
+
+    # Calibration samples, as many and as long as SparseML takes by default
+    NUM_CALIBRATION_SAMPLES = 512
+    MAX_SEQ_LEN = 384
+    SEED = 42
 
-    recipe = """
+    recipe = f"""
     test_stage:
       obcq_modifiers:
         LogarithmicEqualizationModifier:
@@ -118,12 +161,12 @@ def quantize_cpu_model(model_path:str, compress_model_path: str, ds: str):
             - MatMulOutput_PV
           post_oneshot_calibration: true
           scheme_overrides:
-            # Enable channelwise quantization for better accuracy
+            # Channelwise quantization by default, for better accuracy
             Linear:
               weights:
                 num_bits: 8
                 symmetric: true
-                strategy: channel
+                strategy: {weight_strategy}
             MatMulLeftInput_QK:
               input_activations:
                 num_bits: 8
@@ -165,183 +208,139 @@ def quantize_cpu_model(model_path:str, compress_model_path: str, ds: str):
     #             symmetric: false
     # """
 
-    model = sparseml.transformers.SparseAutoModelForCausalLM.from_pretrained(
-        model_path, device_map="auto")
-
-    sparseml.transformers.oneshot(
-        model=model,
-        dataset=ds,
-        recipe=recipe,
-        output_dir=compress_model_path,
-    )
-
-def quantize_gpu_model(model_path:str, compress_model_path: str, ds: str):
-    # Quantizing an LLM
-    from transformers import AutoTokenizer
-    from datasets import load_dataset
-
-    from auto_gptq import AutoGPTQForCausalLM, BaseQuantizeConfig
-
-    MAX_SEQ_LEN = 512
-    NUM_EXAMPLES = 512
-
-    def preprocess(example):
-        return {"text": tokenizer.apply_chat_template(example["messages"],
-                                                      tokenize=False)}
-
-    print("Loading the dataset and tokenizers")
-    dataset = load_dataset(ds, split="train_sft")
-    #dataset = load_dataset(ds, split="train")
-    #dataset = load_dataset(ds, split="test")
-    tokenizer = AutoTokenizer.from_pretrained(model_path)
-    ds = dataset.shuffle().select(range(NUM_EXAMPLES))
-    ds = ds.map(preprocess)
-
-    examples = [
-        tokenizer(
-            example["text"], padding=False, max_length=MAX_SEQ_LEN,
-            truncation=True,
-        ) for example in ds
-    ]
-
-    print("Loaded the dataset and tokenizers")
-    print("Starting the quantization")
-
-    # Apply GPTQ
-    quantize_config = BaseQuantizeConfig(
-        bits=4,                         # Only support 4 bit
-        group_size=128,                 # Set to g=128 or -1 (for channelwise)
-        desc_act=False,                 # Marlin does not support act_order=True
-        model_file_base_name="model",   # Name of the model.safetensors when we call save_pretrained
-    )
-    print("Applying GPTQ for quantization")
-
-    model = AutoGPTQForCausalLM.from_pretrained(
-        model_path,
-        quantize_config,
-        device_map="auto")
-    model.quantize(examples)
-
-    gptq_save_dir = f"{model_path}-gptq"
-    print(f"Saving gptq model to {gptq_save_dir}")
-    model.save_pretrained(gptq_save_dir)
-    tokenizer.save_pretrained(gptq_save_dir)
-
-    # Convert to Marlin
-    print("Reloading in marlin format")
-    marlin_model = AutoGPTQForCausalLM.from_quantized(
-        gptq_save_dir,
-        use_marlin=True,
-        device_map="auto")
-
-    print(f"Saving model in marlin format to {compress_model_path}")
-    marlin_model.save_pretrained(compress_model_path)
-    tokenizer.save_pretrained(compress_model_path)
-
-    print("Quantization process completed")
-
-def export_model(model_path: str, exported_model_path: str):
-    from sparseml import export
-
-    export(
-        model_path,
-        task="text-generation",
-        sequence_length=1024,
-        target_path=exported_model_path
-    )
-
-
-def cpu_eval_model(model_path: str, tasks: str, batch_size: str):
-    import subprocess
-    import os
-
-    model_args = "pretrained=" + model_path  # + ",trust_remote_code=True"
-
-    # Execute the huggingface_hub-cli command
-    env = os.environ.copy()
-    env["CUDA_VISIBLE_DEVICES"] = "0"
-    result = subprocess.run(["python", "./lm-evaluation-harness/main.py",
-                             "--model", "sparseml",
-                             "--model_args", model_args,
-                             "--tasks", tasks,
-                             "--batch_size", batch_size,
-                             "--no_cache",
-                             "--write_out",
-                             "--device", "cuda:0",
-                             "--num_fewshot", "0"],
-                            capture_output=True, text=True, env=env)
-
-    # Check for errors or output
-    if result.returncode == 0:
-        print("Model evaluated successfully:")
-        print(result.stdout)
-    else:
-        print("Error evaluating the model:")
-        print(result.stderr)
-
-def gpu_eval_model(model_path: str, tasks: str, batch_size: str, sparse: bool=False):
-    import subprocess
-    import os
-
-    if sparse:
-        model_args = "pretrained=" + model_path + ",sparsity=sparse_w16a16"  # + ",trust_remote_code=True"
-    else:
-        model_args = "pretrained=" + model_path  + ",tensor_parallel_size=1"  # + ",trust_remote_code=True"
-
-    # Execute the huggingface_hub-cli command
-    env = os.environ.copy()
-    env["CUDA_VISIBLE_DEVICES"] = "0"
-    result = subprocess.run(["lm_eval",
-                             "--model", "vllm",
-                             "--model_args", model_args,
-                             "--tasks", tasks,
-                             "--batch_size", batch_size,
-                             "--write_out",
-                             "--num_fewshot", "0"],
-                            capture_output=True, text=True, env=env)
-
-    # Check for errors or output
-    if result.returncode == 0:
-        print("Model evaluated successfully:")
-        print(result.stdout)
-    else:
-        print("Error evaluating the model:")
-        print(result.stderr)
-
-
-def upload_model(model_path: str, name: str):
-    import os
-    from boto3 import client
-
-    print('Starting results upload.')
-    s3_endpoint_url = os.environ["s3_host"]
-    s3_access_key = os.environ["s3_access_key"]
-    s3_secret_key = os.environ["s3_secret_access_key"]
-    s3_bucket_name = os.environ["s3_bucket"]
+    def compress(output_dir):
+        mark('load_model')
+        model = sparseml.transformers.SparseAutoModelForCausalLM.from_pretrained(
+            model_path, device_map="auto")
+
+        mark('calibration')
+        # Formatted once and kept in the model cache, so SparseML only
+        # tokenizes the samples instead of the whole dataset
+        calibration = calibration_set(model_path, ds,
+                                      NUM_CALIBRATION_SAMPLES, MAX_SEQ_LEN,
+                                      seed=SEED,
+                                      path=f"{compress_model_path}-calibration",
+                                      cache_dir=cache_dir)
+        mark('oneshot')
+        sparseml.transformers.oneshot(
+            model=model,
+            dataset=calibration.dataset(),
+            recipe=recipe,
+            output_dir=output_dir,
+            num_calibration_samples=len(calibration),
+            max_seq_length=MAX_SEQ_LEN,
+        )
 
-    print(f'Uploading predictions to bucket {s3_bucket_name} '
-          f'to S3 storage at {s3_endpoint_url}')
+    if not cache_dir:
+        compress(compress_model_path)
+        return
+    # Reuse the output of an earlier run with the same model, recipe,
+    # dataset and libraries instead of compressing again
+    memoize_step('quantize_cpu_model', compress_model_path, compress, cache_dir,
+                 model=folder_hash(model_path), recipe=recipe, dataset=ds,
+                 num_samples=NUM_CALIBRATION_SAMPLES, max_seq_len=MAX_SEQ_LEN,
+                 seed=SEED,
+                 versions=library_versions('sparseml', 'torch', 'transformers'))
+
+def sparse_quantize_cpu_model(model_path:str, compress_model_path: str,
+                              ds: str, sparsity_ratio: float,
+                              sparsity_targets: str, cache_dir: str = "",
+                              weight_strategy: str = "channel"):
+    import sparseml.transformers
+    import torch
+    from calibration_data import calibration_set
+    from model_storage import folder_hash, library_versions, memoize_step
+    from stage_telemetry import mark
+
+    # Calibration samples, as many and as long as SparseML takes by default
+    NUM_CALIBRATION_SAMPLES = 512
+    MAX_SEQ_LEN = 384
+    SEED = 42
+
+    # The quantization modifiers of quantize_cpu_model and SparseGPT in a
+    # single recipe, so the model is loaded, calibrated and written once. SparseGPT prunes and quantizes every layer in the
+    # same pass, compensating the quantization error too
+    recipe = f"""
+    test_stage:
+      obcq_modifiers:
+        LogarithmicEqualizationModifier:
+          mappings: [
+            [["re:.*q_proj", "re:.*k_proj", "re:.*v_proj"], "re:.*input_layernorm"],
+            [["re:.*gate_proj", "re:.*up_proj"], "re:.*post_attention_layernorm"],
+          ]
+        QuantizationModifier:
+          ignore:
+            # These operations don't make sense to quantize
+            - LlamaRotaryEmbedding
+            - LlamaRMSNorm
+            - SiLUActivation
+            - MatMulOutput_QK
+            - MatMulOutput_PV
+          post_oneshot_calibration: true
+          scheme_overrides:
+            # Channelwise quantization by default, for better accuracy
+            Linear:
+              weights:
+                num_bits: 8
+                symmetric: true
+                strategy: {weight_strategy}
+            MatMulLeftInput_QK:
+              input_activations:
+                num_bits: 8
+                symmetric: true
+            # For the embeddings, only weight-quantization makes sense
+            Embedding:
+              input_activations: null
+              weights:
+                num_bits: 8
+                symmetric: false
+        SparseGPTModifier:
+          sparsity: {sparsity_ratio}
+          sequential_update: true
+          quantize: true
+          targets: {sparsity_targets}
+    """
 
-    s3_client = client(
-        's3', endpoint_url=s3_endpoint_url, aws_access_key_id=s3_access_key,
-        aws_secret_access_key=s3_secret_key, verify=False
-    )
+    def compress(output_dir):
+        mark('load_model')
+        # set the data type of the model to bfloat16 and device_map="auto" which
+        # will place the model on all the gpus available in the system
+        model = sparseml.transformers.SparseAutoModelForCausalLM.from_pretrained(
+            model_path,
+            torch_dtype=torch.bfloat16,
+            device_map="auto"
+        )
 
-    # Walk through the local folder and upload files
-    for root, dirs, files in os.walk(model_path):
-        for file in files:
-            local_file_path = os.path.join(root, file)
-            #s3_file_path = os.path.join(s3_bucket_name, local_file_path[len(model_path)+1:])
-            s3_file_path = os.path.join(name, local_file_path[len(model_path)+1:])
-            s3_client.upload_file(local_file_path, s3_bucket_name, s3_file_path)
-            print(f'Uploaded {local_file_path}')
+        mark('calibration')
+        # Formatted once and kept in the model cache, so SparseML only
+        # tokenizes the samples instead of the whole dataset
+        calibration = calibration_set(model_path, ds,
+                                      NUM_CALIBRATION_SAMPLES, MAX_SEQ_LEN,
+                                      seed=SEED,
+                                      path=f"{compress_model_path}-calibration",
+                                      cache_dir=cache_dir)
+        mark('oneshot')
+        sparseml.transformers.oneshot(
+            model=model,
+            dataset=calibration.dataset(),
+            recipe=recipe,
+            output_dir=output_dir,
+            num_calibration_samples=len(calibration),
+            max_seq_length=MAX_SEQ_LEN,
+        )
 
-    print('Finished uploading results.')
+    if not cache_dir:
+        compress(compress_model_path)
+        return
+    # Reuse the output of an earlier run with the same model, recipe,
+    # dataset and libraries instead of compressing again
+    memoize_step('sparse_quantize_cpu_model', compress_model_path, compress,
+                 cache_dir, model=folder_hash(model_path), recipe=recipe,
+                 dataset=ds, num_samples=NUM_CALIBRATION_SAMPLES,
+                 max_seq_len=MAX_SEQ_LEN, seed=SEED,
+                 versions=library_versions('sparseml', 'torch', 'transformers'))
 
 
-download_op = comp.create_component_from_func(download_model,
-                                              packages_to_install=["huggingface-hub", "boto3"],
-                                              base_image='registry.access.redhat.com/ubi9/python-311')
 sparse_op = comp.create_component_from_func(sparse_model,
                                             packages_to_install=["datasets", "sentencepiece"],
                                             base_image='quay.io/ltomasbo/neural-magic:sparseml')
@@ -350,191 +349,243 @@ quant_cpu_op = comp.create_component_from_func(quantize_cpu_model,
                                             packages_to_install=["datasets", "sentencepiece"],
                                             base_image='quay.io/ltomasbo/neural-magic:sparseml')
 #                                            base_image='quay.io/ltomasbo/sparseml')
-quant_gpu_op = comp.create_component_from_func(quantize_gpu_model,
-                                            packages_to_install=["datasets", "auto-gptq==0.7.1", "torch==2.2.1", "sentencepiece"],
-                                            base_image='registry.access.redhat.com/ubi9/python-311')
-export_op = comp.create_component_from_func(export_model,
-                                            packages_to_install=[],
-                                            base_image='quay.io/ltomasbo/neural-magic:sparseml')
-#                                            base_image='quay.io/ltomasbo/sparseml')
-cpu_eval_op = comp.create_component_from_func(cpu_eval_model,
-                                          packages_to_install=[],
-                                          base_image='quay.io/ltomasbo/neural-magic:sparseml_eval')
-#                                          base_image='quay.io/ltomasbo/sparseml:eval2')
-gpu_eval_op = comp.create_component_from_func(gpu_eval_model,
-                                          packages_to_install=[],
-                                          base_image='quay.io/ltomasbo/neural-magic:nm_vllm_eval')
-#                                          base_image='quay.io/ltomasbo/sparseml:eval2')
-upload_op = comp.create_component_from_func(upload_model,
-                                            packages_to_install=["boto3"],
-                                            base_image='registry.access.redhat.com/ubi9/python-311')
-
-
-def cpu_model_optimization(predecing_task:object, model_path:str,
-                           sparse:bool, quantize:bool,
+sparse_quant_cpu_op = comp.create_component_from_func(sparse_quantize_cpu_model,
+                                                   packages_to_install=["datasets", "sentencepiece"],
+                                                   base_image='quay.io/ltomasbo/neural-magic:sparseml')
+
+
+def target_dir(path:str, target:str):
+    """The folder of path for the steps of target, when both targets run."""
+    return f'{path}-{target}' if target else path
+
+
+def eval_dir(model_path:str, target:str):
+    """The results folder of the evals of model_path, apart for target."""
+    return model_path.replace(BASE_DIR,
+                              EVAL_DIR + (f'{target}/' if target else ''))
+
+
+def add_sparse(predecing_task:object, ds:str, sparsity_ratio:float,
+               sparsity_targets:str, low_memory:bool, vol:object,
+               gpu_toleration:object, profile:object):
+    sparse_llm = sparse_op(model_path=MODEL_DIR,
+                           compress_model_path=SPARSE_MODEL_DIR,
+                           ds=ds,
+                           sparsity_ratio=sparsity_ratio,
+                           sparsity_targets=sparsity_targets,
+                           cache_dir=CACHE_DIR,
+                           low_memory=low_memory)
+    sparse_llm.add_pvolumes({"/mnt/models": vol})
+    if low_memory is True:
+        # Fixed at compile time, the layers are streamed through the
+        # CPU of any node
+        add_resources(sparse_llm, 'sparse_low_memory', profile,
+                      samples=512, seq_len=384)
+    else:
+        sparse_llm.add_node_selector_constraint(
+            label_name='nvidia.com/gpu.present', value='true')
+        sparse_llm.add_toleration(gpu_toleration)
+        add_resources(sparse_llm, 'sparse', profile, gpus=3, samples=512,
+                      seq_len=384)
+    # Preempted or OOM killed pods resume from their last pruned layer
+    sparse_llm.set_retry(2)
+    sparse_llm.after(predecing_task)
+    return sparse_llm
+
+
+def cpu_model_optimization(predecing_task:object,
+                           sparse:bool, quantize:bool, fused:bool,
+                           sparsity_ratio:float, sparsity_targets:str,
+                           weight_strategy:str, low_memory:bool,
                            eval:bool, eval_task:str, eval_batch_size:str,
-                           save_model:bool, save_folder_name:str,
-                           vol:object, gpu_toleration:object):
-    quant_llm = None
-    export_llm = None
-    upload_pruned_llm = None
-
+                           eval_shards:int, save_model:bool,
+                           save_folder_name:str, export_shapes:dict,
+                           vol:object, gpu_toleration:object, profile:object,
+                           sparse_llm:object=None, target:str=''):
     #ds = "openai_humaneval"
     ds = "open_platypus"
-
-    with dsl.Condition(quantize == True):
-        quant_llm = quant_cpu_op(model_path=model_path,
-                                 compress_model_path=QUANT_MODEL_DIR,
-                                 ds=ds)
-        quant_llm.add_pvolumes({"/mnt/models": vol})
-        quant_llm.add_node_selector_constraint(
-            label_name='nvidia.com/gpu.present', value='true')
-        quant_llm.add_toleration(gpu_toleration)
-        quant_llm.add_resource_request('nvidia.com/gpu', "2")
-        quant_llm.add_resource_limit('nvidia.com/gpu', "2")
-        quant_llm.after(predecing_task)
-
-        with dsl.Condition(eval == True):
-            eval_llm = cpu_eval_op(model_path=QUANT_MODEL_DIR, tasks=eval_task,
-                               batch_size=eval_batch_size)
-            eval_llm.add_pvolumes({"/mnt/models": vol})
-            eval_llm.add_node_selector_constraint(
-                label_name='nvidia.com/gpu.present', value='true')
-            eval_llm.add_toleration(gpu_toleration)
-            eval_llm.add_resource_request('nvidia.com/gpu', "1")
-            eval_llm.add_resource_limit('nvidia.com/gpu', "1")
-            eval_llm.after(quant_llm)
-
-        export_llm = export_op(model_path=QUANT_MODEL_DIR,
-                               exported_model_path=EXPORTED_MODEL_DIR)
-        export_llm.add_pvolumes({"/mnt/models": vol})
-        export_llm.after(quant_llm)
-
-        with dsl.Condition(save_model == True):
-            upload_pruned_llm = upload_op(model_path=EXPORTED_MODEL_DIR,
-                                          name=save_folder_name)
-            upload_pruned_llm.add_env_variable(env_from_secret(
-                's3_access_key', 'aws-connection-models', 'AWS_ACCESS_KEY_ID'))
-            upload_pruned_llm.add_env_variable(env_from_secret(
-                's3_secret_access_key', 'aws-connection-models',
-                'AWS_SECRET_ACCESS_KEY'))
-            upload_pruned_llm.add_env_variable(env_from_secret(
-                's3_host', 'aws-connection-models', 'AWS_S3_ENDPOINT'))
-            upload_pruned_llm.add_env_variable(env_from_secret(
-                's3_bucket', 'aws-connection-models', 'AWS_S3_BUCKET'))
-            upload_pruned_llm.add_pvolumes({"/mnt/models": vol})
-            upload_pruned_llm.after(export_llm)
-
-    with dsl.Condition(quantize == False):
-        with dsl.Condition(eval == True):
-            with dsl.Condition(sparse == True):
-                eval_llm = cpu_eval_op(model_path=model_path, tasks=eval_task,
-                                   batch_size=eval_batch_size)
-                eval_llm.add_pvolumes({"/mnt/models": vol})
-                eval_llm.add_node_selector_constraint(
+    quant_model_dir = target_dir(QUANT_MODEL_DIR, target)
+    if sparse_llm is not None:
+        # The sparse model is shared with the GPU deployment, so it is
+        # quantized on its own instead of pruning the model a second time
+        fused = False
+
+    for _ in branch(sparse == True):
+        for _ in branch(quantize == True):
+            for _ in branch(fused == True):
+                # Pruned and quantized with a single recipe, calibrating
+                # once, without writing the sparse model in between
+                quant_llm = sparse_quant_cpu_op(
+                    model_path=MODEL_DIR,
+                    compress_model_path=quant_model_dir,
+                    ds=ds,
+                    sparsity_ratio=sparsity_ratio,
+                    sparsity_targets=sparsity_targets,
+                    cache_dir=CACHE_DIR,
+                    weight_strategy=weight_strategy)
+                quant_llm.add_pvolumes({"/mnt/models": vol})
+                quant_llm.add_node_selector_constraint(
                     label_name='nvidia.com/gpu.present', value='true')
-                eval_llm.add_toleration(gpu_toleration)
-                eval_llm.add_resource_request('nvidia.com/gpu', "1")
-                eval_llm.add_resource_limit('nvidia.com/gpu', "1")
-                eval_llm.after(predecing_task)
-
-        export_llm = export_op(model_path=model_path,
-                               exported_model_path=EXPORTED_MODEL_DIR)
-        export_llm.add_pvolumes({"/mnt/models": vol})
-        export_llm.after(predecing_task)
-
-        with dsl.Condition(save_model == True):
-            upload_pruned_llm = upload_op(model_path=EXPORTED_MODEL_DIR,
-                                          name=save_folder_name)
-            upload_pruned_llm.add_env_variable(env_from_secret(
-                's3_access_key', 'aws-connection-models', 'AWS_ACCESS_KEY_ID'))
-            upload_pruned_llm.add_env_variable(env_from_secret(
-                's3_secret_access_key', 'aws-connection-models',
-                'AWS_SECRET_ACCESS_KEY'))
-            upload_pruned_llm.add_env_variable(env_from_secret(
-                's3_host', 'aws-connection-models', 'AWS_S3_ENDPOINT'))
-            upload_pruned_llm.add_env_variable(env_from_secret(
-                's3_bucket', 'aws-connection-models', 'AWS_S3_BUCKET'))
-            upload_pruned_llm.add_pvolumes({"/mnt/models": vol})
-            upload_pruned_llm.after(export_llm)
+                quant_llm.add_toleration(gpu_toleration)
+                add_resources(quant_llm, 'sparse_quantize_cpu', profile,
+                              gpus=2, samples=512, seq_len=384)
+                quant_llm.after(predecing_task)
+                cpu_deployment(quant_llm, quant_model_dir, True, eval,
+                               eval_task, eval_batch_size, eval_shards,
+                               save_model, save_folder_name, export_shapes,
+                               vol, gpu_toleration, profile, target)
+
+            for _ in branch(fused == False):
+                quant_llm = add_quantize_cpu(
+                    sparse_llm or add_sparse(predecing_task, ds,
+                                             sparsity_ratio, sparsity_targets,
+                                             low_memory, vol, gpu_toleration,
+                                             profile),
+                    SPARSE_MODEL_DIR, ds, weight_strategy, vol,
+                    gpu_toleration, profile, target)
+                cpu_deployment(quant_llm, quant_model_dir, True, eval,
+                               eval_task, eval_batch_size, eval_shards,
+                               save_model, save_folder_name, export_shapes,
+                               vol, gpu_toleration, profile, target)
+
+        for _ in branch(quantize == False):
+            cpu_deployment(sparse_llm or add_sparse(predecing_task, ds,
+                                                    sparsity_ratio,
+                                                    sparsity_targets,
+                                                    low_memory, vol,
+                                                    gpu_toleration, profile),
+                           SPARSE_MODEL_DIR, True, eval, eval_task,
+                           eval_batch_size, eval_shards, save_model,
+                           save_folder_name, export_shapes, vol,
+                           gpu_toleration, profile, target)
+
+    for _ in branch(sparse == False):
+        for _ in branch(quantize == True):
+            quant_llm = add_quantize_cpu(predecing_task, MODEL_DIR, ds,
+                                         weight_strategy, vol, gpu_toleration,
+                                         profile, target)
+            cpu_deployment(quant_llm, quant_model_dir, True, eval, eval_task,
+                           eval_batch_size, eval_shards, save_model,
+                           save_folder_name, export_shapes, vol,
+                           gpu_toleration, profile, target)
+
+        for _ in branch(quantize == False):
+            # The base model, only exported
+            cpu_deployment(predecing_task, MODEL_DIR, False, eval, eval_task,
+                           eval_batch_size, eval_shards, save_model,
+                           save_folder_name, export_shapes, vol,
+                           gpu_toleration, profile, target)
+
+
+def add_quantize_cpu(predecing_task:object, model_path:str, ds:str,
+                     weight_strategy:str, vol:object, gpu_toleration:object,
+                     profile:object, target:str=''):
+    quant_llm = quant_cpu_op(model_path=model_path,
+                             compress_model_path=target_dir(QUANT_MODEL_DIR,
+                                                            target),
+                             ds=ds,
+                             cache_dir=CACHE_DIR,
+                             weight_strategy=weight_strategy)
+    quant_llm.add_pvolumes({"/mnt/models": vol})
+    quant_llm.add_node_selector_constraint(
+        label_name='nvidia.com/gpu.present', value='true')
+    quant_llm.add_toleration(gpu_toleration)
+    add_resources(quant_llm, 'quantize_cpu', profile, gpus=2,
+                  samples=512, seq_len=384)
+    quant_llm.after(predecing_task)
+    return quant_llm
+
+
+def cpu_deployment(predecing_task:object, model_path:str, evaluate:bool,
+                   eval:bool, eval_task:str, eval_batch_size:str,
+                   eval_shards:int, save_model:bool, save_folder_name:str,
+                   export_shapes:dict, vol:object, gpu_toleration:object,
+                   profile:object, target:str=''):
+    exported_model_dir = target_dir(EXPORTED_MODEL_DIR, target)
+    # evaluate is fixed at compile time, the base model is evaluated apart
+    if evaluate:
+        for _ in branch(eval == True):
+            add_eval(cpu_eval_op, merge_eval_op, predecing_task,
+                     vol, gpu_toleration,
+                     eval_dir(model_path, target),
+                     eval_shards, profile,
+                     model_path=model_path, tasks=eval_task,
+                     batch_size=eval_batch_size)
+
+    # Exported either way, the export step uploads the files itself while
+    # writing them when save_model is set
+    export_llm = export_op(model_path=model_path,
+                           exported_model_path=exported_model_dir,
+                           cache_dir=CACHE_DIR,
+                           upload_name=save_folder_name,
+                           upload=save_model,
+                           **export_shapes)
+    add_data_connection(export_llm, 'aws-connection-models')
+    export_llm.add_pvolumes({"/mnt/models": vol})
+    add_resources(export_llm, 'export', profile)
+    export_llm.after(predecing_task)
 
 
 def gpu_model_optimization(predecing_task:object, model_path:str,
                            sparse:bool, quantize:bool,
                            eval:bool, eval_task:str, eval_batch_size:str,
-                           save_model:bool, save_folder_name:str,
-                           vol:object, gpu_toleration:object):
+                           eval_shards:int, save_model:bool,
+                           save_folder_name:str, vol:object,
+                           gpu_toleration:object, num_examples:int,
+                           max_seq_len:int, profile:object, target:str=''):
     quant_llm = None
     upload_pruned_llm = None
+    quant_model_dir = target_dir(QUANT_MODEL_DIR, target)
 
     #ds = "openai_humaneval"
     ds = "HuggingFaceH4/ultrachat_200k"
     #ds = "garage-bAInd/Open-Platypus"
 
-    with dsl.Condition(quantize == True):
+    for _ in branch(quantize == True):
         quant_llm = quant_gpu_op(model_path=model_path,
-                                 compress_model_path=QUANT_MODEL_DIR,
-                                 ds=ds)
+                                 compress_model_path=quant_model_dir,
+                                 ds=ds,
+                                 num_examples=num_examples,
+                                 max_seq_len=max_seq_len,
+                                 cache_dir=CACHE_DIR)
         quant_llm.add_pvolumes({"/mnt/models": vol})
         quant_llm.add_node_selector_constraint(
             label_name='nvidia.com/gpu.present', value='true')
         quant_llm.add_toleration(gpu_toleration)
-        quant_llm.add_resource_request('nvidia.com/gpu', "2")
-        quant_llm.add_resource_limit('nvidia.com/gpu', "2")
+        add_resources(quant_llm, 'quantize_gpu', profile, gpus=2,
+                      samples=num_examples, seq_len=max_seq_len)
         quant_llm.after(predecing_task)
 
-        with dsl.Condition(eval == True):
-            eval_llm = gpu_eval_op(model_path=QUANT_MODEL_DIR, tasks=eval_task,
-                               batch_size=eval_batch_size)
-            eval_llm.add_pvolumes({"/mnt/models": vol})
-            eval_llm.add_node_selector_constraint(
-                label_name='nvidia.com/gpu.present', value='true')
-            eval_llm.add_toleration(gpu_toleration)
-            eval_llm.add_resource_request('nvidia.com/gpu', "1")
-            eval_llm.add_resource_limit('nvidia.com/gpu', "1")
-            eval_llm.after(quant_llm)
-
-        with dsl.Condition(save_model == True):
-            upload_pruned_llm = upload_op(model_path=QUANT_MODEL_DIR,
+        for _ in branch(eval == True):
+            eval_llm = add_eval(gpu_eval_op, merge_eval_op, quant_llm,
+                                vol, gpu_toleration,
+                                eval_dir(quant_model_dir, target),
+                                eval_shards, profile,
+                                model_path=quant_model_dir, tasks=eval_task,
+                                batch_size=eval_batch_size)
+
+        for _ in branch(save_model == True):
+            upload_pruned_llm = upload_op(model_path=quant_model_dir,
                                           name=save_folder_name)
-            upload_pruned_llm.add_env_variable(env_from_secret(
-                's3_access_key', 'aws-connection-models', 'AWS_ACCESS_KEY_ID'))
-            upload_pruned_llm.add_env_variable(env_from_secret(
-                's3_secret_access_key', 'aws-connection-models',
-                'AWS_SECRET_ACCESS_KEY'))
-            upload_pruned_llm.add_env_variable(env_from_secret(
-                's3_host', 'aws-connection-models', 'AWS_S3_ENDPOINT'))
-            upload_pruned_llm.add_env_variable(env_from_secret(
-                's3_bucket', 'aws-connection-models', 'AWS_S3_BUCKET'))
+            add_data_connection(upload_pruned_llm, 'aws-connection-models')
             upload_pruned_llm.add_pvolumes({"/mnt/models": vol})
             upload_pruned_llm.after(quant_llm)
     
-    with dsl.Condition(quantize == False):
-        with dsl.Condition(eval == True):
-            with dsl.Condition(sparse == True):
-                eval_llm = gpu_eval_op(model_path=model_path, tasks=eval_task,
-                                       batch_size=eval_batch_size,
-                                       sparse=sparse)
-                eval_llm.add_pvolumes({"/mnt/models": vol})
-                eval_llm.add_node_selector_constraint(
-                    label_name='nvidia.com/gpu.present', value='true')
-                eval_llm.add_toleration(gpu_toleration)
-                eval_llm.add_resource_request('nvidia.com/gpu', "1")
-                eval_llm.add_resource_limit('nvidia.com/gpu', "1")
-                eval_llm.after(predecing_task)
-
-        with dsl.Condition(save_model == True):
+    for _ in branch(quantize == False):
+        for _ in branch(eval == True):
+            for _ in branch(sparse == True):
+                eval_llm = add_eval(gpu_eval_op, merge_eval_op, predecing_task,
+                                    vol, gpu_toleration,
+                                    eval_dir(model_path, target),
+                                    eval_shards, profile,
+                                    model_path=model_path, tasks=eval_task,
+                                    batch_size=eval_batch_size,
+                                    sparse=sparse)
+
+        for _ in branch(save_model == True):
             upload_pruned_llm = upload_op(model_path=model_path,
                                           name=save_folder_name)
-            upload_pruned_llm.add_env_variable(env_from_secret(
-                's3_access_key', 'aws-connection-models', 'AWS_ACCESS_KEY_ID'))
-            upload_pruned_llm.add_env_variable(env_from_secret(
-                's3_secret_access_key', 'aws-connection-models',
-                'AWS_SECRET_ACCESS_KEY'))
-            upload_pruned_llm.add_env_variable(env_from_secret(
-                's3_host', 'aws-connection-models', 'AWS_S3_ENDPOINT'))
-            upload_pruned_llm.add_env_variable(env_from_secret(
-                's3_bucket', 'aws-connection-models', 'AWS_S3_BUCKET'))
+            add_data_connection(upload_pruned_llm, 'aws-connection-models')
             upload_pruned_llm.add_pvolumes({"/mnt/models": vol})
             upload_pruned_llm.after(predecing_task)
 
@@ -546,7 +597,7 @@ def gpu_model_optimization(predecing_task:object, model_path:str,
 )
 def sparseml_pipeline(
     model_name:str="TinyLlama/TinyLlama-1.1B-Chat-v1.0",
-    inference_target:str='CPU',  # CPU or GPU
+    inference_target:str='CPU',  # CPU or GPU, BOTH when set at compile time
     download_option:str='HF',   # HF or S3 or PVC if already there
     shared_volume:str='models-shared',
     sparse:bool=True,
@@ -556,8 +607,16 @@ def sparseml_pipeline(
     eval:bool=False,
     eval_task:str="hellaswag",
     eval_batch_size:str="auto",  # 64
+    eval_shards:int=1,  # GPU workers every eval fans out to
     save_model:bool=True,
-    save_folder_name:str="optimized-1"
+    save_folder_name:str="optimized-1",
+    num_examples:int=512,  # GPU, GPTQ calibration samples
+    max_seq_len:int=512,  # GPU, GPTQ calibration sample length
+    low_memory:bool=False,  # stream the layers through the sparsification
+    fused:bool=True,  # CPU, prune and quantize in a single step
+    quantization_strategy:str='channel',  # CPU, of the weights: channel or tensor
+    export_sequence_lengths:str='[1024]',  # CPU, DeepSparse variants
+    export_batch_sizes:str='[1]',  # CPU, DeepSparse variants
 ):
         
     ONE_HOUR_SEC = 60 * 60
@@ -569,6 +628,8 @@ def sparseml_pipeline(
 
     # Configure the pipeline level to one week (in seconds)
     dsl.get_pipeline_conf().set_timeout(ONE_WEEK_SEC)
+    # Time and resources of every step, see stage_telemetry.py
+    dsl.get_pipeline_conf().add_op_transformer(add_telemetry)
 
     print("Params", model_name, inference_target, sparse, sparsity_ratio,
           quantize, eval, eval_task, eval_batch_size, save_model)
@@ -584,80 +645,118 @@ def sparseml_pipeline(
                                   #operator='Equal',
                                   #value='true')
 
+    # The shapes DeepSparse compiles the exported model for, see
+    # export_variants.py
+    export_shapes = dict(sequence_lengths=export_sequence_lengths,
+                         batch_sizes=export_batch_sizes)
+
+    # The steps are sized for the model when it is fixed at compile time,
+    # and keep fixed GPU counts otherwise, see resource_model.py
+    profile = (model_profile(model_name) if isinstance(model_name, str)
+               else None)
+
     # Download volumes
     download_llm = download_op(model_name, destination_path=MODEL_DIR,
-                               download_option=download_option)
-    download_llm.add_env_variable(env_from_secret(
-        's3_access_key', 'aws-connection-models', 'AWS_ACCESS_KEY_ID'))
-    download_llm.add_env_variable(env_from_secret(
-        's3_secret_access_key', 'aws-connection-models',
-        'AWS_SECRET_ACCESS_KEY'))
-    download_llm.add_env_variable(env_from_secret(
-        's3_host', 'aws-connection-models', 'AWS_S3_ENDPOINT'))
-    download_llm.add_env_variable(env_from_secret(
-        's3_bucket', 'aws-connection-models', 'AWS_S3_BUCKET'))
+                               download_option=download_option,
+                               cache_dir=CACHE_DIR)
+    add_data_connection(download_llm, 'aws-connection-models')
     download_llm.add_pvolumes({"/mnt/models": vol})
 
-    sparse_llm = None
-
-    with dsl.Condition(sparse == True):
-        sparse_llm = sparse_op(model_path=MODEL_DIR,
-                               compress_model_path=SPARSE_MODEL_DIR,
-                               ds=ds,
-                               sparsity_ratio=sparsity_ratio,
-                               sparsity_targets=sparsity_targets)
-        sparse_llm.add_pvolumes({"/mnt/models": vol})
-        sparse_llm.add_node_selector_constraint(
-            label_name='nvidia.com/gpu.present', value='true')
-        sparse_llm.add_toleration(gpu_toleration)
-        sparse_llm.add_resource_request('nvidia.com/gpu', "3")
-        sparse_llm.add_resource_limit('nvidia.com/gpu', "3")
-        sparse_llm.after(download_llm)
-
-        with dsl.Condition(inference_target == 'CPU'):
-            cpu_model_optimization(sparse_llm, SPARSE_MODEL_DIR, sparse,
-                                   quantize, eval, eval_task, eval_batch_size,
-                                   save_model, save_folder_name, vol,
-                                   gpu_toleration)
-        with dsl.Condition(inference_target == 'GPU'):
+    for _ in branch(inference_target == 'CPU'):
+        cpu_model_optimization(download_llm, sparse, quantize, fused,
+                               sparsity_ratio, sparsity_targets,
+                               quantization_strategy, low_memory, eval,
+                               eval_task, eval_batch_size, eval_shards,
+                               save_model, save_folder_name, export_shapes,
+                               vol, gpu_toleration, profile)
+
+    for _ in branch(inference_target == 'GPU'):
+        for _ in branch(sparse == True):
+            sparse_llm = add_sparse(download_llm, ds, sparsity_ratio,
+                                    sparsity_targets, low_memory, vol,
+                                    gpu_toleration, profile)
             gpu_model_optimization(sparse_llm, SPARSE_MODEL_DIR, sparse,
                                    quantize, eval, eval_task, eval_batch_size,
-                                   save_model, save_folder_name, vol,
-                                   gpu_toleration)
-
-    with dsl.Condition(sparse == False):
-        with dsl.Condition(inference_target == 'CPU'):
-            cpu_model_optimization(download_llm, MODEL_DIR, sparse, quantize,
-                                   eval, eval_task, eval_batch_size,
-                                   save_model, save_folder_name, vol,
-                                   gpu_toleration)
-        with dsl.Condition(inference_target == 'GPU'):
+                                   eval_shards, save_model, save_folder_name,
+                                   vol, gpu_toleration, num_examples,
+                                   max_seq_len, profile)
+        for _ in branch(sparse == False):
             gpu_model_optimization(download_llm, MODEL_DIR, sparse, quantize,
                                    eval, eval_task, eval_batch_size,
-                                   save_model, save_folder_name, vol,
-                                   gpu_toleration)
-            
-    with dsl.Condition(eval == True):
-        with dsl.Condition(inference_target == 'CPU'):
-            eval_llm_base = cpu_eval_op(model_path=MODEL_DIR, tasks=eval_task,
-                                        batch_size=eval_batch_size)
-            eval_llm_base.add_pvolumes({"/mnt/models": vol})
-            eval_llm_base.add_node_selector_constraint(
-                label_name='nvidia.com/gpu.present', value='true')
-            eval_llm_base.add_toleration(gpu_toleration)
-            eval_llm_base.add_resource_request('nvidia.com/gpu', "1")
-            eval_llm_base.add_resource_limit('nvidia.com/gpu', "1")
-            eval_llm_base.after(download_llm)
-        with dsl.Condition(inference_target == 'GPU'):
-            eval_llm_base = gpu_eval_op(model_path=MODEL_DIR, tasks=eval_task,
-                                        batch_size=eval_batch_size)
-            eval_llm_base.add_pvolumes({"/mnt/models": vol})
-            eval_llm_base.add_node_selector_constraint(
-                label_name='nvidia.com/gpu.present', value='true')
-            eval_llm_base.add_toleration(gpu_toleration)
-            eval_llm_base.add_resource_request('nvidia.com/gpu', "1")
-            eval_llm_base.add_resource_limit('nvidia.com/gpu', "1")
-            eval_llm_base.after(download_llm)
-
-# Compile the pipeline
-TektonCompiler().compile(sparseml_pipeline, 'sparseml_pipeline.yaml')
+                                   eval_shards, save_model, save_folder_name,
+                                   vol, gpu_toleration, num_examples,
+                                   max_seq_len, profile)
+
+    # Both deployments from the same download and sparsification, their
+    # steps running side by side, uploaded to the deepsparse and vllm
+    # folders of save_folder_name. Only when inference_target is BOTH at
+    # compile time, as a run time condition would put a second copy of the
+    # CPU and GPU steps in every pipeline
+    if isinstance(inference_target, str) and inference_target == 'BOTH':
+        for _ in branch(sparse == True):
+            sparse_llm = add_sparse(download_llm, ds, sparsity_ratio,
+                                    sparsity_targets, low_memory, vol,
+                                    gpu_toleration, profile)
+            cpu_model_optimization(download_llm, True, quantize, fused,
+                                   sparsity_ratio, sparsity_targets,
+                                   quantization_strategy, low_memory, eval,
+                                   eval_task, eval_batch_size, eval_shards,
+                                   save_model,
+                                   f'{save_folder_name}/deepsparse',
+                                   export_shapes, vol, gpu_toleration, profile,
+                                   sparse_llm, 'cpu')
+            gpu_model_optimization(sparse_llm, SPARSE_MODEL_DIR, True,
+                                   quantize, eval, eval_task, eval_batch_size,
+                                   eval_shards, save_model,
+                                   f'{save_folder_name}/vllm', vol,
+                                   gpu_toleration, num_examples, max_seq_len,
+                                   profile, 'gpu')
+        for _ in branch(sparse == False):
+            cpu_model_optimization(download_llm, False, quantize, fused,
+                                   sparsity_ratio, sparsity_targets,
+                                   quantization_strategy, low_memory, eval,
+                                   eval_task, eval_batch_size, eval_shards,
+                                   save_model,
+                                   f'{save_folder_name}/deepsparse',
+                                   export_shapes, vol, gpu_toleration, profile,
+                                   target='cpu')
+            gpu_model_optimization(download_llm, MODEL_DIR, False, quantize,
+                                   eval, eval_task, eval_batch_size,
+                                   eval_shards, save_model,
+                                   f'{save_folder_name}/vllm', vol,
+                                   gpu_toleration, num_examples, max_seq_len,
+                                   profile, 'gpu')
+
+    # The scores of the base model do not change from run to run, so they
+    # are only computed the first time, with vLLM when both targets run
+    for _ in branch(eval == True):
+        for _ in branch(inference_target == 'CPU'):
+            eval_llm_base = add_cached_eval(
+                lookup_cpu_eval_op, store_eval_op, cpu_eval_op, merge_eval_op,
+                download_llm, vol, gpu_toleration,
+                MODEL_DIR.replace(BASE_DIR, EVAL_DIR), CACHE_DIR, eval_shards,
+                profile, model_path=MODEL_DIR, tasks=eval_task,
+                batch_size=eval_batch_size)
+        for _ in branch(inference_target != 'CPU'):
+            eval_llm_base = add_cached_eval(
+                lookup_gpu_eval_op, store_eval_op, gpu_eval_op, merge_eval_op,
+                download_llm, vol, gpu_toleration,
+                MODEL_DIR.replace(BASE_DIR, EVAL_DIR), CACHE_DIR, eval_shards,
+                profile, model_path=MODEL_DIR, tasks=eval_task,
+                batch_size=eval_batch_size)
+
+# Compile the pipeline, or a variant of it for the parameters given as
+# name=value arguments, with only the tasks they run, and its steps sized for
+# the model when model_name is one of them, e.g.:
+#   python pipeline_nmvllm.py inference_target=GPU sparse=False eval=True
+#   python pipeline_nmvllm.py model_name=meta-llama/Llama-2-7b-hf
+#   python pipeline_nmvllm.py inference_target=BOTH
+fixed = parse_params(sparseml_pipeline, sys.argv[1:])
+if fixed:
+    TektonCompiler().compile(
+        specialize(sparseml_pipeline, **fixed),
+        'sparseml_pipeline-{}.yaml'.format('-'.join(
+            f'{name}-{value}'.lower().replace('/', '-')
+            for name, value in fixed.items())))
+else:
+    TektonCompiler().compile(sparseml_pipeline, 'sparseml_pipeline.yaml')
@@ -1,7 +1,15 @@
 import kfp.dsl as dsl
 import kfp.components as comp
+from kfp.components import OutputPath
+from typing import NamedTuple
 from kfp_tekton.compiler import TektonCompiler
-from kfp_tekton.k8s_client_helper import env_from_secret
+
+from pipeline_components import (cpu_eval_op, download_op, export_op,
+                                 gpu_eval_op, lookup_base_eval_op,
+                                 merge_eval_op, quant_gpu_op, store_eval_op,
+                                 upload_op)
+from pipeline_helpers import (STORAGE_IMAGE, add_cached_eval,
+                              add_data_connection, add_eval, add_telemetry)
 
 from kubernetes.client import V1Volume, V1PersistentVolumeClaimVolumeSource, V1Toleration
 
@@ -9,95 +17,18 @@ BASE_DIR = "/mnt/models/"
 MODEL_DIR = BASE_DIR + "llm"
 COMPRESS_MODEL_DIR = BASE_DIR + "compress-llm"
 EXPORTED_MODEL_DIR = BASE_DIR + "exported"
+EVAL_DIR = BASE_DIR + "eval/"
+CACHE_DIR = BASE_DIR + "cache"
+SWEEP_DIR = BASE_DIR + "sweep/"
 
+# Sweep candidates compressed and evaluated at the same time
+SWEEP_PARALLELISM = 2
 
-def download_model(model_name: str, destination_path: str,
-                   download_option: str):
-    if download_option == "HF":
-        import subprocess
-        print('Starting downloading the model from HF')
-        # Execute the huggingface_hub-cli command
-        result = subprocess.run(["huggingface-cli", "download", model_name,
-                                 "--local-dir", destination_path,
-                                 "--local-dir-use-symlinks", "False"],
-                                capture_output=True, text=True)
-        # Check for errors or output
-        if result.returncode == 0:
-            print("Model downloaded successfully from HF.")
-        else:
-            print("Error downloading model:")
-            print(result.stderr)
-
-    elif download_option == "S3":
-        import os
-        import errno
-        from boto3 import client
-
-        print('Starting downloading the model from S3')
-
-        s3_endpoint_url = os.environ["s3_host"]
-        s3_access_key = os.environ["s3_access_key"]
-        s3_secret_key = os.environ["s3_secret_access_key"]
-        s3_bucket_name = os.environ["s3_bucket"]
-
-        s3_client = client(
-            's3', endpoint_url=s3_endpoint_url, aws_access_key_id=s3_access_key,
-            aws_secret_access_key=s3_secret_key, verify=False
-        )
-
-        # list all objects in the folder
-        objects = s3_client.list_objects(Bucket=s3_bucket_name, Prefix=model_name)
-
-        # download each object in the folder
-        for object in objects['Contents']:
-            file_name = object['Key']
-            local_file_name = os.path.join(destination_path, file_name.replace(model_name, '')[1:])
-            if not os.path.exists(os.path.dirname(local_file_name)):
-                try:
-                    os.makedirs(os.path.dirname(local_file_name))
-                except OSError as exc: # Guard against race condition
-                    if exc.errno != errno.EEXIST:
-                        print("Error downloading model")
-                        raise
-            s3_client.download_file(s3_bucket_name, file_name, local_file_name)
-
-        print('Model downloaded successfully from S3.')
-
-    elif download_option == "PVC":
-        print('Model should be already on the volumen.')
-
-
-def upload_model(model_path: str, name: str):
-    import os
-    from boto3 import client
-
-    print('Starting results upload.')
-    s3_endpoint_url = os.environ["s3_host"]
-    s3_access_key = os.environ["s3_access_key"]
-    s3_secret_key = os.environ["s3_secret_access_key"]
-    s3_bucket_name = os.environ["s3_bucket"]
-
-    print(f'Uploading predictions to bucket {s3_bucket_name} '
-          f'to S3 storage at {s3_endpoint_url}')
-
-    s3_client = client(
-        's3', endpoint_url=s3_endpoint_url, aws_access_key_id=s3_access_key,
-        aws_secret_access_key=s3_secret_key, verify=False
-    )
 
-    # Walk through the local folder and upload files
-    for root, dirs, files in os.walk(model_path):
-        for file in files:
-            local_file_path = os.path.join(root, file)
-            #s3_file_path = os.path.join(s3_bucket_name, local_file_path[len(model_path)+1:])
-            s3_file_path = os.path.join(name, local_file_path[len(model_path)+1:])
-            s3_client.upload_file(local_file_path, s3_bucket_name, s3_file_path)
-            print(f'Uploaded {local_file_path}')
-
-    print('Finished uploading results.')
-
-
-def base_eval_model(model_path: str, tasks: str, batch_size: str):
+def base_eval_model(model_path: str, tasks: str, batch_size: str,
+                    shard: int = 0, num_shards: int = 1,
+                    results_dir: str = "", num_fewshot: int = 0,
+                    limit: str = ""):
     import subprocess
     import os
 
@@ -106,14 +37,25 @@ def base_eval_model(model_path: str, tasks: str, batch_size: str):
     # Execute the huggingface_hub-cli command
     env = os.environ.copy()
     env["CUDA_VISIBLE_DEVICES"] = "0"
-    result = subprocess.run(["lm_eval",
-                             "--model", "hf",
-                             "--model_args", model_args,
-                             "--tasks", tasks,
-                             "--batch_size", batch_size,
-                             "--write_out",
-                             "--num_fewshot", "0"],
-                            capture_output=True, text=True, env=env)
+    command = ["lm_eval",
+               "--model", "hf",
+               "--model_args", model_args,
+               "--tasks", tasks,
+               "--batch_size", batch_size,
+               "--write_out",
+               "--num_fewshot", str(num_fewshot)]
+
+    if results_dir:
+        # Evaluate this worker's share of the docs only, the merge step
+        # weights the results of all the shards
+        command = ["python", "-m", "lm_eval_shards",
+                   "--shard", str(shard), "--num-shards", str(num_shards),
+                   "--results", f"{results_dir}/shard-{shard}.json",
+                   "--limit", limit or "0",
+                   "--"] + command
+    elif limit:
+        command += ["--limit", limit]
+    result = subprocess.run(command, capture_output=True, text=True, env=env)
 
     # Check for errors or output
     if result.returncode == 0:
@@ -124,144 +66,25 @@ def base_eval_model(model_path: str, tasks: str, batch_size: str):
         print(result.stderr)
 
 
-def cpu_eval_model(model_path: str, tasks: str, batch_size: str):
-    import subprocess
-    import os
-
-    model_args = "pretrained=" + model_path  # + ",trust_remote_code=True"
-
-    # Execute the huggingface_hub-cli command
-    env = os.environ.copy()
-    env["CUDA_VISIBLE_DEVICES"] = "0"
-    result = subprocess.run(["python", "./lm-evaluation-harness/main.py",
-                             "--model", "sparseml",
-                             "--model_args", model_args,
-                             "--tasks", tasks,
-                             "--batch_size", batch_size,
-                             "--no_cache",
-                             "--write_out",
-                             "--device", "cuda:0",
-                             "--num_fewshot", "0"],
-                            capture_output=True, text=True, env=env)
-
-    # Check for errors or output
-    if result.returncode == 0:
-        print("Model evaluated successfully:")
-        print(result.stdout)
-    else:
-        print("Error evaluating the model:")
-        print(result.stderr)
-
-
-def gpu_eval_model(model_path: str, tasks: str, batch_size: str):
-    import subprocess
-    import os
-
-    model_args = "pretrained=" + model_path  + ",tensor_parallel_size=1"  # + ",trust_remote_code=True"
-
-    # Execute the huggingface_hub-cli command
-    env = os.environ.copy()
-    env["CUDA_VISIBLE_DEVICES"] = "0"
-    result = subprocess.run(["lm_eval",
-                             "--model", "vllm",
-                             "--model_args", model_args,
-                             "--tasks", tasks,
-                             "--batch_size", batch_size,
-                             "--write_out",
-                             "--num_fewshot", "0"],
-                            capture_output=True, text=True, env=env)
-
-    # Check for errors or output
-    if result.returncode == 0:
-        print("Model evaluated successfully:")
-        print(result.stdout)
-    else:
-        print("Error evaluating the model:")
-        print(result.stderr)
-
-
-def quantize_gpu_model(model_path:str, compress_model_path: str, ds: str):
-    # Quantizing an LLM
-    from transformers import AutoTokenizer
-    from datasets import load_dataset
-
-    from auto_gptq import AutoGPTQForCausalLM, BaseQuantizeConfig
-
-    MAX_SEQ_LEN = 512
-    NUM_EXAMPLES = 512
-
-    def preprocess(example):
-        return {"text": tokenizer.apply_chat_template(example["messages"],
-                                                      tokenize=False)}
-
-    print("Loading the dataset and tokenizers")
-    dataset = load_dataset(ds, split="train_sft")
-    #dataset = load_dataset(ds, split="train")
-    #dataset = load_dataset(ds, split="test")
-    tokenizer = AutoTokenizer.from_pretrained(model_path)
-    ds = dataset.shuffle().select(range(NUM_EXAMPLES))
-    ds = ds.map(preprocess)
-
-    examples = [
-        tokenizer(
-            example["text"], padding=False, max_length=MAX_SEQ_LEN,
-            truncation=True,
-        ) for example in ds
-    ]
-
-    print("Loaded the dataset and tokenizers")
-    print("Starting the quantization")
-
-    # Apply GPTQ
-    quantize_config = BaseQuantizeConfig(
-        bits=4,                         # Only support 4 bit
-        group_size=128,                 # Set to g=128 or -1 (for channelwise)
-        desc_act=False,                 # Marlin does not support act_order=True
-        model_file_base_name="model",   # Name of the model.safetensors when we call save_pretrained
-    )
-    print("Applying GPTQ for quantization")
-
-    model = AutoGPTQForCausalLM.from_pretrained(
-        model_path,
-        quantize_config,
-        device_map="auto")
-    model.quantize(examples)
-
-    gptq_save_dir = f"{model_path}-gptq"
-    print(f"Saving gptq model to {gptq_save_dir}")
-    model.save_pretrained(gptq_save_dir)
-    tokenizer.save_pretrained(gptq_save_dir)
-
-    # Convert to Marlin
-    print("Reloading in marlin format")
-    marlin_model = AutoGPTQForCausalLM.from_quantized(
-        gptq_save_dir,
-        use_marlin=True,
-        device_map="auto")
-
-    print(f"Saving model in marlin format to {compress_model_path}")
-    marlin_model.save_pretrained(compress_model_path)
-    tokenizer.save_pretrained(compress_model_path)
-
-    print("Quantization process completed")
-
-
 def sparse_cpu_model(model_path:str, compress_model_path: str, ds: str,
-                     sparsity_ratio: float, sparsity_targets: str):
+                     sparsity_ratio: float, sparsity_targets: str,
+                     cache_dir: str = "", quantize: bool = True):
+    import shutil
+
     import sparseml.transformers
     import torch
-
-    # set the data type of the model to bfloat16 and device_map="auto" which
-    # will place the model on all the gpus available in the system
-    model = sparseml.transformers.SparseAutoModelForCausalLM.from_pretrained(
-        model_path,
-        torch_dtype=torch.bfloat16,
-        device_map="auto"
-    )
-
-    recipe = f"""
-    test_stage:
-      obcq_modifiers:
+    from calibration_data import calibration_set
+    from model_storage import (folder_hash, library_versions, memoize_step,
+                               step_key)
+    from oneshot_checkpoints import resumable_oneshot
+    from stage_telemetry import mark
+
+    # Calibration samples, as many and as long as SparseML takes by default
+    NUM_CALIBRATION_SAMPLES = 512
+    MAX_SEQ_LEN = 384
+    SEED = 42
+
+    quantization_modifiers = """
         LogarithmicEqualizationModifier:
           mappings: [
             [["re:.*q_proj", "re:.*k_proj", "re:.*v_proj"], "re:.*input_layernorm"],
@@ -292,54 +115,236 @@ def sparse_cpu_model(model_path:str, compress_model_path: str, ds: str,
               input_activations: null
               weights:
                 num_bits: 8
-                symmetric: false
+                symmetric: false"""
+
+    recipe = f"""
+    test_stage:
+      obcq_modifiers:{quantization_modifiers if quantize else ""}
         SparseGPTModifier:
           sparsity: {sparsity_ratio}
           sequential_update: true
-          quantize: true
+          quantize: {"true" if quantize else "false"}
           targets: {sparsity_targets}
     """
+    inputs = dict(model=folder_hash(model_path), recipe=recipe, dataset=ds,
+                  num_samples=NUM_CALIBRATION_SAMPLES, max_seq_len=MAX_SEQ_LEN,
+                  seed=SEED,
+                  versions=library_versions('sparseml', 'torch',
+                                            'transformers'))
+    # On the shared volume, so a retried pod resumes from the last layer
+    checkpoint_dir = f"{compress_model_path}-checkpoints"
+
+    def compress(output_dir):
+        mark('load_model')
+        # set the data type of the model to bfloat16 and device_map="auto" which
+        # will place the model on all the gpus available in the system
+        model = sparseml.transformers.SparseAutoModelForCausalLM.from_pretrained(
+            model_path,
+            torch_dtype=torch.bfloat16,
+            device_map="auto"
+        )
 
-    sparseml.transformers.oneshot(
-        model=model,
-        dataset=ds,
-        recipe=recipe,
-        output_dir=compress_model_path,
-    )
-
+        mark('calibration')
+        # Formatted once and kept in the model cache, so SparseML only
+        # tokenizes the samples instead of the whole dataset
+        calibration = calibration_set(model_path, ds,
+                                      NUM_CALIBRATION_SAMPLES, MAX_SEQ_LEN,
+                                      seed=SEED,
+                                      path=f"{compress_model_path}-calibration",
+                                      cache_dir=cache_dir)
+        mark('oneshot')
+        # Every compressed layer is checkpointed, and a retried pod resumes
+        # after the last one, see oneshot_checkpoints.py. The quantization
+        # observers calibrate on the forward passes of the layers resumed
+        # too, so those are run again
+        with resumable_oneshot(checkpoint_dir, step_key(**inputs),
+                               replay_calibration=quantize):
+            sparseml.transformers.oneshot(
+                model=model,
+                dataset=calibration.dataset(),
+                recipe=recipe,
+                output_dir=output_dir,
+                num_calibration_samples=len(calibration),
+                max_seq_length=MAX_SEQ_LEN,
+            )
+        shutil.rmtree(checkpoint_dir)
+
+    if not cache_dir:
+        compress(compress_model_path)
+        return
+    # Reuse the output of an earlier run with the same model, recipe,
+    # dataset and libraries instead of compressing again
+    memoize_step('sparse_cpu_model', compress_model_path, compress, cache_dir,
+                 **inputs)
+
+
+def plan_sweep(sparsity_ratios: str, quantize_options: str,
+               sweep_dir: str) -> str:
+    import json
+    import os
 
-def export_model(model_path: str, exported_model_path: str):
-    from sparseml import export
+    # One candidate per sparsity ratio and quantize option, each with its own
+    # folders on the shared volume, as they run in parallel
+    candidates = []
+    for sparsity_ratio in json.loads(sparsity_ratios):
+        for quantize in json.loads(quantize_options):
+            # Parsed as parse_params does, '["false"]' is no quantization
+            if isinstance(quantize, str):
+                quantize = quantize.lower() in ('true', '1', 'yes')
+            name = (f"sparse{round(float(sparsity_ratio) * 100)}"
+                    f"{'-quant' if quantize else ''}")
+            candidate_dir = os.path.join(sweep_dir, name)
+            candidates.append({
+                "name": name,
+                "sparsity_ratio": float(sparsity_ratio),
+                "quantize": bool(quantize),
+                "model_path": os.path.join(candidate_dir, "llm"),
+                "exported_path": os.path.join(candidate_dir, "exported"),
+                "eval_dir": os.path.join(candidate_dir, "eval"),
+                "benchmark_path": os.path.join(candidate_dir,
+                                               "benchmark.json"),
+            })
+    print(f"Sweeping {len(candidates)} candidates:",
+          ", ".join(candidate["name"] for candidate in candidates))
+    return json.dumps(candidates)
+
+
+def benchmark_model(model_path: str, results_path: str,
+                    sequence_length: int = 1024, seconds: int = 30):
+    import json
+    import subprocess
 
-    export(
-        model_path,
-        task="text-generation",
-        sequence_length=1024,
-        target_path=exported_model_path
-    )
+    # DeepSparse latency per generated token at batch size 1, as it serves
+    # the exported model
+    raw_results_path = results_path + ".raw"
+    command = ["deepsparse.benchmark", f"{model_path}/deployment/model.onnx",
+               "--batch_size", "1",
+               "--sequence_length", str(sequence_length),
+               "--input_ids_length", "1",
+               "--time", str(seconds),
+               "--export_path", raw_results_path]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        print("Error benchmarking the model:")
+        print(result.stderr)
+        raise RuntimeError(f"Could not benchmark {model_path}")
+    print(result.stdout)
+
+    with open(raw_results_path) as f:
+        benchmark = json.load(f)["benchmark_result"]
+    with open(results_path, "w") as f:
+        json.dump({"latency_ms": benchmark["median"],
+                   "items_per_sec": benchmark["items_per_sec"]}, f, indent=2)
+
+
+def select_sweep_candidate(candidates: str, baseline_results: str,
+                           tasks: str, metric: str, max_accuracy_drop: float,
+                           pareto_path: str,
+                           mlpipeline_metrics_path: OutputPath('Metrics')
+                           ) -> NamedTuple('Outputs', [('name', str),
+                                                       ('exported_path', str)]):
+    import json
+    import os
+    from collections import namedtuple
+
+    def accuracy(results_path):
+        # Mean of the metric over the evaluated tasks, the older harness
+        # names it without the filter
+        with open(results_path) as f:
+            results = json.load(f)["results"]
+        return sum(results[task].get(f"{metric},none",
+                                     results[task].get(metric))
+                   for task in tasks.split(",")) / len(tasks.split(","))
+
+    candidates = json.loads(candidates)
+    for candidate in candidates:
+        candidate["accuracy"] = accuracy(
+            os.path.join(candidate["eval_dir"], "results.json"))
+        with open(candidate["benchmark_path"]) as f:
+            candidate["latency_ms"] = json.load(f)["latency_ms"]
+
+    # The candidates no other one beats on both accuracy and latency
+    def dominates(a, b):
+        return (a["accuracy"] >= b["accuracy"]
+                and a["latency_ms"] <= b["latency_ms"]
+                and (a["accuracy"], -a["latency_ms"])
+                != (b["accuracy"], -b["latency_ms"]))
+
+    frontier = sorted((candidate for candidate in candidates
+                       if not any(dominates(other, candidate)
+                                  for other in candidates)),
+                      key=lambda candidate: candidate["latency_ms"])
+    for candidate in candidates:
+        candidate["pareto"] = candidate in frontier
+
+    # The fastest one within max_accuracy_drop of the base model, or the
+    # most accurate one if none is
+    baseline = None
+    eligible = []
+    if os.path.exists(baseline_results):
+        baseline = accuracy(baseline_results)
+        eligible = [candidate for candidate in frontier
+                    if candidate["accuracy"] >= baseline - max_accuracy_drop]
+    chosen = (eligible[0] if eligible
+              else max(frontier, key=lambda candidate: candidate["accuracy"]))
+
+    print(f"Base model {metric}: {baseline}")
+    for candidate in frontier:
+        print(f"Pareto: {candidate['name']} {metric} "
+              f"{candidate['accuracy']:.4f}, "
+              f"{candidate['latency_ms']:.2f} ms/token")
+    print(f"Chosen: {chosen['name']}")
+
+    with open(pareto_path, "w") as f:
+        json.dump({"metric": metric, "baseline": baseline,
+                   "max_accuracy_drop": max_accuracy_drop,
+                   "chosen": chosen["name"], "candidates": candidates},
+                  f, indent=2)
+
+    metrics = [{"name": f"{candidate['name']}-{name}"[:63],
+                "numberValue": candidate[key], "format": "RAW"}
+               for candidate in candidates
+               for name, key in (("accuracy", "accuracy"),
+                                 ("latency-ms", "latency_ms"))]
+    with open(mlpipeline_metrics_path, "w") as f:
+        json.dump({"metrics": metrics}, f)
+
+    outputs = namedtuple('Outputs', ['name', 'exported_path'])
+    return outputs(chosen["name"], chosen["exported_path"])
 
 
 def cpu_model_optimization(predecing_task:object, sparsity_ratio:float,
                            sparsity_targets:str, eval:bool, eval_task:str,
-                           eval_batch_size:str, save_model:bool,
-                           save_folder_name:str, vol:object,
+                           eval_batch_size:str, eval_shards:int,
+                           save_model:bool, save_folder_name:str,
+                           export_shapes:dict, vol:object,
                            gpu_toleration:object, dc_secret:str):
     ds = "open_platypus"
     sparse_llm = sparse_cpu_op(model_path=MODEL_DIR,
                                compress_model_path=COMPRESS_MODEL_DIR,
                                ds=ds,
                                sparsity_ratio=sparsity_ratio,
-                               sparsity_targets=sparsity_targets)
+                               sparsity_targets=sparsity_targets,
+                               cache_dir=CACHE_DIR)
     sparse_llm.add_pvolumes({"/mnt/models": vol})
     sparse_llm.add_node_selector_constraint(
         label_name='nvidia.com/gpu.present', value='true')
     sparse_llm.add_toleration(gpu_toleration)
     sparse_llm.add_resource_request('nvidia.com/gpu', "1")
     sparse_llm.add_resource_limit('nvidia.com/gpu', "1")
+    # Preempted or OOM killed pods resume from their last pruned layer
+    sparse_llm.set_retry(2)
     sparse_llm.after(predecing_task)
 
+    # Exported either way, the export step uploads the files itself while
+    # writing them when save_model is set
     export_llm = export_op(model_path=COMPRESS_MODEL_DIR,
-                           exported_model_path=EXPORTED_MODEL_DIR)
+                           exported_model_path=EXPORTED_MODEL_DIR,
+                           cache_dir=CACHE_DIR,
+                           upload_name=save_folder_name,
+                           upload=save_model,
+                           **export_shapes)
+    add_data_connection(export_llm, dc_secret)
     export_llm.add_pvolumes({"/mnt/models": vol})
     export_llm.add_resource_request('nvidia.com/gpu', "1")
     export_llm.add_resource_limit('nvidia.com/gpu', "1")
@@ -348,40 +353,26 @@ def cpu_model_optimization(predecing_task:object, sparsity_ratio:float,
     export_llm.after(sparse_llm)
 
     with dsl.Condition(eval == True):
-        eval_llm = cpu_eval_op(model_path=COMPRESS_MODEL_DIR, tasks=eval_task,
-                               batch_size=eval_batch_size)
-        eval_llm.add_pvolumes({"/mnt/models": vol})
-        eval_llm.add_node_selector_constraint(
-            label_name='nvidia.com/gpu.present', value='true')
-        eval_llm.add_toleration(gpu_toleration)
-        eval_llm.add_resource_request('nvidia.com/gpu', "1")
-        eval_llm.add_resource_limit('nvidia.com/gpu', "1")
-        eval_llm.after(sparse_llm)
-
-    with dsl.Condition(save_model == True):
-        upload_llm = upload_op(model_path=EXPORTED_MODEL_DIR,
-                               name=save_folder_name)
-        upload_llm.add_env_variable(env_from_secret(
-            's3_access_key', dc_secret, 'AWS_ACCESS_KEY_ID'))
-        upload_llm.add_env_variable(env_from_secret(
-            's3_secret_access_key', dc_secret, 'AWS_SECRET_ACCESS_KEY'))
-        upload_llm.add_env_variable(env_from_secret(
-            's3_host', dc_secret, 'AWS_S3_ENDPOINT'))
-        upload_llm.add_env_variable(env_from_secret(
-            's3_bucket', dc_secret, 'AWS_S3_BUCKET'))
-        upload_llm.add_pvolumes({"/mnt/models": vol})
-        upload_llm.after(export_llm)
+        eval_llm = add_eval(cpu_eval_op, merge_eval_op, sparse_llm,
+                            vol, gpu_toleration,
+                            COMPRESS_MODEL_DIR.replace(BASE_DIR, EVAL_DIR),
+                            eval_shards, model_path=COMPRESS_MODEL_DIR,
+                            tasks=eval_task, batch_size=eval_batch_size)
 
 
 def gpu_model_optimization(predecing_task:object, eval:bool, eval_task:str,
-                           eval_batch_size:str, save_model:bool,
-                           save_folder_name:str, vol:object,
-                           gpu_toleration:object, dc_secret:str):
+                           eval_batch_size:str, eval_shards:int,
+                           save_model:bool, save_folder_name:str, vol:object,
+                           gpu_toleration:object, dc_secret:str,
+                           num_examples:int, max_seq_len:int):
     ds = "HuggingFaceH4/ultrachat_200k"
     #ds = "garage-bAInd/Open-Platypus"
     quant_llm = quant_gpu_op(model_path=MODEL_DIR,
                              compress_model_path=COMPRESS_MODEL_DIR,
-                             ds=ds)
+                             ds=ds,
+                             num_examples=num_examples,
+                             max_seq_len=max_seq_len,
+                             cache_dir=CACHE_DIR)
     quant_llm.add_pvolumes({"/mnt/models": vol})
     quant_llm.add_node_selector_constraint(
         label_name='nvidia.com/gpu.present', value='true')
@@ -391,55 +382,108 @@ def gpu_model_optimization(predecing_task:object, eval:bool, eval_task:str,
     quant_llm.after(predecing_task)
 
     with dsl.Condition(eval == True):
-        eval_llm = gpu_eval_op(model_path=COMPRESS_MODEL_DIR, tasks=eval_task,
-                               batch_size=eval_batch_size)
-        eval_llm.add_pvolumes({"/mnt/models": vol})
-        eval_llm.add_node_selector_constraint(
-            label_name='nvidia.com/gpu.present', value='true')
-        eval_llm.add_toleration(gpu_toleration)
-        eval_llm.add_resource_request('nvidia.com/gpu', "1")
-        eval_llm.add_resource_limit('nvidia.com/gpu', "1")
-        eval_llm.after(quant_llm)
+        eval_llm = add_eval(gpu_eval_op, merge_eval_op, quant_llm,
+                            vol, gpu_toleration,
+                            COMPRESS_MODEL_DIR.replace(BASE_DIR, EVAL_DIR),
+                            eval_shards, model_path=COMPRESS_MODEL_DIR,
+                            tasks=eval_task, batch_size=eval_batch_size)
 
     with dsl.Condition(save_model == True):
         upload_llm = upload_op(model_path=COMPRESS_MODEL_DIR,
                                name=save_folder_name)
-        upload_llm.add_env_variable(env_from_secret(
-            's3_access_key', dc_secret, 'AWS_ACCESS_KEY_ID'))
-        upload_llm.add_env_variable(env_from_secret(
-            's3_secret_access_key', dc_secret, 'AWS_SECRET_ACCESS_KEY'))
-        upload_llm.add_env_variable(env_from_secret(
-            's3_host', dc_secret, 'AWS_S3_ENDPOINT'))
-        upload_llm.add_env_variable(env_from_secret(
-            's3_bucket', dc_secret, 'AWS_S3_BUCKET'))
+        add_data_connection(upload_llm, dc_secret)
         upload_llm.add_pvolumes({"/mnt/models": vol})
         upload_llm.after(quant_llm)
 
 
-download_op = comp.create_component_from_func(download_model,
-                                              packages_to_install=["huggingface-hub", "boto3"],
-                                              base_image='registry.access.redhat.com/ubi9/python-311')
-upload_op = comp.create_component_from_func(upload_model,
-                                            packages_to_install=["boto3"],
-                                            base_image='registry.access.redhat.com/ubi9/python-311')
+def sweep_model_optimization(predecing_task:object, sparsity_ratios:str,
+                             quantize_options:str, sparsity_targets:str,
+                             eval_task:str, eval_batch_size:str,
+                             eval_shards:int, metric:str,
+                             max_accuracy_drop:float, save_model:bool,
+                             save_folder_name:str, vol:object,
+                             gpu_toleration:object, dc_secret:str,
+                             baseline_eval:object):
+    ds = "open_platypus"
+    plan = plan_sweep_op(sparsity_ratios=sparsity_ratios,
+                         quantize_options=quantize_options,
+                         sweep_dir=SWEEP_DIR)
+
+    # Compress, export, benchmark and evaluate every candidate, at most
+    # SWEEP_PARALLELISM at a time
+    with dsl.ParallelFor(plan.output,
+                         parallelism=SWEEP_PARALLELISM) as candidate:
+        sparse_llm = sparse_cpu_op(model_path=MODEL_DIR,
+                                   compress_model_path=candidate.model_path,
+                                   ds=ds,
+                                   sparsity_ratio=candidate.sparsity_ratio,
+                                   sparsity_targets=sparsity_targets,
+                                   cache_dir=CACHE_DIR,
+                                   quantize=candidate.quantize)
+        sparse_llm.add_pvolumes({"/mnt/models": vol})
+        sparse_llm.add_node_selector_constraint(
+            label_name='nvidia.com/gpu.present', value='true')
+        sparse_llm.add_toleration(gpu_toleration)
+        sparse_llm.add_resource_request('nvidia.com/gpu', "1")
+        sparse_llm.add_resource_limit('nvidia.com/gpu', "1")
+        sparse_llm.set_retry(2)
+        sparse_llm.after(predecing_task)
+
+        export_llm = export_op(model_path=candidate.model_path,
+                               exported_model_path=candidate.exported_path,
+                               cache_dir=CACHE_DIR)
+        export_llm.add_pvolumes({"/mnt/models": vol})
+        export_llm.add_resource_request('nvidia.com/gpu', "1")
+        export_llm.add_resource_limit('nvidia.com/gpu', "1")
+        export_llm.add_resource_request('memory', "32Gi")
+        export_llm.add_resource_limit('memory', "32Gi")
+        export_llm.after(sparse_llm)
+
+        benchmark_llm = benchmark_op(model_path=candidate.exported_path,
+                                     results_path=candidate.benchmark_path)
+        benchmark_llm.add_pvolumes({"/mnt/models": vol})
+        # A whole CPU node to itself, so the latencies compare
+        benchmark_llm.add_resource_request('cpu', "16")
+        benchmark_llm.add_resource_limit('cpu', "16")
+        benchmark_llm.after(export_llm)
+
+        eval_llm = add_eval(cpu_eval_op, merge_eval_op, sparse_llm,
+                            vol, gpu_toleration, candidate.eval_dir,
+                            eval_shards, model_path=candidate.model_path,
+                            tasks=eval_task, batch_size=eval_batch_size)
+
+    select = select_op(candidates=plan.output,
+                       baseline_results=MODEL_DIR.replace(BASE_DIR, EVAL_DIR)
+                       + "/results.json",
+                       tasks=eval_task, metric=metric,
+                       max_accuracy_drop=max_accuracy_drop,
+                       pareto_path=SWEEP_DIR + "pareto.json")
+    select.add_pvolumes({"/mnt/models": vol})
+    select.after(benchmark_llm, eval_llm, *baseline_eval)
+
+    with dsl.Condition(save_model == True):
+        upload_llm = upload_op(model_path=select.outputs['exported_path'],
+                               name=save_folder_name)
+        add_data_connection(upload_llm, dc_secret)
+        upload_llm.add_pvolumes({"/mnt/models": vol})
+        upload_llm.after(select)
+
+
 base_eval_op = comp.create_component_from_func(base_eval_model,
                                               packages_to_install=[],
                                               base_image='quay.io/ltomasbo/neural-magic:base_eval')
-cpu_eval_op = comp.create_component_from_func(cpu_eval_model,
-                                              packages_to_install=[],
-                                              base_image='quay.io/ltomasbo/neural-magic:sparseml_eval')
-gpu_eval_op = comp.create_component_from_func(gpu_eval_model,
-                                              packages_to_install=[],
-                                              base_image='quay.io/ltomasbo/neural-magic:nm_vllm_eval')
 sparse_cpu_op = comp.create_component_from_func(sparse_cpu_model,
                                                 packages_to_install=["datasets", "sentencepiece"],
                                                 base_image='quay.io/ltomasbo/neural-magic:sparseml')
-quant_gpu_op = comp.create_component_from_func(quantize_gpu_model,
-                                               packages_to_install=["datasets", "auto-gptq==0.7.1", "torch==2.2.1", "sentencepiece"],
-                                               base_image='registry.access.redhat.com/ubi9/python-311')
-export_op = comp.create_component_from_func(export_model,
+plan_sweep_op = comp.create_component_from_func(plan_sweep,
+                                                packages_to_install=[],
+                                                base_image=STORAGE_IMAGE)
+benchmark_op = comp.create_component_from_func(benchmark_model,
+                                               packages_to_install=[],
+                                               base_image='quay.io/ltomasbo/neural-magic:deepsparse')
+select_op = comp.create_component_from_func(select_sweep_candidate,
                                             packages_to_install=[],
-                                            base_image='quay.io/ltomasbo/neural-magic:sparseml')
+                                            base_image=STORAGE_IMAGE)
 
 
 # Define your pipeline function
@@ -460,6 +504,16 @@ def sparseml_pipeline(
     eval:bool=False,
     eval_task:str="hellaswag",
     eval_batch_size:str="auto",  # 64
+    eval_shards:int=1,  # GPU workers every eval fans out to
+    sweep:bool=False,  # CPU only, evaluates every candidate
+    sweep_sparsity_ratios:str='[0.3, 0.5, 0.7]',
+    sweep_quantize:str='[true, false]',
+    sweep_metric:str="acc",
+    sweep_max_accuracy_drop:float=0.01,
+    num_examples:int=512,  # GPU, GPTQ calibration samples
+    max_seq_len:int=512,  # GPU, GPTQ calibration sample length
+    export_sequence_lengths:str='[1024]',  # CPU, DeepSparse variants
+    export_batch_sizes:str='[1]',  # CPU, DeepSparse variants
 ):
 
     ONE_HOUR_SEC = 60 * 60
@@ -467,9 +521,16 @@ def sparseml_pipeline(
     ONE_WEEK_SEC = ONE_DAY_SEC * 7
     # Configure the pipeline level to one week (in seconds)
     dsl.get_pipeline_conf().set_timeout(ONE_WEEK_SEC)
+    # Time and resources of every step, see stage_telemetry.py
+    dsl.get_pipeline_conf().add_op_transformer(add_telemetry)
 
     dc_secret = 'aws-connection-{}'.format(data_connection)
 
+    # The shapes DeepSparse compiles the exported model for, see
+    # export_variants.py
+    export_shapes = dict(sequence_lengths=export_sequence_lengths,
+                         batch_sizes=export_batch_sizes)
+
     vol = V1Volume(
         name='models-shared',
         persistent_volume_claim=V1PersistentVolumeClaimVolumeSource(
@@ -482,40 +543,49 @@ def sparseml_pipeline(
 
     # Download volumes
     download_llm = download_op(model_name, destination_path=MODEL_DIR,
-                               download_option=download_option)
-    download_llm.add_env_variable(env_from_secret(
-        's3_access_key', dc_secret, 'AWS_ACCESS_KEY_ID'))
-    download_llm.add_env_variable(env_from_secret(
-        's3_secret_access_key', dc_secret,
-        'AWS_SECRET_ACCESS_KEY'))
-    download_llm.add_env_variable(env_from_secret(
-        's3_host', dc_secret, 'AWS_S3_ENDPOINT'))
-    download_llm.add_env_variable(env_from_secret(
-        's3_bucket', dc_secret, 'AWS_S3_BUCKET'))
+                               download_option=download_option,
+                               cache_dir=CACHE_DIR)
+    add_data_connection(download_llm, dc_secret)
     download_llm.add_pvolumes({"/mnt/models": vol})
 
-    with dsl.Condition(inference_target == 'CPU'):
-        cpu_model_optimization(download_llm, sparsity_ratio, sparsity_targets,
-                               eval, eval_task, eval_batch_size, save_model,
-                               save_folder_name, vol, gpu_toleration,
-                               dc_secret)
-
-    with dsl.Condition(inference_target == 'GPU'):
-        gpu_model_optimization(download_llm, eval, eval_task, eval_batch_size,
-                               save_model, save_folder_name, vol,
-                               gpu_toleration, dc_secret)
-
-    with dsl.Condition(eval == True):
-        eval_llm_base = base_eval_op(model_path=MODEL_DIR, tasks=eval_task,
-                                     batch_size=eval_batch_size)
-        eval_llm_base.add_pvolumes({"/mnt/models": vol})
-        eval_llm_base.add_node_selector_constraint(
-            label_name='nvidia.com/gpu.present', value='true')
-        eval_llm_base.add_toleration(gpu_toleration)
-        eval_llm_base.add_resource_request('nvidia.com/gpu', "1")
-        eval_llm_base.add_resource_limit('nvidia.com/gpu', "1")
-        eval_llm_base.after(download_llm)
-
+    with dsl.Condition(sweep == False):
+        with dsl.Condition(inference_target == 'CPU'):
+            cpu_model_optimization(download_llm, sparsity_ratio,
+                                   sparsity_targets, eval, eval_task,
+                                   eval_batch_size, eval_shards, save_model,
+                                   save_folder_name, export_shapes, vol,
+                                   gpu_toleration, dc_secret)
+
+        with dsl.Condition(inference_target == 'GPU'):
+            gpu_model_optimization(download_llm, eval, eval_task,
+                                   eval_batch_size, eval_shards, save_model,
+                                   save_folder_name, vol, gpu_toleration,
+                                   dc_secret, num_examples, max_seq_len)
+
+        # The scores of the base model do not change from run to run, so
+        # they are only computed the first time
+        with dsl.Condition(eval == True):
+            eval_llm_base = add_cached_eval(
+                lookup_base_eval_op, store_eval_op, base_eval_op,
+                merge_eval_op, download_llm, vol, gpu_toleration,
+                MODEL_DIR.replace(BASE_DIR, EVAL_DIR), CACHE_DIR, eval_shards,
+                model_path=MODEL_DIR, tasks=eval_task,
+                batch_size=eval_batch_size)
+
+    # Try every sparsity ratio and quantize option on the same download, and
+    # keep the fastest candidate close enough to the base model scores
+    with dsl.Condition(sweep == True):
+        eval_llm_base = add_cached_eval(
+            lookup_base_eval_op, store_eval_op, base_eval_op, merge_eval_op,
+            download_llm, vol, gpu_toleration,
+            MODEL_DIR.replace(BASE_DIR, EVAL_DIR), CACHE_DIR, eval_shards,
+            model_path=MODEL_DIR, tasks=eval_task, batch_size=eval_batch_size)
+        sweep_model_optimization(download_llm, sweep_sparsity_ratios,
+                                 sweep_quantize, sparsity_targets, eval_task,
+                                 eval_batch_size, eval_shards, sweep_metric,
+                                 sweep_max_accuracy_drop, save_model,
+                                 save_folder_name, vol, gpu_toleration,
+                                 dc_secret, eval_llm_base)
 
 # Compile the pipeline
 TektonCompiler().compile(sparseml_pipeline, 'sparseml_simplified_pipeline.yaml')
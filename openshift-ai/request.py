@@ -4,6 +4,8 @@ import json
 import gradio as gr
 from openai import OpenAI
 
+from export_variants import select_model
+
 
 #URL = "https://SERVING_RUNTIME-predictor-NAMESPACE.apps.devcluster.openshift.com"
 #URL = "http://SERVER:8000/v1"
@@ -11,12 +13,19 @@ from openai import OpenAI
 MODEL_AUX = "/mnt/models-aux"
 MODEL = "/mnt/models"
 MODEL_VAR = "/var/models"
+MAX_TOKENS = 1000
+
+
+def get_model(client, prompt):
+    """The smallest variant served the prompt and its completion fit in."""
+    # About 4 characters a token, the server only lists the variant names
+    tokens = len(prompt) // 4 + MAX_TOKENS
+    return select_model([m.id for m in client.models.list().data], tokens)
 
 
 def get_answer(question, url):
     client = OpenAI(base_url=url, api_key="EMPTY")
-    model = client.models.list().data[0][1]
-    #model = client.models.list().data[0].id
+    model = get_model(client, question)
     print(f"Accessing model API '{model}'")
 
     #completion = client.completions.create(model=model, prompt=question, max_tokens=100, temperature=0.2)
@@ -26,7 +35,7 @@ def get_answer(question, url):
     completion = client.completions.create(
         model=model,
         prompt=prompt,
-        max_tokens=1000,
+        max_tokens=MAX_TOKENS,
         temperature=0.2,
         n=1,
         stream=stream)
@@ -43,7 +52,7 @@ def get_answer(question, url):
 
 def get_answer_chat(question, url):
     client = OpenAI(base_url=url, api_key="EMPTY")
-    model = client.models.list().data[0][1]
+    model = get_model(client, question)
     print(f"Accessing model API '{model}'")
 
     msg = [
@@ -55,7 +64,7 @@ def get_answer_chat(question, url):
         model=model,
         messages=msg,
         stream=True,
-        max_tokens=1000,
+        max_tokens=MAX_TOKENS,
         temperature=0.2)
     #return completion.choices[0].message.content
     response_content = []
@@ -0,0 +1,265 @@
+"""Size the pipeline steps for the model they process.
+
+The steps used to request the same GPUs whatever the model, three for the
+sparsification of TinyLlama as for a 70B one, and no CPU or memory at all.
+When the model is known at compile time, the pipeline reads its config.json
+and requests what every step needs for it, from this cost model, where P is
+the parameter count, h the hidden size, I the intermediate size, and S x L
+the calibration samples and their length:
+
+- sparse: SparseGPT on the bf16 model spread over the GPUs, so 2P bytes of
+  weights, the fp32 Hessians of the linear layers of one decoder layer,
+  4 * (6h^2 + I^2) bytes, and the inputs and outputs of that layer for the
+  whole calibration set, 2 * S * L * h * 2 bytes.
+- sparse_low_memory: SparseGPT on a CPU node, streaming the layers from the
+  safetensors one at a time (see sparsegpt.py), so the host memory only
+  holds the bf16 weights of a layer and of the embeddings, the Hessians and
+  the activations.
+- quantize_cpu: the SparseML quantization loads the model in fp32, 4P
+  bytes, and calibrates on the same activations, in fp32.
+- sparse_quantize_cpu: SparseGPT pruning and quantizing in one pass over
+  the bf16 model spread over the GPUs, so 2P bytes of weights, and the
+  Hessians and activations of a layer.
+- quantize_gpu: GPTQ on the fp16 model spread over the GPUs, so 2P bytes
+  of weights, and the Hessians and activations of a layer.
+- eval: vLLM with the weights on a single GPU, the rest of it is KV cache.
+- export: the fp32 model traced to ONNX on the CPU, 3 * 4P bytes of memory
+  for the model, the graph and its serialized weights.
+- serve: the optimized model served by vLLM, with room for the KV cache on
+  the GPUs. It is not a pipeline step: the nm-vLLM serving runtimes leave
+  the resources to the InferenceService, where they are set from the CLI
+  below. The DeepSparse manifests keep their fixed 2 CPU / 24Gi, as their
+  memory depends on the exported variants DeepSparse compiles (see
+  export_variants.py), which this cost model does not cover.
+
+The steps cast the weights to the dtype they work in, so only the sizes of
+the config matter, not its torch_dtype.
+
+The GPU memory is rounded up to whole GPUs of GPU_MEMORY_GIB (40, set the
+env var of the same name at compile time for other GPUs) with GPU_HEADROOM
+left for the CUDA context and fragmentation. The GPU steps get CPUs to feed
+them and host memory to load the weights through.
+
+The config is read from a local model folder or config.json, so compiling
+the pipeline does not need the network: set MODEL_CONFIG to one when
+model_name is a HF hub id, or FETCH_MODEL_CONFIG=1 to download it from the
+hub. Print the resources of a model, read from the hub if needed, with:
+
+    python openshift-ai/resource_model.py meta-llama/Llama-2-7b-hf
+"""
+import json
+import math
+import os
+import sys
+import urllib.request
+import warnings
+
+GIB = 2 ** 30
+# Memory of every GPU of the cluster
+GPU_MEMORY_GIB = float(os.environ.get('GPU_MEMORY_GIB', 40))
+# Share of the GPU memory that is not available to the tensors
+GPU_HEADROOM = 0.15
+MAX_GPUS = 8
+# Host memory of the processes themselves: python, CUDA, tokenizers
+BASE_MEMORY_GIB = 8
+
+# Calibration the steps run when it is only known at run time
+DEFAULT_SAMPLES = 512
+DEFAULT_SEQ_LEN = 512
+
+# Activations with a gate projection, three MLP matrices instead of two
+GATED_ACTIVATIONS = ('silu', 'swiglu', 'gelu_pytorch_tanh')
+
+STAGES = ('sparse', 'sparse_low_memory', 'quantize_cpu', 'sparse_quantize_cpu',
+          'quantize_gpu', 'eval', 'export', 'serve')
+
+
+def load_config(model, fetch=False):
+    """The config.json of a model folder, or with fetch of a HF hub model.
+
+    The hub is taken from the HF_ENDPOINT env var, and its token from
+    HF_TOKEN, as the download step does.
+    """
+    path = os.path.join(model, 'config.json') if os.path.isdir(model) \
+        else model
+    if os.path.isfile(path):
+        with open(path) as f:
+            return json.load(f)
+    if not fetch:
+        raise ValueError(f'{model} is no local model folder nor config.json, '
+                         f'set MODEL_CONFIG to one, or FETCH_MODEL_CONFIG=1 '
+                         f'to download it from the HF hub')
+    endpoint = os.environ.get('HF_ENDPOINT', 'https://huggingface.co')
+    request = urllib.request.Request(
+        f'{endpoint.rstrip("/")}/{model}/resolve/main/config.json')
+    if os.environ.get('HF_TOKEN'):
+        request.add_header('Authorization',
+                           f'Bearer {os.environ["HF_TOKEN"]}')
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.load(response)
+
+
+def _get(config, *names, default=None):
+    for name in names:
+        if config.get(name) is not None:
+            return config[name]
+    if default is None:
+        raise ValueError(f'The model config has none of {", ".join(names)}')
+    return default
+
+
+class ModelProfile:
+    """The sizes of a model the cost model takes, from its config.json."""
+
+    def __init__(self, config):
+        # Multimodal models nest the config of their language model
+        config = config.get('text_config', config)
+        self.model_type = config.get('model_type', '')
+        self.hidden_size = _get(config, 'hidden_size', 'n_embd', 'd_model')
+        self.layers = _get(config, 'num_hidden_layers', 'n_layer',
+                           'num_layers')
+        self.intermediate_size = _get(config, 'intermediate_size', 'n_inner',
+                                      'ffn_dim',
+                                      default=4 * self.hidden_size)
+        self.vocab_size = _get(config, 'vocab_size')
+        heads = _get(config, 'num_attention_heads', 'n_head')
+        kv_heads = _get(config, 'num_key_value_heads', default=heads)
+        self.kv_size = self.hidden_size * kv_heads // heads
+        self.experts = config.get('num_local_experts') or 1
+        self.tied_embeddings = config.get('tie_word_embeddings', True)
+        activation = config.get('hidden_act',
+                                config.get('activation_function', ''))
+        self.gated = (activation in GATED_ACTIVATIONS
+                      or self.model_type.startswith('gemma'))
+
+    @property
+    def layer_parameters(self):
+        """Parameter count of one decoder layer, from its linear layers."""
+        h = self.hidden_size
+        attention = 2 * h * h + 2 * h * self.kv_size
+        mlp = (3 if self.gated else 2) * h * self.intermediate_size
+        return attention + self.experts * mlp
+
+    @property
+    def embedding_parameters(self):
+        """Parameter count of the embeddings, and of the head if untied."""
+        return (self.vocab_size * self.hidden_size
+                * (1 if self.tied_embeddings else 2))
+
+    @property
+    def parameters(self):
+        """Parameter count, from the decoder layers and the embeddings."""
+        return self.embedding_parameters + self.layers * self.layer_parameters
+
+    @property
+    def hessian_bytes(self):
+        """The fp32 Hessians of the linear layers of one decoder layer."""
+        h = self.hidden_size
+        return 4 * (6 * h * h + self.intermediate_size ** 2)
+
+    def activation_bytes(self, samples, seq_len, dtype_bytes=2):
+        """Inputs and outputs of a decoder layer for the calibration set."""
+        return 2 * samples * seq_len * self.hidden_size * dtype_bytes
+
+
+class Resources:
+    """GPUs, CPUs and memory (GiB) a step requests."""
+
+    def __init__(self, gpus, cpu, memory_gib):
+        self.gpus = gpus
+        self.cpu = cpu
+        self.memory_gib = memory_gib
+
+    def __repr__(self):
+        return (f'Resources(gpus={self.gpus}, cpu={self.cpu}, '
+                f'memory_gib={self.memory_gib})')
+
+
+def gpus_for(bytes_needed):
+    """The GPUs bytes_needed fits on, leaving the GPU headroom free.
+
+    At most MAX_GPUS, the largest nodes have, warning when it does not fit.
+    """
+    usable = GPU_MEMORY_GIB * GIB * (1 - GPU_HEADROOM)
+    gpus = max(1, math.ceil(bytes_needed / usable))
+    if gpus > MAX_GPUS:
+        warnings.warn(f'{bytes_needed / GIB:.0f} GiB do not fit on {MAX_GPUS} '
+                      f'GPUs of {GPU_MEMORY_GIB:g} GiB, the step will run '
+                      f'out of memory')
+        return MAX_GPUS
+    return gpus
+
+
+def _host_memory(bytes_loaded):
+    return math.ceil(bytes_loaded / GIB) + BASE_MEMORY_GIB
+
+
+def stage_resources(profile, stage, samples=DEFAULT_SAMPLES,
+                    seq_len=DEFAULT_SEQ_LEN):
+    """The Resources stage needs for the model of profile.
+
+    samples and seq_len are the calibration of the compression steps.
+    """
+    weights = 2 * profile.parameters
+    if stage == 'sparse_low_memory':
+        return Resources(0, 16, _host_memory(
+            2 * (profile.layer_parameters + profile.embedding_parameters)
+            + profile.hessian_bytes
+            + profile.activation_bytes(samples, seq_len)))
+    if stage in ('sparse', 'quantize_gpu', 'sparse_quantize_cpu'):
+        gpus = gpus_for(weights + profile.hessian_bytes
+                        + profile.activation_bytes(samples, seq_len))
+        return Resources(gpus, 4 + 2 * gpus, _host_memory(weights))
+    if stage == 'quantize_cpu':
+        weights = 4 * profile.parameters
+        gpus = gpus_for(weights + profile.activation_bytes(samples, seq_len,
+                                                           4))
+        return Resources(gpus, 4 + 2 * gpus, _host_memory(weights))
+    if stage == 'eval':
+        # The eval steps run vLLM with tensor_parallel_size=1
+        if gpus_for(weights) > 1:
+            warnings.warn(f'The {weights / GIB:.0f} GiB of weights do not fit '
+                          f'on a GPU of {GPU_MEMORY_GIB:g} GiB, the eval '
+                          f'will fail')
+        return Resources(1, 4, _host_memory(weights))
+    if stage == 'export':
+        return Resources(0, 8, _host_memory(3 * 4 * profile.parameters))
+    if stage == 'serve':
+        # Half of the GPU memory for the KV cache of the concurrent requests
+        return Resources(gpus_for(2 * weights), 4, _host_memory(weights))
+    raise ValueError(f'Unknown stage {stage}, one of {", ".join(STAGES)}')
+
+
+def model_profile(model):
+    """The ModelProfile of model, None when its config can not be read.
+
+    The config is the MODEL_CONFIG one when set, and is only downloaded from
+    the hub with FETCH_MODEL_CONFIG=1. Without a profile, the steps keep the
+    fixed resources they always had.
+    """
+    try:
+        return ModelProfile(load_config(
+            os.environ.get('MODEL_CONFIG') or model,
+            fetch=os.environ.get('FETCH_MODEL_CONFIG') == '1'))
+    except (OSError, ValueError, KeyError) as e:
+        warnings.warn(f'Could not read the config of {model}, the steps are '
+                      f'not sized for it: {e}')
+        return None
+
+
+def main():
+    if len(sys.argv) != 2:
+        sys.exit('usage: resource_model.py MODEL')
+    profile = ModelProfile(load_config(sys.argv[1], fetch=True))
+    print(f'{sys.argv[1]}: {profile.parameters / 1e9:.2f}B parameters, '
+          f'{profile.layers} layers, hidden size {profile.hidden_size}, '
+          f'GPUs of {GPU_MEMORY_GIB:g} GiB')
+    print(f'{"stage":<20} {"gpus":>4} {"cpu":>4} {"memory":>7}')
+    for stage in STAGES:
+        resources = stage_resources(profile, stage)
+        print(f'{stage:<20} {resources.gpus:>4} {resources.cpu:>4} '
+              f'{resources.memory_gib:>5}Gi')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,421 @@
+"""Prune a model with SparseGPT without ever loading it whole.
+
+SparseML oneshot loads the whole model, so host memory and GPUs bound the
+models it can compress. prune_model_streaming builds the model empty and
+reads every decoder layer from the memory mapped safetensors for its turn,
+prunes it with the same SparseGPT as SparseML (SparseGptWrapper.fasterprune
+with sequential_update) on the outputs of the already pruned layer, and
+writes it out as a shard of the pruned model. Only one layer and the
+calibration activations are ever in memory, so a 7B model can be compressed
+on a CPU only node:
+
+    prune_model_streaming(model_path, output_dir, calibration.examples(),
+                          0.5, targets, checkpoint_dir=path, device='cpu')
+
+It is the low_memory mode of the sparsification step, the default one runs
+oneshot (see oneshot_checkpoints.py). The checkpoint folder holds the pruned
+layers and the activations the next layer takes, so a rerun with the same
+checkpoint_key continues from the last finished layer.
+
+This module is baked into the sparseml image, see sparseml_Dockerfile.
+"""
+import json
+import math
+import os
+import re
+import shutil
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+PROGRESS_FILE = 'progress.json'
+SAFETENSORS_WEIGHTS = 'model.safetensors'
+SAFETENSORS_INDEX = 'model.safetensors.index.json'
+
+
+class SparseGPT:
+    """Hessian of the inputs of a linear layer, and its pruning."""
+
+    def __init__(self, layer):
+        self.layer = layer
+        self.columns = layer.weight.shape[1]
+        self.hessian = torch.zeros((self.columns, self.columns),
+                                   device=layer.weight.device)
+        self.samples = 0
+
+    def add_batch(self, inputs):
+        # Mean over the samples, weighted as SparseML does
+        batch = inputs.shape[0] if inputs.dim() == 3 else 1
+        inputs = inputs.reshape(-1, inputs.shape[-1]).t().float()
+        self.hessian *= self.samples / (self.samples + batch)
+        self.samples += batch
+        inputs = math.sqrt(2 / self.samples) * inputs
+        self.hessian += inputs.matmul(inputs.t())
+
+    @torch.no_grad()
+    def prune(self, sparsity, prunen=0, prunem=0, blocksize=128,
+              percdamp=0.01):
+        """Prune the layer to sparsity, updating the weights left."""
+        weight = self.layer.weight.data.clone().float()
+        hessian = self.hessian
+        dead = torch.diag(hessian) == 0
+        hessian[dead, dead] = 1
+        weight[:, dead] = 0
+
+        damp = percdamp * torch.mean(torch.diag(hessian))
+        diag = torch.arange(self.columns, device=hessian.device)
+        hessian[diag, diag] += damp
+        hessian = torch.linalg.cholesky(hessian)
+        hessian = torch.cholesky_inverse(hessian)
+        hinv = torch.linalg.cholesky(hessian, upper=True)
+
+        # See section 3.4 of https://arxiv.org/abs/2203.07259
+        for i1 in range(0, self.columns, blocksize):
+            i2 = min(i1 + blocksize, self.columns)
+            w1 = weight[:, i1:i2].clone()
+            q1 = torch.zeros_like(w1)
+            err1 = torch.zeros_like(w1)
+            hinv1 = hinv[i1:i2, i1:i2]
+
+            if prunen == 0:
+                scores = w1 ** 2 / torch.diag(hinv1).reshape((1, -1)) ** 2
+                threshold = torch.sort(scores.flatten())[0][
+                    int(scores.numel() * sparsity)]
+                mask1 = scores <= threshold
+            else:
+                mask1 = torch.zeros_like(w1) == 1
+
+            for i in range(i2 - i1):
+                w = w1[:, i]
+                d = hinv1[i, i]
+                if prunen != 0 and i % prunem == 0:
+                    scores = (w1[:, i:i + prunem] ** 2
+                              / torch.diag(hinv1)[i:i + prunem].reshape(
+                                  (1, -1)) ** 2)
+                    mask1.scatter_(1, i + torch.topk(
+                        scores, prunen, dim=1, largest=False)[1], True)
+                q = w.clone()
+                q[mask1[:, i]] = 0
+                q1[:, i] = q
+                err = (w - q) / d
+                w1[:, i:] -= err.unsqueeze(1).matmul(hinv1[i, i:].unsqueeze(0))
+                err1[:, i] = err
+
+            weight[:, i1:i2] = q1
+            weight[:, i2:] -= err1.matmul(hinv[i1:i2, i2:])
+
+        self.layer.weight.data = weight.to(self.layer.weight.dtype)
+        del self.hessian
+
+
+def _matches(name, targets):
+    """Whether name is one of the SparseML targets, names or re: patterns."""
+    return any(re.match(target[3:], name) if target.startswith('re:')
+               else name == target for target in targets)
+
+
+def decoder_layers(model):
+    """The name and ModuleList of the decoder layers of a model."""
+    for name, module in model.named_modules():
+        if isinstance(module, torch.nn.ModuleList) and name.endswith('layers'):
+            return name, module
+    raise ValueError(f'No decoder layers found in {type(model).__name__}')
+
+
+class _Catcher(torch.nn.Module):
+    """Stands in for the first decoder layer, to capture its inputs."""
+
+    class Captured(Exception):
+        pass
+
+    def __init__(self, layer):
+        super().__init__()
+        self.layer = layer
+        self.inputs = []
+        self.kwargs = []
+
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(self._modules['layer'], name)
+
+    def forward(self, hidden_states, **kwargs):
+        self.inputs.append(hidden_states)
+        self.kwargs.append(kwargs)
+        raise self.Captured()
+
+
+@torch.no_grad()
+def capture_inputs(model, layers, examples, device):
+    """The hidden states and kwargs the first decoder layer gets."""
+    catcher = _Catcher(layers[0])
+    layers[0] = catcher
+    try:
+        for example in examples:
+            input_ids = torch.tensor([example['input_ids']])
+            try:
+                model(input_ids=input_ids.to(model.device), use_cache=False)
+            except _Catcher.Captured:
+                pass
+    finally:
+        layers[0] = catcher.layer
+    kwargs = [{key: _to(value, device) for key, value in sample.items()}
+              for sample in catcher.kwargs]
+    return [hidden.to(device) for hidden in catcher.inputs], kwargs
+
+
+def _to(value, device):
+    if isinstance(value, torch.Tensor):
+        return value.to(device)
+    if isinstance(value, tuple):
+        return tuple(_to(item, device) for item in value)
+    return value
+
+
+def _output(output):
+    # Decoder layers return a tuple in older transformers
+    return output[0] if isinstance(output, tuple) else output
+
+
+@torch.no_grad()
+def prune_layer(layer, inputs, kwargs, sparsity, **prune_args):
+    """Prune the linear layers of a decoder layer on its inputs."""
+    pruners = {name: SparseGPT(module) for name, module
+               in layer.named_modules() if isinstance(module, torch.nn.Linear)}
+    handles = [module.register_forward_hook(
+        lambda module, args, output, name=name:
+        pruners[name].add_batch(args[0].data))
+        for name, module in layer.named_modules() if name in pruners]
+    try:
+        for hidden, sample_kwargs in zip(inputs, kwargs):
+            layer(hidden, **sample_kwargs)
+    finally:
+        for handle in handles:
+            handle.remove()
+    for pruner in pruners.values():
+        pruner.prune(sparsity, **prune_args)
+
+
+def _save_atomic(tensors, path):
+    save_file({name: tensor.detach().contiguous().cpu()
+               for name, tensor in tensors.items()}, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+class Checkpoints:
+    """The layers pruned so far, and the inputs of the next one, in path.
+
+    Every layer is saved with the full names of its tensors, as a shard of
+    the model. progress.json is written after the files of a layer, so it
+    always points to complete ones, and a different key starts over.
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.completed = -1
+        progress = os.path.join(path, PROGRESS_FILE)
+        if os.path.exists(progress):
+            with open(progress) as f:
+                saved = json.load(f)
+            if saved['key'] == key:
+                self.completed = saved['completed']
+            else:
+                print(f'Checkpoints in {path} are for other settings, '
+                      f'starting over')
+                shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+
+    def layer_path(self, index):
+        return os.path.join(self.path, f'layer-{index:05d}.safetensors')
+
+    def _activations_path(self, index):
+        return os.path.join(self.path, f'activations-{index:05d}.safetensors')
+
+    def save(self, index, name, layer, outputs):
+        _save_atomic({f'{name}.{key}': tensor for key, tensor
+                      in layer.state_dict().items()}, self.layer_path(index))
+        _save_atomic({str(i): output for i, output in enumerate(outputs)},
+                     self._activations_path(index))
+        with open(os.path.join(self.path, PROGRESS_FILE + '.tmp'), 'w') as f:
+            json.dump({'key': self.key, 'completed': index}, f)
+        os.replace(os.path.join(self.path, PROGRESS_FILE + '.tmp'),
+                   os.path.join(self.path, PROGRESS_FILE))
+        if index > 0:
+            # Only the inputs of the next layer are needed to resume
+            try:
+                os.remove(self._activations_path(index - 1))
+            except FileNotFoundError:
+                pass
+        self.completed = index
+
+    def restore(self, device):
+        """The inputs of the next layer."""
+        activations = load_file(self._activations_path(self.completed),
+                                device=str(device))
+        return [activations[str(i)] for i in range(len(activations))]
+
+
+def _prune_layers(layers, prefix, inputs, kwargs, sparsity, targets, device,
+                  checkpoints, start, weights, **prune_args):
+    """Prune layers from start on, each on the outputs of the previous one.
+
+    The layers are loaded from weights, a SafetensorsWeights, for their turn
+    and emptied afterwards.
+    """
+    for index in range(start, len(layers)):
+        name = f'{prefix}.{index}'
+        layer = layers[index]
+        weights.load(layer, name, device)
+        if _matches(name, targets):
+            print(f'Pruning layer {index + 1}/{len(layers)} to sparsity '
+                  f'{sparsity}')
+            prune_layer(layer, inputs, kwargs, sparsity, **prune_args)
+        # The next layer is calibrated on the outputs of the pruned one
+        with torch.no_grad():
+            inputs = [_output(layer(hidden, **sample_kwargs))
+                      for hidden, sample_kwargs in zip(inputs, kwargs)]
+        checkpoints.save(index, name, layer, inputs)
+        layer.to('meta')
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+
+def _device(device):
+    return torch.device(device or ('cuda' if torch.cuda.is_available()
+                                   else 'cpu'))
+
+
+class SafetensorsWeights:
+    """The tensors of the safetensors weights of a model folder, mmapped."""
+
+    def __init__(self, model_path, dtype):
+        self.model_path = model_path
+        self.dtype = dtype
+        index = os.path.join(model_path, SAFETENSORS_INDEX)
+        if os.path.exists(index):
+            with open(index) as f:
+                self.weight_map = json.load(f)['weight_map']
+        elif os.path.exists(os.path.join(model_path, SAFETENSORS_WEIGHTS)):
+            with safe_open(os.path.join(model_path, SAFETENSORS_WEIGHTS),
+                           framework='pt') as f:
+                self.weight_map = {name: SAFETENSORS_WEIGHTS
+                                   for name in f.keys()}
+        else:
+            raise ValueError(f'No safetensors weights in {model_path}, the '
+                             f'low memory compression only streams those')
+        self._files = {}
+
+    def get(self, name):
+        file = self.weight_map[name]
+        if file not in self._files:
+            self._files[file] = safe_open(
+                os.path.join(self.model_path, file), framework='pt')
+        tensor = self._files[file].get_tensor(name)
+        return tensor.to(self.dtype) if tensor.is_floating_point() else tensor
+
+    def load(self, module, prefix, device, names=None):
+        """Materialize the tensors of the empty module, named under prefix.
+
+        All the ones of its state dict, or only names.
+        """
+        for name in module.state_dict() if names is None else names:
+            full_name = f'{prefix}.{name}' if prefix else name
+            if full_name not in self.weight_map:
+                raise ValueError(f'{full_name} is not in the weights of '
+                                 f'{self.model_path}')
+            owner_name, _, attribute = name.rpartition('.')
+            owner = module.get_submodule(owner_name)
+            value = self.get(full_name).to(device)
+            if attribute in owner._parameters:
+                owner._parameters[attribute] = torch.nn.Parameter(
+                    value, requires_grad=False)
+            else:
+                owner._buffers[attribute] = value
+
+
+def prune_model_streaming(model_path, output_dir, examples, sparsity, targets,
+                          checkpoint_dir, checkpoint_key='', device=None,
+                          dtype=torch.bfloat16, **prune_args):
+    """Prune the model in model_path into output_dir, a layer at a time.
+
+    Only the weights of the layer being pruned, the ones outside of the
+    decoder layers (embeddings, norm, head) and the calibration activations
+    are ever in memory: the model is built empty and every layer is read
+    from the memory mapped safetensors for its turn, so a model far bigger
+    than the host memory can be compressed on a CPU only node. The layers
+    are written as the shards of the output as they are done, checkpointed
+    in checkpoint_dir, and moved to output_dir at the end, with the config.
+    """
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    device = _device(device)
+    config = AutoConfig.from_pretrained(model_path)
+    # Parameters on the meta device, the buffers (e.g. rotary embeddings)
+    # computed as usual
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=dtype)
+    model.eval()
+    weights = SafetensorsWeights(model_path, dtype)
+    prefix, layers = decoder_layers(model)
+
+    outside = [name for name in model.state_dict()
+               if not name.startswith(prefix + '.')]
+    weights.load(model, '', 'cpu', [name for name in outside
+                                    if name in weights.weight_map])
+    # The head tied to the embeddings is not in the weights
+    model.tie_weights()
+    empty = [name for name, tensor in model.state_dict().items()
+             if tensor.is_meta and not name.startswith(prefix + '.')]
+    if empty:
+        raise ValueError(f'{", ".join(empty)} not in the weights of '
+                         f'{model_path}')
+
+    inputs, kwargs = capture_inputs(model, layers, examples, device)
+    checkpoints = Checkpoints(checkpoint_dir, checkpoint_key)
+    start = 0
+    if checkpoints.completed >= 0:
+        inputs = checkpoints.restore(device)
+        start = checkpoints.completed + 1
+        print(f'Resuming from layer {start} of {len(layers)}, '
+              f'{checkpoint_dir}')
+    _prune_layers(layers, prefix, inputs, kwargs, sparsity, targets, device,
+                  checkpoints, start, weights, **prune_args)
+
+    # A shard per layer, and a last one with the rest of the weights
+    os.makedirs(output_dir, exist_ok=True)
+    shards = len(layers) + 1
+    weight_map = {}
+    for index in range(len(layers)):
+        shard = f'model-{index + 1:05d}-of-{shards:05d}.safetensors'
+        with safe_open(checkpoints.layer_path(index), framework='pt') as f:
+            weight_map.update({name: shard for name in f.keys()})
+        _link(checkpoints.layer_path(index), os.path.join(output_dir, shard))
+    shard = f'model-{shards:05d}-of-{shards:05d}.safetensors'
+    rest = {name: tensor for name, tensor
+            in model.state_dict(keep_vars=False).items()
+            if name in outside and name in weights.weight_map}
+    _save_atomic(rest, os.path.join(output_dir, shard))
+    weight_map.update({name: shard for name in rest})
+    total_size = sum(os.path.getsize(os.path.join(output_dir, file))
+                     for file in set(weight_map.values()))
+    with open(os.path.join(output_dir, SAFETENSORS_INDEX), 'w') as f:
+        json.dump({'metadata': {'total_size': total_size},
+                   'weight_map': weight_map}, f, indent=2)
+    config.torch_dtype = dtype
+    config.save_pretrained(output_dir)
+    if os.path.exists(os.path.join(model_path, 'generation_config.json')):
+        shutil.copy(os.path.join(model_path, 'generation_config.json'),
+                    output_dir)
+
+
+def _link(source, destination):
+    # The checkpoint stays complete until it is removed, in case the pod
+    # dies before the output is
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy(source, destination)
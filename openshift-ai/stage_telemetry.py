@@ -0,0 +1,229 @@
+"""Record the resources every pipeline step uses.
+
+pipeline_helpers.add_telemetry wraps the command of every step with this
+script, which runs it and writes what it took to the shared volume, one JSON
+file per step and pod under the folder of the run:
+
+    /mnt/models/telemetry/<run>/<task>-<pod>.json
+
+with the wall and CPU time, the peak RSS and memory (and GPU memory, when
+nvidia-smi is there), the disk and network bytes read and written, and the
+time between the phase marks of the step. The steps mark their phases with:
+
+    from stage_telemetry import mark
+    mark('quantize')
+
+Each phase lasts until the next mark, or the end of the step. The script is
+baked into every image the steps run on, in /opt/nm, their PYTHONPATH, so it
+only uses the standard library, which all of them have.
+telemetry_report.py aggregates the files of many runs.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PHASES_ENV = 'STAGE_TELEMETRY_PHASES'
+CGROUP = '/sys/fs/cgroup'
+# Seconds between the GPU memory samples
+SAMPLE_INTERVAL = 5
+
+
+def mark(phase):
+    """Start the phase of the running step, ending the previous one."""
+    path = os.environ.get(PHASES_ENV)
+    if not path:
+        return
+    with open(path, 'a') as f:
+        f.write(json.dumps({'phase': phase, 'time': time.time()}) + '\n')
+
+
+def _read_stat(path):
+    """The key value lines of a cgroup stat file, None if unavailable."""
+    try:
+        with open(path) as f:
+            return {key: int(value) for key, value in
+                    (line.split() for line in f if len(line.split()) == 2)}
+    except (OSError, ValueError):
+        return None
+
+
+def _read_int(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def _io_bytes():
+    """Bytes read and written to the block devices by the container."""
+    try:
+        with open(os.path.join(CGROUP, 'io.stat')) as f:
+            lines = f.read().split('\n')
+    except OSError:
+        return None
+    read = written = 0
+    for line in lines:
+        for field in line.split()[1:]:
+            key, _, value = field.partition('=')
+            if key == 'rbytes':
+                read += int(value)
+            elif key == 'wbytes':
+                written += int(value)
+    return read, written
+
+
+def _net_bytes():
+    """Bytes received and sent by the pod, loopback aside."""
+    try:
+        with open('/proc/net/dev') as f:
+            lines = f.readlines()[2:]
+    except OSError:
+        return None
+    received = sent = 0
+    for line in lines:
+        interface, _, counters = line.partition(':')
+        if interface.strip() != 'lo':
+            counters = counters.split()
+            received += int(counters[0])
+            sent += int(counters[8])
+    return received, sent
+
+
+def _snapshot():
+    return {'time': time.time(), 'cpu': _read_stat(
+        os.path.join(CGROUP, 'cpu.stat')), 'io': _io_bytes(),
+            'net': _net_bytes()}
+
+
+class GPUMemorySampler(threading.Thread):
+    """Peak GPU memory used on the devices of the pod, from nvidia-smi."""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                output = subprocess.run(
+                    ['nvidia-smi', '--query-gpu=memory.used',
+                     '--format=csv,noheader,nounits'], capture_output=True,
+                    text=True, timeout=30).stdout
+                used = sum(int(line) for line in output.split() if line)
+                self.peak = max(self.peak or 0, used * 2 ** 20)
+            except (OSError, ValueError, subprocess.SubprocessError):
+                return
+            if self.stopped.wait(SAMPLE_INTERVAL):
+                return
+
+
+def _phases(path, start, end):
+    try:
+        with open(path) as f:
+            marks = [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        marks = []
+    marks = [{'phase': 'setup', 'time': start}] + marks
+    return [{'phase': current['phase'],
+             'seconds': round(following['time'] - current['time'], 3)}
+            for current, following in zip(marks, marks[1:] + [{'time': end}])]
+
+
+def run(command, stage, task, run_name, output_dir):
+    """Run the step command, and record its telemetry. Returns its code."""
+    phases_path = tempfile.mkstemp(suffix='.jsonl')[1]
+    env = dict(os.environ, **{PHASES_ENV: phases_path})
+
+    gpu = GPUMemorySampler() if shutil.which('nvidia-smi') else None
+    if gpu:
+        gpu.start()
+    before = _snapshot()
+    process = subprocess.Popen(command, env=env)
+    # Let the step clean up when the pod is stopped
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum,
+                      lambda signum, frame: process.send_signal(signum))
+    returncode = process.wait()
+    after = _snapshot()
+    if gpu:
+        gpu.stopped.set()
+        gpu.join()
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    telemetry = {
+        'stage': stage, 'task': task, 'run': run_name,
+        'pod': socket.gethostname(), 'start': before['time'],
+        'returncode': returncode,
+        'wall_seconds': round(after['time'] - before['time'], 3),
+        # The cgroup counts the whole container, subprocesses included,
+        # rusage only the processes waited for
+        'cpu_user_seconds': round(usage.ru_utime, 3),
+        'cpu_system_seconds': round(usage.ru_stime, 3),
+        # Of the biggest process, and of the container, page cache included
+        'peak_rss_bytes': usage.ru_maxrss * 1024,
+        'peak_memory_bytes': _read_int(os.path.join(CGROUP, 'memory.peak')),
+        'peak_gpu_memory_bytes': gpu.peak if gpu else None,
+        'disk_read_bytes': usage.ru_inblock * 512,
+        'disk_write_bytes': usage.ru_oublock * 512,
+        'net_received_bytes': None, 'net_sent_bytes': None,
+        'phases': _phases(phases_path, before['time'], after['time']),
+    }
+    if before['cpu'] and after['cpu']:
+        for key, name in (('user_usec', 'cpu_user_seconds'),
+                          ('system_usec', 'cpu_system_seconds')):
+            if key in before['cpu'] and key in after['cpu']:
+                telemetry[name] = round(
+                    (after['cpu'][key] - before['cpu'][key]) / 1e6, 3)
+    if before['io'] and after['io']:
+        telemetry['disk_read_bytes'] = after['io'][0] - before['io'][0]
+        telemetry['disk_write_bytes'] = after['io'][1] - before['io'][1]
+    if before['net'] and after['net']:
+        telemetry['net_received_bytes'] = after['net'][0] - before['net'][0]
+        telemetry['net_sent_bytes'] = after['net'][1] - before['net'][1]
+    os.remove(phases_path)
+
+    print('Telemetry: ' + json.dumps(telemetry))
+    if output_dir:
+        try:
+            run_dir = os.path.join(output_dir, run_name)
+            os.makedirs(run_dir, exist_ok=True)
+            path = os.path.join(run_dir, f"{task}-{telemetry['pod']}.json")
+            with open(path + '.tmp', 'w') as f:
+                json.dump(telemetry, f, indent=2)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            # Never fail a step for its telemetry
+            print(f'Could not write the telemetry to {output_dir}: {e}')
+    return returncode
+
+
+def main():
+    argv = sys.argv[1:]
+    if '--' not in argv:
+        sys.exit('usage: stage_telemetry.py [options] -- command ...')
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stage', required=True)
+    parser.add_argument('--task', required=True)
+    parser.add_argument('--run', required=True)
+    parser.add_argument('--output-dir', default='',
+                        help='folder to write the telemetry of the run to')
+    args = parser.parse_args(argv[:argv.index('--')])
+    returncode = run(argv[argv.index('--') + 1:], args.stage, args.task,
+                     args.run, args.output_dir)
+    # Killed by a signal, as a shell reports it
+    sys.exit(128 - returncode if returncode < 0 else returncode)
+
+
+if __name__ == '__main__':
+    main()
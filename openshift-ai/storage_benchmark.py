@@ -0,0 +1,86 @@
+"""Compare the plain and packed model layouts against an S3 endpoint.
+
+Uploads and downloads a local model folder in both layouts of
+model_storage.py and prints the time, throughput and stored size of each.
+It reads the same env vars as the pipeline components, e.g. for the MinIO
+deployed with minio.yaml:
+
+    export s3_host=http://minio-service.object-datastore.svc:9000
+    export s3_access_key=minio s3_secret_access_key=minio_1_2_3 s3_bucket=models
+    python openshift-ai/storage_benchmark.py /mnt/models/llm
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from model_storage import ModelStorage
+
+
+def folder_size(path):
+    return sum(os.path.getsize(os.path.join(root, file))
+               for root, dirs, files in os.walk(path) for file in files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('model_path', help='local model folder to transfer')
+    parser.add_argument('--name', default='storage-benchmark',
+                        help='bucket folder prefix used for the runs')
+    parser.add_argument('--max-concurrency', type=int, default=10)
+    parser.add_argument('--file-concurrency', type=int, default=4)
+    parser.add_argument('--multipart-chunksize-mb', type=int, default=64)
+    parser.add_argument('--pack-chunk-mb', type=int, default=16)
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the uploaded objects in the bucket')
+    args = parser.parse_args()
+
+    size = folder_size(args.model_path)
+    results = []
+    for layout in ('plain', 'packed'):
+        storage = ModelStorage(args.max_concurrency, args.file_concurrency,
+                               args.multipart_chunksize_mb)
+        name = f'{args.name}-{layout}'
+
+        start = time.perf_counter()
+        storage.upload(args.model_path, name, sync=False, layout=layout,
+                       pack_chunk_mb=args.pack_chunk_mb)
+        upload_time = time.perf_counter() - start
+
+        local_path = tempfile.mkdtemp()
+        try:
+            start = time.perf_counter()
+            storage.download(name, local_path, sync=False)
+            download_time = time.perf_counter() - start
+            if folder_size(local_path) != size:
+                raise RuntimeError(f'{layout} download does not match '
+                                   f'{args.model_path}')
+        finally:
+            shutil.rmtree(local_path)
+
+        objects = storage.list_objects(name + '/')
+        stored = sum(object['Size'] for object in objects)
+        results.append((layout, upload_time, download_time, stored,
+                        len(objects), storage.metrics.calls))
+
+        if not args.keep:
+            for object in objects:
+                storage.client.delete_object(Bucket=storage.bucket_name,
+                                             Key=object['Key'])
+            storage.client.delete_object(Bucket=storage.bucket_name,
+                                         Key=name + '.manifest.json')
+
+    print(f'\n{size / 2**20:.1f} MiB model at {args.model_path}')
+    print(f'{"layout":<8}{"upload s":>10}{"MiB/s":>9}{"download s":>12}'
+          f'{"MiB/s":>9}{"stored MiB":>12}{"objects":>9}{"requests":>10}')
+    for layout, upload_time, download_time, stored, count, calls in results:
+        requests = sum(count for count, total in calls.values())
+        print(f'{layout:<8}{upload_time:>10.1f}'
+              f'{size / 2**20 / upload_time:>9.1f}{download_time:>12.1f}'
+              f'{size / 2**20 / download_time:>9.1f}{stored / 2**20:>12.1f}'
+              f'{count:>9}{requests:>10}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""Aggregate the telemetry the pipeline steps write, across runs.
+
+Every step of every run writes what it took under the telemetry folder of
+the shared volume, see stage_telemetry.py. This sums it up per stage, with
+the share of the pipeline hours each one takes and where its time goes:
+
+    python openshift-ai/telemetry_report.py /mnt/models/telemetry
+    python openshift-ai/telemetry_report.py /mnt/models/telemetry --last 10
+    python openshift-ai/telemetry_report.py /mnt/models/telemetry --json
+
+Run it from a pod mounting the volume, or on a copy of the folder.
+"""
+import argparse
+import json
+import os
+import statistics
+
+
+def load_runs(telemetry_dir, runs=None, last=0):
+    """The telemetry of every step, by run, the most recent runs last."""
+    loaded = {}
+    for run in sorted(os.listdir(telemetry_dir)):
+        run_dir = os.path.join(telemetry_dir, run)
+        if not os.path.isdir(run_dir) or (runs and run not in runs):
+            continue
+        steps = []
+        for file in sorted(os.listdir(run_dir)):
+            if file.endswith('.json'):
+                with open(os.path.join(run_dir, file)) as f:
+                    steps.append(json.load(f))
+        if steps:
+            loaded[run] = steps
+    ordered = sorted(loaded, key=lambda run: min(step['start']
+                                                 for step in loaded[run]))
+    if last:
+        ordered = ordered[-last:]
+    return {run: loaded[run] for run in ordered}
+
+
+def _total(steps, key):
+    values = [step.get(key) for step in steps if step.get(key) is not None]
+    return sum(values) if values else None
+
+
+def _peak(steps, key):
+    values = [step.get(key) for step in steps if step.get(key) is not None]
+    return max(values) if values else None
+
+
+def summarize(runs):
+    """Per stage totals and peaks of the steps of all the runs."""
+    stages = {}
+    for run, steps in runs.items():
+        for step in steps:
+            stages.setdefault(step['stage'], []).append(step)
+    total_wall = sum(step['wall_seconds'] for steps in runs.values()
+                     for step in steps)
+
+    summary = []
+    for stage, steps in stages.items():
+        walls = [step['wall_seconds'] for step in steps]
+        phases = {}
+        for step in steps:
+            for phase in step.get('phases', []):
+                phases[phase['phase']] = (phases.get(phase['phase'], 0)
+                                          + phase['seconds'])
+        cpu = [step['cpu_user_seconds'] + step['cpu_system_seconds']
+               for step in steps]
+        summary.append({
+            'stage': stage,
+            'runs': len({step['run'] for step in steps}),
+            'steps': len(steps),
+            'failed': sum(1 for step in steps if step['returncode'] != 0),
+            'wall_hours': sum(walls) / 3600,
+            'wall_share': sum(walls) / total_wall if total_wall else 0,
+            'median_wall_seconds': statistics.median(walls),
+            'max_wall_seconds': max(walls),
+            'cpu_hours': sum(cpu) / 3600,
+            'peak_rss_bytes': _peak(steps, 'peak_rss_bytes'),
+            'peak_memory_bytes': _peak(steps, 'peak_memory_bytes'),
+            'peak_gpu_memory_bytes': _peak(steps, 'peak_gpu_memory_bytes'),
+            'disk_read_bytes': _total(steps, 'disk_read_bytes'),
+            'disk_write_bytes': _total(steps, 'disk_write_bytes'),
+            'net_received_bytes': _total(steps, 'net_received_bytes'),
+            'net_sent_bytes': _total(steps, 'net_sent_bytes'),
+            'phase_seconds': dict(sorted(phases.items(),
+                                         key=lambda item: -item[1])),
+        })
+    return sorted(summary, key=lambda stage: -stage['wall_hours'])
+
+
+def _gib(value):
+    return '-' if value is None else f'{value / 2 ** 30:.1f}'
+
+
+def print_summary(runs, summary):
+    print(f'{len(runs)} runs, '
+          f'{sum(stage["wall_hours"] for stage in summary):.2f} step hours')
+    print(f'{"stage":<24} {"steps":>5} {"fail":>4} {"hours":>7} {"share":>6} '
+          f'{"median s":>9} {"cpu h":>6} {"rss GiB":>7} {"gpu GiB":>7} '
+          f'{"disk r/w GiB":>13} {"net in/out GiB":>14}')
+    for stage in summary:
+        disk = (_gib(stage['disk_read_bytes']) + '/'
+                + _gib(stage['disk_write_bytes']))
+        net = (_gib(stage['net_received_bytes']) + '/'
+               + _gib(stage['net_sent_bytes']))
+        print(f'{stage["stage"]:<24} {stage["steps"]:>5} '
+              f'{stage["failed"]:>4} {stage["wall_hours"]:>7.2f} '
+              f'{stage["wall_share"]:>6.1%} '
+              f'{stage["median_wall_seconds"]:>9.0f} '
+              f'{stage["cpu_hours"]:>6.2f} '
+              f'{_gib(stage["peak_rss_bytes"]):>7} '
+              f'{_gib(stage["peak_gpu_memory_bytes"]):>7} '
+              f'{disk:>13} {net:>14}')
+    print()
+    for stage in summary:
+        total = sum(stage['phase_seconds'].values())
+        phases = ', '.join(f'{phase} {seconds / total:.0%}'
+                           for phase, seconds in stage['phase_seconds'].items()
+                           if total)
+        print(f'{stage["stage"]:<24} {phases}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('telemetry_dir',
+                        help='telemetry folder, with a folder per run')
+    parser.add_argument('--run', action='append', dest='runs',
+                        help='only this run, can be repeated')
+    parser.add_argument('--last', type=int, default=0,
+                        help='only the last LAST runs')
+    parser.add_argument('--json', action='store_true',
+                        help='print the summary as JSON')
+    args = parser.parse_args()
+
+    runs = load_runs(args.telemetry_dir, args.runs, args.last)
+    if not runs:
+        raise SystemExit(f'No telemetry found in {args.telemetry_dir}')
+    summary = summarize(runs)
+    if args.json:
+        print(json.dumps({'runs': list(runs), 'stages': summary}, indent=2))
+    else:
+        print_summary(runs, summary)
+
+
+if __name__ == '__main__':
+    main()
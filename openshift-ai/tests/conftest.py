@@ -0,0 +1,75 @@
+import os
+import sys
+
+# The modules are baked into the images under /opt/nm and imported from
+# there, so the tests import them from the folder they are copied from
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json  # noqa: E402
+
+import pytest  # noqa: E402
+
+# Vocabulary of the tokenizer of calibration_llama
+WORDS = [f'w{i}' for i in range(400)]
+
+
+def word_tokenizer():
+    """A word level tokenizer of WORDS, built offline."""
+    tokenizers = pytest.importorskip('tokenizers')
+    transformers = pytest.importorskip('transformers')
+    vocab = {'<unk>': 0, '<s>': 1, '</s>': 2,
+             **{word: i + 3 for i, word in enumerate(WORDS)}}
+    model = tokenizers.Tokenizer(tokenizers.models.WordLevel(
+        vocab, unk_token='<unk>'))
+    model.pre_tokenizer = tokenizers.pre_tokenizers.WhitespaceSplit()
+    return transformers.PreTrainedTokenizerFast(
+        tokenizer_object=model, unk_token='<unk>', bos_token='<s>',
+        eos_token='</s>', pad_token='</s>',
+        model_input_names=['input_ids', 'attention_mask'])
+
+
+@pytest.fixture(scope='session')
+def calibration_llama(tmp_path_factory):
+    """A tiny Llama folder with its tokenizer and a calibration set.
+
+    texts.json has the calibration texts, examples.json their tokens.
+    """
+    torch = pytest.importorskip('torch')
+    transformers = pytest.importorskip('transformers')
+    path = str(tmp_path_factory.mktemp('calibration-llama'))
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(
+        hidden_size=128, intermediate_size=256, num_hidden_layers=3,
+        num_attention_heads=4, num_key_value_heads=4,
+        vocab_size=len(WORDS) + 3, max_position_embeddings=128)
+    transformers.LlamaForCausalLM(config).save_pretrained(
+        path, safe_serialization=True)
+    tokenizer = word_tokenizer()
+    tokenizer.save_pretrained(path)
+
+    generator = torch.Generator().manual_seed(1)
+    texts = [' '.join(WORDS[i] for i in torch.randint(
+        0, len(WORDS), (int(torch.randint(16, 48, (1,), generator=generator)),),
+        generator=generator).tolist()) for _ in range(16)]
+    with open(os.path.join(path, 'texts.json'), 'w') as f:
+        json.dump(texts, f)
+    with open(os.path.join(path, 'examples.json'), 'w') as f:
+        json.dump([{'input_ids': ids}
+                   for ids in tokenizer(texts)['input_ids']], f)
+    return path
+
+
+def load_weights(path):
+    """The tensors of the weight files, safetensors or not, of a model folder."""
+    import torch
+    from safetensors.torch import load_file
+
+    tensors = {}
+    for file in sorted(os.listdir(path)):
+        if file.endswith('.safetensors'):
+            tensors.update(load_file(os.path.join(path, file)))
+        elif file.startswith('pytorch_model') and file.endswith('.bin'):
+            tensors.update(torch.load(os.path.join(path, file),
+                                      map_location='cpu'))
+    assert tensors, f'No weights in {path}'
+    return tensors
@@ -0,0 +1,96 @@
+"""Formatting, sampling and caching of the calibration sets."""
+import json
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import calibration_data  # noqa: E402
+
+
+def test_platypus_text_with_input():
+    text = calibration_data._platypus_text(None, {
+        'instruction': 'Add the numbers.', 'input': '2 and 3',
+        'output': '5'})
+    assert text == (
+        "Below is an instruction that describes a task, paired with an input "
+        "that provides further context. Write a response that appropriately "
+        "completes the request.\n\n### Instruction:\nAdd the numbers.\n\n"
+        "### Input:\n2 and 3\n\n### Response:\n5")
+
+
+def test_platypus_text_without_input():
+    text = calibration_data._platypus_text(None, {
+        'instruction': 'Add 2 and 3.', 'input': '', 'output': '5'})
+    assert text == (
+        "Below is an instruction that describes a task. Write a response "
+        "that appropriately completes the request.\n\n### Instruction:\n"
+        "Add 2 and 3.\n\n### Response:\n5")
+
+
+def test_platypus_templates_of_sparseml():
+    data = pytest.importorskip('sparseml.transformers.finetune.data')
+    templates = data.OpenPlatypusDataset.ALPACA_TEMPLATE
+    assert calibration_data.ALPACA_PROMPT == templates['prompt_input']
+    assert (calibration_data.ALPACA_PROMPT_NO_INPUT
+            == templates['prompt_no_input'])
+
+
+def test_reservoir_sample_is_deterministic():
+    sample = calibration_data.reservoir_sample(range(1000), 10, seed=3)
+    assert sample == calibration_data.reservoir_sample(range(1000), 10,
+                                                       seed=3)
+    assert sample != calibration_data.reservoir_sample(range(1000), 10,
+                                                       seed=4)
+
+
+def test_reservoir_sample_size():
+    sample = calibration_data.reservoir_sample(iter(range(1000)), 10)
+    assert len(sample) == 10
+    assert len(set(sample)) == 10
+    assert set(sample) <= set(range(1000))
+
+
+@pytest.mark.parametrize('num_samples', [5, 6])
+def test_reservoir_sample_whole_iterable(num_samples):
+    assert calibration_data.reservoir_sample(range(5), num_samples) == [
+        0, 1, 2, 3, 4]
+
+
+def test_calibration_set_cache_key(tmp_path, monkeypatch):
+    model_path = tmp_path / 'model'
+    model_path.mkdir()
+    (model_path / 'tokenizer.json').write_text('{"version": 1}')
+    (model_path / 'config.json').write_text('{}')
+    builds = []
+
+    def build(path, model_path, ds, num_samples, max_seq_len, seed):
+        builds.append(seed)
+        os.makedirs(path)
+        np.save(os.path.join(path, 'input_ids.npy'),
+                np.full((num_samples, max_seq_len), seed, dtype=np.int32))
+        np.save(os.path.join(path, 'lengths.npy'),
+                np.full(num_samples, max_seq_len, dtype=np.int32))
+        with open(os.path.join(path, 'info.json'), 'w') as f:
+            json.dump({'seed': seed}, f)
+
+    monkeypatch.setattr(calibration_data, 'build_calibration_set', build)
+
+    def load(seed=42, path='calibration'):
+        return calibration_data.calibration_set(
+            str(model_path), 'open_platypus', 4, 8, str(tmp_path / path),
+            seed=seed, cache_dir=str(tmp_path / 'cache'))
+
+    assert load().info == {'seed': 42}
+    assert len(load(path='other')) == 4
+    assert builds == [42]
+    assert load(seed=7).input_ids[0, 0] == 7
+    assert builds == [42, 7]
+    # Only the tokenizer files are part of the key
+    (model_path / 'config.json').write_text('{"changed": true}')
+    load()
+    assert builds == [42, 7]
+    (model_path / 'tokenizer.json').write_text('{"version": 2}')
+    load()
+    assert builds == [42, 7, 42]
@@ -0,0 +1,29 @@
+"""The checked in pipeline YAMLs, against the pipelines they compile from."""
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('kfp_tekton')
+
+MODULES = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The compiler names the loops after a random hash
+LOOP_HASH = re.compile(r'-[0-9a-f]{5}-for-loop-')
+
+
+def normalized(path):
+    with open(path) as f:
+        return LOOP_HASH.sub('-for-loop-', f.read())
+
+
+@pytest.mark.parametrize('script, yaml', [
+    ('pipeline_nmvllm.py', 'sparseml_pipeline.yaml'),
+    ('pipeline_simplified.py', 'sparseml_simplified_pipeline.yaml')])
+def test_compiled_pipeline_is_up_to_date(script, yaml, tmp_path):
+    subprocess.run([sys.executable, os.path.join(MODULES, script)],
+                   cwd=tmp_path, check=True, capture_output=True)
+    assert normalized(tmp_path / yaml) == normalized(
+        os.path.join(MODULES, yaml)), (
+        f'{yaml} is stale, compile {script} and check it in')
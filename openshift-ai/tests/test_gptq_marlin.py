@@ -0,0 +1,192 @@
+"""gptq_marlin against AutoGPTQ's own two steps conversion, on a tiny Llama.
+
+The two steps save the GPTQ model and load it back with use_marlin, which
+repacks the weights with the autogptq_marlin_cuda.gptq_repack kernel. Without
+a GPU that kernel is replaced by a line by line port of marlin_repack.cu,
+the rest of the conversion runs AutoGPTQ's code.
+"""
+import itertools
+import json
+import os
+import types
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('auto_gptq')
+transformers = pytest.importorskip('transformers')
+
+from auto_gptq import AutoGPTQForCausalLM, BaseQuantizeConfig  # noqa: E402
+from auto_gptq.utils import marlin_utils  # noqa: E402
+from safetensors.torch import load_file  # noqa: E402
+
+import gptq_marlin  # noqa: E402
+
+GPU = (torch.cuda.is_available() and marlin_utils.MARLIN_AVAILABLE
+       and torch.cuda.get_device_capability()[0] >= 8)
+
+
+def gptq_repack(qweight):
+    """marlin_repack.cu, one thread block and thread at a time."""
+    import numpy as np
+
+    weight = qweight.cpu().numpy().view(np.uint32)
+    rows, cols = weight.shape
+    out = np.zeros((rows // 2) * cols * 2, dtype=np.uint32)
+    for bx, by in itertools.product(range(rows // 2), range(cols // 64)):
+        row, col = bx * 2, by * 64
+        block = np.zeros((4, 16, 18), dtype=np.uint32)
+        for thread in range(32):
+            bi, bo = thread // 8, thread % 8
+            for off in range(bo, 16, 8):
+                v1 = int(weight[row, col + bi * 16 + off])
+                v2 = int(weight[row + 1, col + bi * 16 + off])
+                for i in range(8):
+                    block[bi][i][off] = v1 & 0xf
+                    v1 >>= 4
+                    block[bi][i + 8][off] = v2 & 0xf
+                    v2 >>= 4
+        for thread in range(32):
+            srow, scol = (thread % 4) * 2, thread // 4
+            index = [(srow, scol), (srow + 8, scol), (srow, scol + 8),
+                     (srow + 8, scol + 8), (srow + 1, scol), (srow + 9, scol),
+                     (srow + 1, scol + 8), (srow + 9, scol + 8)]
+            for i in range(4):
+                packed = 0
+                for j, (a, b) in enumerate(index):
+                    packed |= int(block[i][a][b]) << (4 * j)
+                out[bx * cols * 2 + by * 128 + thread * 4 + i] = packed
+    return torch.from_numpy(out.view(np.int32).reshape(rows // 2, cols * 2))
+
+
+@pytest.fixture
+def cpu_marlin(monkeypatch):
+    """Let AutoGPTQ load models with use_marlin without a GPU.
+
+    Its Marlin layers and checks only look at the device capability, and the
+    repacking kernel is the port above.
+    """
+    if GPU:
+        return
+    monkeypatch.setattr(torch.cuda, 'get_device_capability',
+                        lambda *args: (8, 0))
+    monkeypatch.setattr(marlin_utils, 'MARLIN_AVAILABLE', True)
+    monkeypatch.setattr(marlin_utils, 'autogptq_marlin_cuda',
+                        types.SimpleNamespace(gptq_repack=gptq_repack),
+                        raising=False)
+
+
+@pytest.fixture(scope='module')
+def tiny_llama(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('tiny-llama'))
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(
+        hidden_size=256, intermediate_size=512, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=4, vocab_size=512,
+        max_position_embeddings=128)
+    transformers.LlamaForCausalLM(config).to(torch.float16).save_pretrained(
+        path, safe_serialization=True)
+    return path
+
+
+def quantized(model_path, group_size):
+    """An AutoGPTQ model of model_path as quantize() leaves it.
+
+    AutoGPTQ only runs GPTQ on a GPU. Without one the int4 weights are
+    rounded to nearest with the quantizer of GPTQ instead, and packed by the
+    same pack_model, so the model is in the very same format.
+    """
+    quantize_config = BaseQuantizeConfig(bits=4, group_size=group_size,
+                                         desc_act=False,
+                                         model_file_base_name='model')
+    if GPU:
+        model = AutoGPTQForCausalLM.from_pretrained(model_path,
+                                                    quantize_config)
+        generator = torch.Generator().manual_seed(0)
+        examples = [{'input_ids': ids, 'attention_mask': torch.ones_like(ids)}
+                    for ids in torch.randint(0, 512, (8, 1, 64),
+                                             generator=generator)]
+        model.quantize(examples)
+        return model, quantize_config
+
+    from auto_gptq.modeling import LlamaGPTQForCausalLM
+    from auto_gptq.modeling._utils import find_layers, pack_model
+    from auto_gptq.quantization import Quantizer
+
+    hf_model = transformers.AutoModelForCausalLM.from_pretrained(
+        model_path, torch_dtype=torch.float16)
+    quantizers = {}
+    for index, layer in enumerate(hf_model.model.layers):
+        for name, linear in find_layers(layer).items():
+            weight = linear.weight.data.float()
+            size = group_size if group_size != -1 else weight.shape[1]
+            scales, zeros = [], []
+            for start in range(0, weight.shape[1], size):
+                quantizer = Quantizer()
+                quantizer.configure(4, perchannel=True, sym=True, mse=False)
+                quantizer.find_params(weight[:, start:start + size],
+                                      weight=True)
+                scales.append(quantizer.scale)
+                zeros.append(quantizer.zero)
+            g_idx = torch.arange(weight.shape[1], dtype=torch.int32) // size
+            quantizers[f'model.layers.{index}.{name}'] = (
+                quantizer, torch.cat(scales, dim=1), torch.cat(zeros, dim=1),
+                g_idx)
+    pack_model(hf_model, quantizers, 4, group_size)
+    return (LlamaGPTQForCausalLM(hf_model, True, quantize_config),
+            quantize_config)
+
+
+def saved(path):
+    tensors = load_file(os.path.join(path, 'model.safetensors'))
+    with open(os.path.join(path, 'quantize_config.json')) as f:
+        return tensors, json.load(f)
+
+
+@pytest.mark.parametrize('group_size', [128, -1])
+def test_matches_two_steps(tiny_llama, tmp_path, cpu_marlin, group_size):
+    model, quantize_config = quantized(tiny_llama, group_size)
+    gptq_dir = str(tmp_path / 'gptq')
+    model.save_pretrained(gptq_dir)
+
+    gptq_marlin.save_marlin(model, quantize_config, str(tmp_path / 'one'))
+
+    two_steps = AutoGPTQForCausalLM.from_quantized(
+        gptq_dir, use_marlin=True, device_map='auto')
+    two_steps.save_pretrained(str(tmp_path / 'two'))
+
+    one_tensors, one_config = saved(str(tmp_path / 'one'))
+    two_tensors, two_config = saved(str(tmp_path / 'two'))
+    assert one_config == two_config
+    assert one_config['is_marlin_format']
+    assert sorted(one_tensors) == sorted(two_tensors)
+    assert any(name.endswith('.B') for name in one_tensors)
+    for name, tensor in one_tensors.items():
+        assert tensor.dtype == two_tensors[name].dtype, name
+        assert torch.equal(tensor, two_tensors[name]), name
+
+
+def test_rejects_act_order():
+    quantize_config = BaseQuantizeConfig(bits=4, group_size=128, desc_act=True)
+    with pytest.raises(ValueError, match='act-order'):
+        gptq_marlin.convert_to_marlin(torch.nn.Module(), quantize_config)
+
+
+def test_two_steps_fallback(tiny_llama, tmp_path, cpu_marlin, monkeypatch):
+    model, quantize_config = quantized(tiny_llama, 128)
+    model.save_pretrained(str(tmp_path / 'gptq'))
+    gptq_marlin.save_marlin(model, quantize_config, str(tmp_path / 'one'))
+
+    gptq = AutoGPTQForCausalLM.from_quantized(
+        str(tmp_path / 'gptq'), device='cpu', disable_exllama=True,
+        disable_exllamav2=True)
+    monkeypatch.setattr(gptq_marlin, 'REPACK_AVAILABLE', False)
+    gptq_marlin.save_marlin(gptq, gptq.quantize_config,
+                            str(tmp_path / 'two'))
+
+    assert not os.path.exists(str(tmp_path / 'two-gptq'))
+    one_tensors, _ = saved(str(tmp_path / 'one'))
+    two_tensors, _ = saved(str(tmp_path / 'two'))
+    assert sorted(one_tensors) == sorted(two_tensors)
+    for name, tensor in one_tensors.items():
+        assert torch.equal(tensor, two_tensors[name]), name
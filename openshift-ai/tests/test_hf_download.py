@@ -0,0 +1,176 @@
+"""HF downloads against a local stand-in for the hub."""
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from model_storage import folder_hash, select_hf_files
+
+SHA = '0123456789abcdef0123456789abcdef01234567'
+REPO = 'org/tiny-llm'
+FILES = {
+    'config.json': b'{"model_type": "llama"}',
+    'generation_config.json': b'{}',
+    'tokenizer.json': b'{"version": "1.0"}',
+    'tokenizer.model': b'sentencepiece',
+    'model-00001-of-00002.safetensors': os.urandom(3 * 2**20),
+    'model-00002-of-00002.safetensors': os.urandom(2**20),
+    'model.safetensors.index.json': json.dumps({'weight_map': {
+        'model.embed_tokens.weight': 'model-00001-of-00002.safetensors',
+        'lm_head.weight': 'model-00002-of-00002.safetensors'}}).encode(),
+    # The same weights in a single file, as mistral repos ship them
+    'consolidated.safetensors': os.urandom(2**20),
+    'pytorch_model.bin': os.urandom(2**20),
+    'pytorch_model.bin.index.json': b'{"weight_map": {}}',
+    'onnx/model.onnx': os.urandom(2**20),
+    'model.gguf': b'gguf',
+    'README.md': b'# tiny',
+    'images/logo.png': b'png',
+}
+
+
+def read_index(files):
+    return lambda file: json.loads(files[file])
+
+
+def test_select_prefers_safetensors():
+    assert sorted(select_hf_files(FILES, read_index=read_index(FILES))) == [
+        'config.json', 'generation_config.json',
+        'model-00001-of-00002.safetensors', 'model-00002-of-00002.safetensors',
+        'model.safetensors.index.json', 'tokenizer.json', 'tokenizer.model']
+
+
+def test_select_single_safetensors():
+    files = ['config.json', 'model.safetensors', 'consolidated.safetensors']
+    assert select_hf_files(files) == ['config.json', 'model.safetensors']
+
+
+def test_select_shards_of_the_index_in_subfolders():
+    files = {
+        'config.json': b'{}',
+        'model.safetensors.index.json': json.dumps({'weight_map': {
+            'a': 'weights/model-00001-of-00002.safetensors',
+            'b': 'weights/model-00002-of-00002.safetensors'}}).encode(),
+        'weights/model-00001-of-00002.safetensors': b'',
+        'weights/model-00002-of-00002.safetensors': b'',
+        'consolidated.safetensors': b'',
+        'original/consolidated.00.pth': b'',
+    }
+    assert sorted(select_hf_files(files, read_index=read_index(files))) == [
+        'config.json', 'model.safetensors.index.json',
+        'weights/model-00001-of-00002.safetensors',
+        'weights/model-00002-of-00002.safetensors']
+
+    del files['weights/model-00002-of-00002.safetensors']
+    with pytest.raises(RuntimeError, match='model-00002-of-00002'):
+        select_hf_files(files, read_index=read_index(files))
+
+
+def test_select_falls_back_to_bin():
+    files = [file for file in FILES if 'safetensors' not in file]
+    # Not the index next to it, transformers loads the single file first
+    assert sorted(select_hf_files(files)) == [
+        'config.json', 'generation_config.json', 'pytorch_model.bin',
+        'tokenizer.json', 'tokenizer.model']
+
+
+def test_select_allow_patterns():
+    assert sorted(select_hf_files(FILES, ['*.json'])) == [
+        'config.json', 'generation_config.json',
+        'model.safetensors.index.json', 'pytorch_model.bin.index.json',
+        'tokenizer.json']
+
+
+class Hub(BaseHTTPRequestHandler):
+    """The model_info and resolve endpoints of the hub, for REPO only."""
+
+    fetched = []
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, body, content_type='application/octet-stream', **headers):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command == 'GET':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path.startswith(f'/api/models/{REPO}'):
+            return self.send(json.dumps({
+                'id': REPO, 'sha': SHA,
+                'siblings': [{'rfilename': file, 'size': len(data)}
+                             for file, data in FILES.items()]}).encode(),
+                'application/json')
+        prefix = f'/{REPO}/resolve/{SHA}/'
+        if not path.startswith(prefix) or path[len(prefix):] not in FILES:
+            self.send_error(404)
+            return
+        file = path[len(prefix):]
+        if self.command == 'GET':
+            Hub.fetched.append(file)
+        data = FILES[file]
+        self.send(data, **{'X-Repo-Commit': SHA,
+                           'ETag': f'"{hashlib.sha256(data).hexdigest()}"'})
+
+    do_HEAD = do_GET
+
+
+@pytest.fixture
+def hub():
+    pytest.importorskip('huggingface_hub')
+    Hub.fetched = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Hub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+
+def download(endpoint, local_path, *args):
+    # HF_ENDPOINT is read when huggingface_hub is imported, as in the steps
+    modules = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, HF_ENDPOINT=endpoint, HF_HUB_DISABLE_TELEMETRY='1',
+               HF_HOME=os.path.join(local_path, os.pardir, 'hf-home'),
+               PYTHONPATH=modules)
+    subprocess.run([sys.executable, '-c',
+                    'import sys, model_storage; '
+                    'model_storage.download_from_hf(*sys.argv[1:])',
+                    REPO, local_path, *args], env=env, check=True)
+
+
+def test_download_from_hf(hub, tmp_path):
+    local_path = str(tmp_path / 'model')
+    download(hub, local_path)
+
+    selected = select_hf_files(FILES, read_index=read_index(FILES))
+    assert 'consolidated.safetensors' not in selected
+    assert sorted(Hub.fetched) == sorted(selected)
+    files = {os.path.relpath(os.path.join(root, file), local_path)
+             for root, dirs, files in os.walk(local_path) for file in files}
+    assert files == set(selected)
+    for file in selected:
+        with open(os.path.join(local_path, file), 'rb') as f:
+            assert f.read() == FILES[file]
+
+
+def test_folder_hash_ignores_hub_metadata(tmp_path):
+    model = tmp_path / 'model'
+    (model / 'sub').mkdir(parents=True)
+    (model / 'config.json').write_bytes(b'{}')
+    (model / 'sub' / 'vocab.txt').write_bytes(b'a')
+    before = folder_hash(str(model))
+    (model / '.cache' / 'huggingface').mkdir(parents=True)
+    (model / '.cache' / 'huggingface' / 'config.json.metadata').write_text('x')
+    assert folder_hash(str(model)) == before
+    (model / 'sub' / 'vocab.txt').write_bytes(b'b')
+    assert folder_hash(str(model)) != before
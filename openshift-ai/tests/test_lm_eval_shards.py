@@ -0,0 +1,42 @@
+"""Merging the scores of the eval shards."""
+import statistics
+
+import pytest
+
+from lm_eval_shards import merge_shards
+
+# Per document accuracies of the two shards of a task
+DOCS = [[1, 0, 1, 1, 1], [0, 1, 0]]
+
+
+def score(docs):
+    return (statistics.mean(docs),
+            statistics.stdev(docs) / len(docs) ** 0.5)
+
+
+def shard_result(shard, docs, mean_key, stderr_key):
+    mean, stderr = score(docs)
+    return {'shard': shard, 'num_shards': len(DOCS),
+            'counts': {'hellaswag': len(docs)},
+            'aggregations': {'hellaswag': {'acc': 'mean'}},
+            'results': {'hellaswag': {mean_key: mean, stderr_key: stderr,
+                                      'alias': 'hellaswag'}}}
+
+
+# The 0.4 harness suffixes the metrics with their filter, the legacy one not
+@pytest.mark.parametrize('mean_key, stderr_key',
+                         [('acc,none', 'acc_stderr,none'),
+                          ('acc', 'acc_stderr')],
+                         ids=['filtered', 'legacy'])
+def test_merge_shards(mean_key, stderr_key):
+    merged = merge_shards([shard_result(shard, docs, mean_key, stderr_key)
+                           for shard, docs in enumerate(DOCS)])
+
+    mean, stderr = score(DOCS[0] + DOCS[1])
+    results = merged['results']['hellaswag']
+    assert merged['counts'] == {'hellaswag': 8}
+    assert results[mean_key] == pytest.approx(mean)
+    # Exact, the stderr of the documents of both shards
+    assert results[stderr_key] == pytest.approx(stderr)
+    assert results['alias'] == 'hellaswag'
+    assert merged['approximate'] == []
@@ -0,0 +1,46 @@
+"""The model cache, and the step outputs it memoizes."""
+import os
+
+from model_storage import ModelCache, memoize_step
+
+
+def produce(path):
+    os.makedirs(os.path.join(path, 'sub'))
+    with open(os.path.join(path, 'weights.bin'), 'wb') as f:
+        f.write(b'cached' * 1000)
+    with open(os.path.join(path, 'sub', 'config.json'), 'w') as f:
+        f.write('{"cached": true}')
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_writes_to_fetched_files_leave_the_entry_alone(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    output = tmp_path / 'output'
+    assert not memoize_step('step', str(output), produce, cache_dir, seed=1)
+
+    # In place, as np.save or a step appending to its output would
+    with open(output / 'weights.bin', 'r+b') as f:
+        f.write(b'change')
+    with open(output / 'sub' / 'config.json', 'w') as f:
+        f.write('{}')
+
+    assert memoize_step('step', str(tmp_path / 'again'), produce, cache_dir,
+                        seed=1)
+    assert read(tmp_path / 'again' / 'weights.bin') == b'cached' * 1000
+    assert read(tmp_path / 'again' / 'sub' / 'config.json') == (
+        b'{"cached": true}')
+
+
+def test_writes_to_stored_folders_leave_the_entry_alone(tmp_path):
+    cache = ModelCache(str(tmp_path / 'cache'))
+    produce(str(tmp_path / 'model'))
+    cache.store('HF', 'org/model', 'abc', str(tmp_path / 'model'))
+    with open(tmp_path / 'model' / 'weights.bin', 'r+b') as f:
+        f.write(b'change')
+
+    assert cache.fetch('HF', 'org/model', 'abc', str(tmp_path / 'fetched'))
+    assert read(tmp_path / 'fetched' / 'weights.bin') == b'cached' * 1000
@@ -0,0 +1,173 @@
+"""ModelStorage transfers against a local moto S3 server."""
+import io
+import os
+import urllib.request
+
+import pytest
+
+moto_server = pytest.importorskip('moto.server')
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    server = moto_server.ThreadedMotoServer(ip_address='127.0.0.1', port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    monkeypatch.setenv('s3_host', f'http://{host}:{port}')
+    monkeypatch.setenv('s3_bucket', 'models')
+    monkeypatch.setenv('s3_access_key', 'test')
+    monkeypatch.setenv('s3_secret_access_key', 'test')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+
+    from model_storage import ModelStorage
+
+    storage = ModelStorage(multipart_chunksize_mb=5)
+    storage.client.create_bucket(Bucket='models')
+    yield storage
+    # The server keeps its buckets in the process, across restarts
+    urllib.request.urlopen(urllib.request.Request(
+        f'http://{host}:{port}/moto-api/reset', method='POST'))
+    server.stop()
+
+
+def write_model(path, files):
+    for name, data in files.items():
+        os.makedirs(os.path.dirname(os.path.join(path, name)), exist_ok=True)
+        with open(os.path.join(path, name), 'wb') as f:
+            f.write(data)
+
+
+def read_model(path):
+    files = {}
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            with open(os.path.join(root, name), 'rb') as f:
+                files[os.path.relpath(os.path.join(root, name), path)] = f.read()
+    return files
+
+
+MODEL = {'config.json': b'{}', 'ig.bin': os.urandom(11 * 2**20),
+         'tokenizer/vocab.txt': b'a\nb\n'}
+
+
+@pytest.mark.parametrize('suffix', ['', '/'])
+def test_upload_download(storage, tmp_path, suffix):
+    write_model(tmp_path / 'src', MODEL)
+    storage.upload(str(tmp_path / 'src') + suffix, 'm3')
+
+    keys = {object['Key'] for object in storage.list_objects('m3/')}
+    assert keys == {'m3/' + path for path in MODEL}
+    assert set(storage.get_manifest('m3')['files']) == set(MODEL)
+
+    storage.download('m3', str(tmp_path / 'dst'))
+    assert read_model(tmp_path / 'dst') == MODEL
+
+
+def test_packed(storage, tmp_path):
+    pytest.importorskip('zstandard')
+    write_model(tmp_path / 'src', MODEL)
+    storage.upload(str(tmp_path / 'src'), 'm3', layout='packed')
+    assert not storage.is_uploading('m3')
+    storage.download('m3', str(tmp_path / 'dst'))
+    assert read_model(tmp_path / 'dst') == MODEL
+
+
+def test_sync_upload(storage, tmp_path):
+    write_model(tmp_path / 'src', MODEL)
+    storage.upload(str(tmp_path / 'src'), 'm3')
+    os.remove(tmp_path / 'src' / 'config.json')
+    write_model(tmp_path / 'src', {'tokenizer/vocab.txt': b'c\n'})
+    storage.upload(str(tmp_path / 'src'), 'm3')
+
+    keys = {object['Key'] for object in storage.list_objects('m3/')}
+    assert keys == {'m3/ig.bin', 'm3/tokenizer/vocab.txt'}
+    assert storage.metrics.bytes['skipped'] == len(MODEL['ig.bin'])
+    storage.download('m3', str(tmp_path / 'dst'))
+    assert read_model(tmp_path / 'dst') == read_model(tmp_path / 'src')
+
+
+def test_failed_upload_blocks_downloads(storage, tmp_path, monkeypatch):
+    write_model(tmp_path / 'src', MODEL)
+    storage.upload(str(tmp_path / 'src'), 'm3')
+    assert not storage.is_uploading('m3')
+
+    def fail(*args):
+        raise ConnectionError('preempted')
+
+    write_model(tmp_path / 'src', {'ig.bin': os.urandom(11 * 2**20)})
+    upload_file = storage._upload_file
+    monkeypatch.setattr(storage, '_upload_file', fail)
+    with pytest.raises(ConnectionError):
+        storage.upload(str(tmp_path / 'src'), 'm3')
+    assert storage.is_uploading('m3')
+    with pytest.raises(RuntimeError, match='being uploaded'):
+        storage.download('m3', str(tmp_path / 'dst'))
+
+    monkeypatch.setattr(storage, '_upload_file', upload_file)
+    storage.upload(str(tmp_path / 'src'), 'm3')
+    assert not storage.is_uploading('m3')
+    storage.download('m3', str(tmp_path / 'dst'))
+    assert read_model(tmp_path / 'dst') == read_model(tmp_path / 'src')
+
+
+def put_without_manifest(storage, path, files):
+    # As other tools upload, the big files in 5 MiB parts
+    from boto3.s3.transfer import TransferConfig
+
+    config = TransferConfig(multipart_threshold=5 * 2**20,
+                            multipart_chunksize=5 * 2**20)
+    for name, data in files.items():
+        storage.client.upload_fileobj(io.BytesIO(data), 'models',
+                                      f'{path}/{name}', Config=config)
+
+
+def test_download_without_manifest(storage, tmp_path):
+    put_without_manifest(storage, 'm3', MODEL)
+    etags = {object['Key']: object['ETag']
+             for object in storage.list_objects('m3/')}
+    assert '-' in etags['m3/ig.bin'] and '-' not in etags['m3/config.json']
+
+    storage.download('m3', str(tmp_path / 'dst'))
+    assert read_model(tmp_path / 'dst') == MODEL
+
+
+@pytest.mark.parametrize('corrupted', ['ig.bin', 'config.json'],
+                         ids=['multipart', 'single-part'])
+def test_download_without_manifest_checks_etags(storage, tmp_path,
+                                                monkeypatch, corrupted):
+    put_without_manifest(storage, 'm3', MODEL)
+    get_object = storage.client.get_object
+
+    class Corrupted:
+        # Flips a bit of the first chunk of the body
+        def __init__(self, body):
+            self.body = body
+
+        def iter_chunks(self, size):
+            for index, chunk in enumerate(self.body.iter_chunks(size)):
+                yield chunk if index else bytes([chunk[0] ^ 1]) + chunk[1:]
+
+    def corrupt(**kwargs):
+        response = get_object(**kwargs)
+        if (kwargs['Key'] == 'm3/' + corrupted
+                and kwargs['Range'].startswith('bytes=0-')):
+            response['Body'] = Corrupted(response['Body'])
+        return response
+
+    monkeypatch.setattr(storage.client, 'get_object', corrupt)
+    with pytest.raises(RuntimeError, match=f'Checksum mismatch for '
+                                           f'm3/{corrupted}'):
+        storage.download('m3', str(tmp_path / 'dst'))
+
+
+def test_is_uploading_raises_on_errors(storage, monkeypatch):
+    from botocore.exceptions import ClientError
+
+    def forbidden(**kwargs):
+        raise ClientError({'Error': {'Code': '403', 'Message': 'Forbidden'}},
+                          'HeadObject')
+
+    assert not storage.is_uploading('m3')
+    monkeypatch.setattr(storage.client, 'head_object', forbidden)
+    with pytest.raises(ClientError):
+        storage.is_uploading('m3')
@@ -0,0 +1,132 @@
+"""SparseML oneshot on a tiny Llama, killed and resumed from its checkpoints."""
+import json
+import os
+import signal
+import subprocess
+import sys
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('sparseml.transformers')
+
+import oneshot_checkpoints  # noqa: E402
+from conftest import load_weights  # noqa: E402
+
+MODULES = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SPARSE = """
+test_stage:
+  obcq_modifiers:
+    SparseGPTModifier:
+      sparsity: 0.5
+      sequential_update: true
+      targets: ["re:model.layers.\\\\d*$"]
+"""
+# The recipe of sparse_cpu_model in pipeline_simplified.py, without the
+# attention matmuls the Llama of transformers does not have as modules
+SPARSE_QUANTIZE = """
+test_stage:
+  obcq_modifiers:
+    QuantizationModifier:
+      ignore: [LlamaRotaryEmbedding, LlamaRMSNorm, SiLUActivation]
+      post_oneshot_calibration: true
+      scheme_overrides:
+        Linear:
+          weights: {num_bits: 8, symmetric: true, strategy: channel}
+        Embedding:
+          input_activations: null
+          weights: {num_bits: 8, symmetric: false}
+    SparseGPTModifier:
+      sparsity: 0.5
+      sequential_update: true
+      quantize: true
+      targets: ["re:model.layers.\\\\d*$"]
+"""
+
+# Runs oneshot on the model of argv[1] into argv[3], checkpointing in
+# argv[2], and kills itself with SIGKILL when about to prune the argv[6]th
+# linear layer, if any
+RUN = '''
+import json, os, signal, sys
+import sparseml.transformers
+from datasets import Dataset
+from sparseml.modifiers.obcq.utils.sgpt_wrapper import SparseGptWrapper
+from oneshot_checkpoints import resumable_oneshot
+model_path, checkpoint_dir, output_dir, recipe, replay, kill_at = sys.argv[1:]
+with open(os.path.join(model_path, 'texts.json')) as f:
+    texts = json.load(f)
+fasterprune = SparseGptWrapper.fasterprune
+calls = []
+def prune_or_die(*args, **kwargs):
+    if len(calls) == int(kill_at):
+        os.kill(os.getpid(), signal.SIGKILL)
+    calls.append(None)
+    return fasterprune(*args, **kwargs)
+SparseGptWrapper.fasterprune = prune_or_die
+model = sparseml.transformers.SparseAutoModelForCausalLM.from_pretrained(
+    model_path)
+with resumable_oneshot(checkpoint_dir, 'key', replay == 'True'):
+    sparseml.transformers.oneshot(
+        model=model, dataset=Dataset.from_dict({'text': texts}),
+        recipe=recipe, output_dir=output_dir,
+        num_calibration_samples=len(texts), max_seq_length=128,
+        pad_to_max_length=False, oneshot_device='cpu')
+'''
+
+# Linear layers of a decoder layer of the tiny Llama
+LINEARS = 7
+
+
+def run(model_path, checkpoint_dir, output_dir, recipe, replay=False,
+        kill_at=-1):
+    process = subprocess.run(
+        [sys.executable, '-c', RUN, model_path, checkpoint_dir, output_dir,
+         recipe, str(replay), str(kill_at)],
+        env=dict(os.environ, PYTHONPATH=MODULES), capture_output=True,
+        text=True, cwd=os.path.dirname(output_dir))
+    if kill_at >= 0:
+        assert process.returncode == -signal.SIGKILL, process.stderr
+    else:
+        assert process.returncode == 0, process.stderr
+
+
+@pytest.mark.parametrize('recipe, replay', [(SPARSE, False),
+                                            (SPARSE_QUANTIZE, True)],
+                         ids=['sparse', 'sparse-quantize'])
+def test_resume_after_kill(calibration_llama, tmp_path, recipe, replay):
+    run(calibration_llama, str(tmp_path / 'ck-full'), str(tmp_path / 'full'),
+        recipe, replay)
+
+    # Killed while pruning the third layer, the first two are checkpointed
+    run(calibration_llama, str(tmp_path / 'ck'), str(tmp_path / 'resumed'),
+        recipe, replay, kill_at=2 * LINEARS + 1)
+    with open(tmp_path / 'ck' / oneshot_checkpoints.PROGRESS_FILE) as f:
+        assert json.load(f) == {'key': 'key', 'completed': 1}
+    assert sorted(os.listdir(tmp_path / 'ck')) == [
+        'layer-00000.pt', 'layer-00001.pt',
+        oneshot_checkpoints.PROGRESS_FILE]
+    run(calibration_llama, str(tmp_path / 'ck'), str(tmp_path / 'resumed'),
+        recipe, replay)
+
+    full = load_weights(str(tmp_path / 'full'))
+    resumed = load_weights(str(tmp_path / 'resumed'))
+    assert sorted(full) == sorted(resumed)
+    for name, tensor in full.items():
+        assert torch.equal(tensor, resumed[name]), name
+    # model.layers.2.mlp.down_proj.module.weight once quantized
+    down_proj = next(tensor for name, tensor in full.items()
+                     if name.startswith('model.layers.2.mlp.down_proj.')
+                     and name.endswith('.weight'))
+    assert (down_proj == 0).float().mean().item() == pytest.approx(0.5,
+                                                                   abs=1e-3)
+
+
+def test_other_key_starts_over(tmp_path):
+    checkpoints = oneshot_checkpoints.LayerCheckpoints(str(tmp_path), 'key')
+    checkpoints.save(0, torch.nn.Linear(2, 2))
+    assert oneshot_checkpoints.LayerCheckpoints(
+        str(tmp_path), 'key').completed == 0
+    assert oneshot_checkpoints.LayerCheckpoints(
+        str(tmp_path), 'other').completed == -1
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,78 @@
+"""The cost model the pipeline steps are sized with."""
+import json
+import urllib.request
+
+import pytest
+
+import resource_model
+from resource_model import ModelProfile, model_profile, stage_resources
+
+# config.json of meta-llama/Llama-2-7b-hf
+LLAMA_2_7B = {
+    'architectures': ['LlamaForCausalLM'], 'model_type': 'llama',
+    'hidden_size': 4096, 'intermediate_size': 11008,
+    'num_hidden_layers': 32, 'num_attention_heads': 32,
+    'num_key_value_heads': 32, 'vocab_size': 32000, 'hidden_act': 'silu',
+    'tie_word_embeddings': False, 'torch_dtype': 'float16',
+}
+# config.json of TinyLlama/TinyLlama-1.1B-Chat-v1.0
+TINYLLAMA = {
+    'model_type': 'llama', 'hidden_size': 2048, 'intermediate_size': 5632,
+    'num_hidden_layers': 22, 'num_attention_heads': 32,
+    'num_key_value_heads': 4, 'vocab_size': 32000, 'hidden_act': 'silu',
+    'tie_word_embeddings': False,
+}
+
+
+def test_parameters():
+    # 6.74B with the norms, which the cost model leaves out
+    assert ModelProfile(LLAMA_2_7B).parameters == pytest.approx(6.738e9,
+                                                                rel=1e-3)
+    assert ModelProfile(TINYLLAMA).parameters == pytest.approx(1.1e9,
+                                                               rel=1e-2)
+
+
+def test_stage_resources():
+    tiny, llama = ModelProfile(TINYLLAMA), ModelProfile(LLAMA_2_7B)
+    # Instead of the 3 GPUs every model used to get
+    assert stage_resources(tiny, 'sparse').gpus == 1
+    # 13.5 GB of bf16 weights, the Hessians and activations, on 40 GiB GPUs
+    sparse = stage_resources(llama, 'sparse')
+    assert sparse.gpus == 1
+    assert sparse.memory_gib == 13 + resource_model.BASE_MEMORY_GIB
+    # Loaded in fp32 for the SparseML quantization, with the activations of
+    # the calibration set
+    assert stage_resources(llama, 'quantize_cpu').gpus == 1
+    assert stage_resources(llama, 'quantize_cpu', samples=1024,
+                           seq_len=2048).gpus == 3
+    low_memory = stage_resources(llama, 'sparse_low_memory')
+    assert low_memory.gpus == 0
+    assert low_memory.memory_gib < sparse.memory_gib
+    # The fp32 model, its graph and their weights, 75.3 GiB
+    assert stage_resources(llama, 'export').memory_gib == (
+        76 + resource_model.BASE_MEMORY_GIB)
+    with pytest.raises(ValueError, match='Unknown stage'):
+        stage_resources(llama, 'train')
+
+
+def test_stage_resources_on_smaller_gpus(monkeypatch):
+    monkeypatch.setattr(resource_model, 'GPU_MEMORY_GIB', 16)
+    assert stage_resources(ModelProfile(LLAMA_2_7B), 'serve').gpus == 2
+
+
+def test_model_profile_stays_offline(tmp_path, monkeypatch):
+    def urlopen(*args, **kwargs):
+        raise AssertionError('The HF hub was called')
+
+    monkeypatch.setattr(urllib.request, 'urlopen', urlopen)
+    monkeypatch.delenv('MODEL_CONFIG', raising=False)
+    monkeypatch.delenv('FETCH_MODEL_CONFIG', raising=False)
+    with pytest.warns(UserWarning, match='FETCH_MODEL_CONFIG'):
+        assert model_profile('meta-llama/Llama-2-7b-hf') is None
+
+    config = tmp_path / 'config.json'
+    config.write_text(json.dumps(LLAMA_2_7B))
+    monkeypatch.setenv('MODEL_CONFIG', str(config))
+    assert model_profile('meta-llama/Llama-2-7b-hf').layers == 32
+    monkeypatch.delenv('MODEL_CONFIG')
+    assert model_profile(str(tmp_path)).hidden_size == 4096
@@ -0,0 +1,119 @@
+"""sparsegpt streaming a tiny Llama: killed and resumed, and against oneshot."""
+import json
+import os
+import signal
+import subprocess
+import sys
+
+import pytest
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+
+import sparsegpt  # noqa: E402
+from conftest import load_weights  # noqa: E402
+
+MODULES = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGETS = ['re:model.layers.\\d*$']
+
+# Prunes the model of argv[1] into argv[3], checkpointing in argv[2], and
+# kills itself with SIGKILL when about to prune layer argv[4], if any
+RUN = '''
+import json, os, signal, sys
+import torch
+import sparsegpt
+model_path, checkpoint_dir, output_dir, kill_at = sys.argv[1:]
+with open(os.path.join(model_path, 'examples.json')) as f:
+    examples = json.load(f)
+prune_layer = sparsegpt.prune_layer
+calls = []
+def prune_or_die(*args, **kwargs):
+    if len(calls) == int(kill_at):
+        os.kill(os.getpid(), signal.SIGKILL)
+    calls.append(None)
+    return prune_layer(*args, **kwargs)
+sparsegpt.prune_layer = prune_or_die
+sparsegpt.prune_model_streaming(model_path, output_dir, examples, 0.5,
+                                ["re:model.layers.\\\\d*$"], checkpoint_dir,
+                                "key", device="cpu", dtype=torch.float32)
+'''
+
+
+def run(model_path, checkpoint_dir, output_dir, kill_at=-1):
+    process = subprocess.run(
+        [sys.executable, '-c', RUN, model_path, checkpoint_dir, output_dir,
+         str(kill_at)],
+        env=dict(os.environ, PYTHONPATH=MODULES), capture_output=True,
+        text=True)
+    if kill_at >= 0:
+        assert process.returncode == -signal.SIGKILL, process.stderr
+    else:
+        assert process.returncode == 0, process.stderr
+
+
+def test_resume_after_kill(calibration_llama, tmp_path):
+    run(calibration_llama, str(tmp_path / 'ck-full'), str(tmp_path / 'full'))
+
+    # Killed while pruning the third layer, the first two are checkpointed
+    run(calibration_llama, str(tmp_path / 'ck'), str(tmp_path / 'resumed'),
+        kill_at=2)
+    with open(tmp_path / 'ck' / sparsegpt.PROGRESS_FILE) as f:
+        assert json.load(f) == {'key': 'key', 'completed': 1}
+    assert not os.path.exists(tmp_path / 'resumed')
+    run(calibration_llama, str(tmp_path / 'ck'), str(tmp_path / 'resumed'))
+
+    full = load_weights(str(tmp_path / 'full'))
+    resumed = load_weights(str(tmp_path / 'resumed'))
+    assert sorted(full) == sorted(resumed)
+    for name, tensor in full.items():
+        assert torch.equal(tensor, resumed[name]), name
+    down_proj = full['model.layers.2.mlp.down_proj.weight']
+    assert (down_proj == 0).float().mean().item() == pytest.approx(0.5,
+                                                                   abs=1e-3)
+
+
+def test_other_key_starts_over(calibration_llama, tmp_path):
+    run(calibration_llama, str(tmp_path / 'ck'), str(tmp_path / 'out'),
+        kill_at=2)
+    checkpoints = sparsegpt.Checkpoints(str(tmp_path / 'ck'), 'other')
+    assert checkpoints.completed == -1
+    assert os.listdir(tmp_path / 'ck') == []
+
+
+def test_matches_oneshot(calibration_llama, tmp_path, monkeypatch):
+    """Same masks as SparseGPTModifier with sequential_update, same weights
+    up to the float rounding of the Hessian sums."""
+    sparseml = pytest.importorskip('sparseml.transformers')
+    from datasets import Dataset
+
+    monkeypatch.chdir(tmp_path)
+    with open(os.path.join(calibration_llama, 'texts.json')) as f:
+        texts = json.load(f)
+
+    run(calibration_llama, str(tmp_path / 'ck'), str(tmp_path / 'streamed'))
+    ours = load_weights(str(tmp_path / 'streamed'))
+
+    model = sparseml.SparseAutoModelForCausalLM.from_pretrained(
+        calibration_llama)
+    recipe = f"""
+    test_stage:
+      obcq_modifiers:
+        SparseGPTModifier:
+          sparsity: 0.5
+          sequential_update: true
+          targets: {json.dumps(TARGETS)}
+    """
+    # Not padded, as the examples of calibration_data
+    sparseml.oneshot(model=model, dataset=Dataset.from_dict({'text': texts}),
+                     recipe=recipe, output_dir=str(tmp_path / 'oneshot'),
+                     num_calibration_samples=len(texts), max_seq_length=128,
+                     pad_to_max_length=False, oneshot_device='cpu')
+
+    theirs = model.state_dict()
+    for name, tensor in ours.items():
+        if tensor.dim() != 2 or not name.startswith('model.layers.'):
+            assert torch.equal(tensor, theirs[name]), name
+            continue
+        assert torch.equal(tensor == 0, theirs[name] == 0), name
+        assert ((tensor - theirs[name]).norm()
+                / theirs[name].norm()).item() < 1e-4, name
@@ -0,0 +1,61 @@
+"""Planning the sweep, and picking the candidate it keeps."""
+import importlib
+import json
+
+import pytest
+
+pytest.importorskip('kfp')
+pytest.importorskip('kfp_tekton')
+
+
+@pytest.fixture(scope='module')
+def pipeline(tmp_path_factory):
+    # The module compiles the pipeline into the working folder when imported
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.chdir(tmp_path_factory.mktemp('compiled'))
+        return importlib.import_module('pipeline_simplified')
+
+
+def results(path, accuracy):
+    with open(path, 'w') as f:
+        json.dump({'results': {'arc_easy': {'acc,none': accuracy}}}, f)
+
+
+def test_plan_sweep_parses_quantize(pipeline, tmp_path):
+    candidates = json.loads(pipeline.plan_sweep(
+        '[0.5]', '[true, "false", "True", false]', str(tmp_path)))
+    assert [candidate['quantize'] for candidate in candidates] == [
+        True, False, True, False]
+    assert [candidate['name'] for candidate in candidates] == [
+        'sparse50-quant', 'sparse50', 'sparse50-quant', 'sparse50']
+
+
+def test_select_sweep_candidate(pipeline, tmp_path):
+    baseline = tmp_path / 'baseline.json'
+    results(baseline, 0.70)
+    candidates = []
+    # fast is 0.1 below the base model, dominated is slower and less accurate
+    # than close
+    for name, accuracy, latency_ms in [('fast', 0.60, 10.0),
+                                       ('close', 0.67, 20.0),
+                                       ('dominated', 0.66, 25.0)]:
+        (tmp_path / name).mkdir()
+        results(tmp_path / name / 'results.json', accuracy)
+        with open(tmp_path / name / 'benchmark.json', 'w') as f:
+            json.dump({'latency_ms': latency_ms}, f)
+        candidates.append({'name': name, 'eval_dir': str(tmp_path / name),
+                           'benchmark_path': str(tmp_path / name
+                                                 / 'benchmark.json'),
+                           'exported_path': f'/exported/{name}'})
+
+    chosen = pipeline.select_sweep_candidate(
+        json.dumps(candidates), str(baseline), 'arc_easy', 'acc', 0.05,
+        str(tmp_path / 'pareto.json'), str(tmp_path / 'metrics.json'))
+
+    assert tuple(chosen) == ('close', '/exported/close')
+    with open(tmp_path / 'pareto.json') as f:
+        pareto = json.load(f)
+    assert pareto['chosen'] == 'close'
+    assert {candidate['name']: candidate['pareto']
+            for candidate in pareto['candidates']} == {
+        'fast': True, 'close': True, 'dominated': False}